@@ -0,0 +1,11 @@
+-- Adds the round number to matches so a round's results can be checked
+-- against its pairings.  Existing matches are treated as round 1.
+--
+-- Run with: psql tournament -f migrations/001_match_rounds.sql
+
+BEGIN;
+
+ALTER TABLE matches
+	ADD COLUMN round integer NOT NULL DEFAULT 1;
+
+COMMIT;
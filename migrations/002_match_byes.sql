@@ -0,0 +1,13 @@
+-- Lets matches record a bye, which has no second player.
+--
+-- Run with: psql tournament -f migrations/002_match_byes.sql
+
+BEGIN;
+
+ALTER TABLE matches
+	ALTER COLUMN player_2 DROP DEFAULT,
+	ALTER COLUMN player_2 DROP NOT NULL;
+
+DROP SEQUENCE IF EXISTS matches_player_2_seq;
+
+COMMIT;
@@ -0,0 +1,50 @@
+-- Adds primary keys and indexes to tournament_data and matches and the
+-- per-tournament tournament_standings() function.
+--
+-- Players entered into the same tournament more than once are collapsed
+-- into their first entry before the primary key is added.
+--
+-- Run with: psql tournament -f migrations/003_keys_and_indexes.sql
+
+BEGIN;
+
+DELETE FROM tournament_data AS duplicate
+	USING tournament_data AS original
+	WHERE duplicate.tournament_id = original.tournament_id
+	AND duplicate.player_id = original.player_id
+	AND duplicate.ctid > original.ctid;
+
+ALTER TABLE tournament_data
+	ALTER COLUMN tournament_id DROP DEFAULT,
+	ALTER COLUMN player_id DROP DEFAULT,
+	ADD PRIMARY KEY (tournament_id, player_id);
+
+ALTER TABLE matches
+	ALTER COLUMN tournament_id DROP DEFAULT,
+	ALTER COLUMN player_1 DROP DEFAULT;
+
+DROP SEQUENCE IF EXISTS tournament_data_tournament_id_seq;
+DROP SEQUENCE IF EXISTS tournament_data_player_id_seq;
+DROP SEQUENCE IF EXISTS matches_tournament_id_seq;
+DROP SEQUENCE IF EXISTS matches_player_1_seq;
+
+CREATE INDEX tournament_data_player_idx ON tournament_data (player_id);
+CREATE INDEX matches_tournament_round_idx ON matches (tournament_id, round);
+CREATE INDEX matches_player_1_idx ON matches (player_1);
+CREATE INDEX matches_player_2_idx ON matches (player_2);
+
+CREATE FUNCTION tournament_standings(integer)
+	RETURNS TABLE (player_id integer, name text, wins integer, matches integer)
+	LANGUAGE sql STABLE AS $$
+		SELECT players.player_id, players.name,
+		       tournament_data.wins, tournament_data.matches
+		FROM tournament_data JOIN players
+		ON (players.player_id = tournament_data.player_id)
+		WHERE tournament_data.tournament_id = $1
+		ORDER BY tournament_data.wins DESC;
+	$$;
+
+COMMIT;
+
+ANALYZE tournament_data;
+ANALYZE matches;
@@ -0,0 +1,71 @@
+-- Adds tournament_tiebreaks() and orders tournament_standings() by it, so
+-- ties in wins are broken by OMW%, Buchholz and strength of schedule.
+--
+-- Run with: psql tournament -f migrations/004_tiebreak_standings.sql
+
+BEGIN;
+
+CREATE FUNCTION tournament_tiebreaks(integer)
+	-- Returns a tournament's standings with their tiebreakers, computed in a
+	-- single pass over its matches:
+	--   omw       opponents' match-win percentage, each floored at 1/3
+	--   buchholz  the sum of the opponents' wins
+	--   sos       strength of schedule, the average of the opponents' omw
+	-- rank orders players by wins and then each tiebreaker in turn, with
+	-- player_id last so that the ranking is total and stable.  Byes are not
+	-- counted as opponents.
+	RETURNS TABLE (player_id integer, name text, wins integer, matches integer,
+	               omw numeric, buchholz bigint, sos numeric, rank bigint)
+	LANGUAGE sql STABLE AS $$
+		WITH records AS (
+			SELECT tournament_data.player_id, tournament_data.wins,
+			       tournament_data.matches,
+			       CASE WHEN tournament_data.matches > 0
+			            THEN greatest(tournament_data.wins::numeric
+			                          / tournament_data.matches, 1.0 / 3)
+			            ELSE 1.0 / 3 END AS win_pct
+			FROM tournament_data
+			WHERE tournament_data.tournament_id = $1
+		), pairs AS (
+			SELECT player_1 AS player_id, player_2 AS opponent_id
+			FROM matches
+			WHERE tournament_id = $1 AND player_2 IS NOT NULL
+			UNION ALL
+			SELECT player_2, player_1
+			FROM matches
+			WHERE tournament_id = $1 AND player_2 IS NOT NULL
+		), opponents AS (
+			SELECT pairs.player_id, avg(records.win_pct) AS omw,
+			       sum(records.wins) AS buchholz
+			FROM pairs JOIN records ON (records.player_id = pairs.opponent_id)
+			GROUP BY pairs.player_id
+		), schedule AS (
+			SELECT pairs.player_id, avg(opponents.omw) AS sos
+			FROM pairs JOIN opponents ON (opponents.player_id = pairs.opponent_id)
+			GROUP BY pairs.player_id
+		), tiebreaks AS (
+			SELECT players.player_id, players.name, records.wins, records.matches,
+			       coalesce(opponents.omw, 0) AS omw,
+			       coalesce(opponents.buchholz, 0) AS buchholz,
+			       coalesce(schedule.sos, 0) AS sos
+			FROM records
+			JOIN players ON (players.player_id = records.player_id)
+			LEFT JOIN opponents ON (opponents.player_id = records.player_id)
+			LEFT JOIN schedule ON (schedule.player_id = records.player_id)
+		)
+		SELECT tiebreaks.*,
+		       row_number() OVER (ORDER BY wins DESC, omw DESC, buchholz DESC,
+		                                   sos DESC, player_id)
+		FROM tiebreaks
+		ORDER BY 8;
+	$$;
+
+CREATE OR REPLACE FUNCTION tournament_standings(integer)
+	RETURNS TABLE (player_id integer, name text, wins integer, matches integer)
+	LANGUAGE sql STABLE AS $$
+		SELECT player_id, name, wins, matches
+		FROM tournament_tiebreaks($1)
+		ORDER BY rank;
+	$$;
+
+COMMIT;
@@ -0,0 +1,83 @@
+-- Stores results in matches: every match gets a match_id and a result
+-- ('win', 'loss' or 'draw' from player_1's point of view, 'bye', or NULL
+-- until reported), and tournament_data gains a draws column.  Player
+-- records are kept up to date from these results and can be rebuilt from
+-- them.
+--
+-- Matches recorded before this migration only kept running totals, so
+-- their results are unknown: byes are marked as such and other matches
+-- are left unreported.  Their wins and matches totals are kept as they are,
+-- but rebuilding the standings of such a tournament would reset them.
+--
+-- Run with: psql tournament -f migrations/005_match_results.sql
+
+BEGIN;
+
+ALTER TABLE matches
+	ADD COLUMN match_id serial PRIMARY KEY,
+	ADD COLUMN result text CHECK (result IN ('win', 'loss', 'draw', 'bye'));
+
+UPDATE matches SET result = 'bye' WHERE player_2 IS NULL;
+
+ALTER TABLE tournament_data
+	ADD COLUMN draws integer DEFAULT 0;
+
+CREATE OR REPLACE FUNCTION tournament_tiebreaks(integer)
+	-- Returns a tournament's standings with their tiebreakers, computed in a
+	-- single pass over its reported matches:
+	--   omw       opponents' match-win percentage, each floored at 1/3, with
+	--             a draw counting as half a win
+	--   buchholz  the sum of the opponents' wins
+	--   sos       strength of schedule, the average of the opponents' omw
+	-- rank orders players by points (two for a win, one for a draw) and then
+	-- each tiebreaker in turn, with player_id last so that the ranking is
+	-- total and stable.  Byes are not counted as opponents.
+	RETURNS TABLE (player_id integer, name text, wins integer, matches integer,
+	               omw numeric, buchholz bigint, sos numeric, rank bigint)
+	LANGUAGE sql STABLE AS $$
+		WITH records AS (
+			SELECT tournament_data.player_id, tournament_data.wins,
+			       tournament_data.draws, tournament_data.matches,
+			       CASE WHEN tournament_data.matches > 0
+			            THEN greatest((tournament_data.wins
+			                           + tournament_data.draws / 2.0)
+			                          / tournament_data.matches, 1.0 / 3)
+			            ELSE 1.0 / 3 END AS win_pct
+			FROM tournament_data
+			WHERE tournament_data.tournament_id = $1
+		), pairs AS (
+			SELECT player_1 AS player_id, player_2 AS opponent_id
+			FROM matches
+			WHERE tournament_id = $1 AND result IN ('win', 'loss', 'draw')
+			UNION ALL
+			SELECT player_2, player_1
+			FROM matches
+			WHERE tournament_id = $1 AND result IN ('win', 'loss', 'draw')
+		), opponents AS (
+			SELECT pairs.player_id, avg(records.win_pct) AS omw,
+			       sum(records.wins) AS buchholz
+			FROM pairs JOIN records ON (records.player_id = pairs.opponent_id)
+			GROUP BY pairs.player_id
+		), schedule AS (
+			SELECT pairs.player_id, avg(opponents.omw) AS sos
+			FROM pairs JOIN opponents ON (opponents.player_id = pairs.opponent_id)
+			GROUP BY pairs.player_id
+		), tiebreaks AS (
+			SELECT players.player_id, players.name, records.wins, records.matches,
+			       coalesce(opponents.omw, 0) AS omw,
+			       coalesce(opponents.buchholz, 0) AS buchholz,
+			       coalesce(schedule.sos, 0) AS sos,
+			       2 * records.wins + records.draws AS points
+			FROM records
+			JOIN players ON (players.player_id = records.player_id)
+			LEFT JOIN opponents ON (opponents.player_id = records.player_id)
+			LEFT JOIN schedule ON (schedule.player_id = records.player_id)
+		)
+		SELECT player_id, name, wins, matches, omw, buchholz, sos,
+		       row_number() OVER (ORDER BY points DESC, omw DESC, buchholz DESC,
+		                                   sos DESC, player_id)
+		FROM tiebreaks
+		ORDER BY 8;
+	$$;
+
+COMMIT;
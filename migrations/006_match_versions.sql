@@ -0,0 +1,13 @@
+-- Adds a version to matches, counting the changes to its result, so that
+-- result submissions can be retried safely and stale corrections refused.
+--
+-- Run with: psql tournament -f migrations/006_match_versions.sql
+
+BEGIN;
+
+ALTER TABLE matches
+	ADD COLUMN version integer NOT NULL DEFAULT 0;
+
+UPDATE matches SET version = 1 WHERE result IS NOT NULL;
+
+COMMIT;
@@ -0,0 +1,18 @@
+-- Adds a standings version to tournaments.  tournament.py moves it to a new
+-- value from the standings_versions sequence on every write that can change
+-- a tournament's standings, and caches standings until it changes.
+--
+-- Processes still running an older tournament.py do not move the version,
+-- so stop them before running this script.
+--
+-- Run with: psql tournament -f migrations/007_standings_versions.sql
+
+BEGIN;
+
+CREATE SEQUENCE standings_versions;
+
+ALTER TABLE tournaments
+	ADD COLUMN standings_version bigint NOT NULL
+	DEFAULT nextval('standings_versions');
+
+COMMIT;
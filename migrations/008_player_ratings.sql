@@ -0,0 +1,15 @@
+-- Adds an Elo rating to players.  tournament.py moves the ratings as results
+-- are reported; ratings for the results already in the matches table are
+-- filled in afterwards with tournament.rebuild_ratings():
+--
+--     python -c 'import tournament; tournament.rebuild_ratings()'
+--
+-- Run with: psql tournament -f migrations/008_player_ratings.sql
+
+BEGIN;
+
+ALTER TABLE players
+	ADD COLUMN rating double precision NOT NULL DEFAULT 1500,
+	ADD COLUMN rated_games integer NOT NULL DEFAULT 0;
+
+COMMIT;
@@ -0,0 +1,141 @@
+-- Partitions matches and tournament_data by tournament, one partition per
+-- tournament, so that a finished tournament can be archived (its partitions
+-- detached into the archive schema) or purged (its partitions dropped)
+-- without scanning or rewriting the rest of the history.
+--
+-- The data is copied into the new partitioned tables, so the script takes
+-- as long as copying both tables once and locks them while it runs.  Every
+-- partition takes a few locks in the one transaction; with thousands of
+-- tournaments raise max_locks_per_transaction first.  Requires PostgreSQL
+-- 11 or later.
+--
+-- Run with: psql tournament -f migrations/009_tournament_partitions.sql
+
+BEGIN;
+
+DROP VIEW player_standings;
+
+ALTER TABLE matches RENAME TO matches_unpartitioned;
+ALTER TABLE tournament_data RENAME TO tournament_data_unpartitioned;
+ALTER SEQUENCE matches_match_id_seq OWNED BY NONE;
+
+CREATE TABLE tournament_data
+	(
+	 	tournament_id integer NOT NULL REFERENCES tournaments,
+	 	player_id integer NOT NULL REFERENCES players,
+	 	wins integer DEFAULT 0,
+	 	draws integer DEFAULT 0,
+	 	matches integer DEFAULT 0
+	) PARTITION BY LIST (tournament_id);
+
+CREATE TABLE matches
+	(
+	 	match_id integer NOT NULL DEFAULT nextval('matches_match_id_seq'),
+	 	tournament_id integer NOT NULL REFERENCES tournaments,
+	 	round integer NOT NULL DEFAULT 1,
+	 	player_1 integer NOT NULL REFERENCES players(player_id),
+	 	player_2 integer REFERENCES players(player_id),
+	 	result text CHECK (result IN ('win', 'loss', 'draw', 'bye')),
+	 	version integer NOT NULL DEFAULT 0
+	) PARTITION BY LIST (tournament_id);
+
+ALTER SEQUENCE matches_match_id_seq OWNED BY matches.match_id;
+
+CREATE SCHEMA archive;
+
+CREATE FUNCTION create_tournament_partitions(integer)
+	RETURNS void LANGUAGE plpgsql AS $$
+	BEGIN
+		EXECUTE format('CREATE TABLE public.matches_%s PARTITION OF matches '
+		               'FOR VALUES IN (%s)', $1, $1);
+		EXECUTE format('CREATE TABLE public.tournament_data_%s '
+		               'PARTITION OF tournament_data FOR VALUES IN (%s)',
+		               $1, $1);
+	END;
+	$$;
+
+CREATE FUNCTION tournaments_partitions() RETURNS trigger
+	LANGUAGE plpgsql AS $$
+	BEGIN
+		PERFORM create_tournament_partitions(NEW.tournament_id);
+		RETURN NULL;
+	END;
+	$$;
+
+CREATE TRIGGER tournaments_partitions AFTER INSERT ON tournaments
+	FOR EACH ROW EXECUTE PROCEDURE tournaments_partitions();
+
+CREATE FUNCTION tournament_storage(integer)
+	RETURNS text LANGUAGE sql STABLE AS $$
+		SELECT CASE
+		       WHEN to_regclass('public.matches_' || $1) IS NOT NULL
+		       THEN 'live'
+		       WHEN to_regclass('archive.matches_' || $1) IS NOT NULL
+		       THEN 'archived' END;
+	$$;
+
+CREATE FUNCTION archive_tournament_partitions(integer)
+	RETURNS void LANGUAGE plpgsql AS $$
+	BEGIN
+		EXECUTE format('ALTER TABLE matches DETACH PARTITION public.matches_%s',
+		               $1);
+		EXECUTE format('ALTER TABLE tournament_data '
+		               'DETACH PARTITION public.tournament_data_%s', $1);
+		EXECUTE format('ALTER TABLE public.matches_%s SET SCHEMA archive', $1);
+		EXECUTE format('ALTER TABLE public.tournament_data_%s '
+		               'SET SCHEMA archive', $1);
+	END;
+	$$;
+
+CREATE FUNCTION restore_tournament_partitions(integer)
+	RETURNS void LANGUAGE plpgsql AS $$
+	BEGIN
+		EXECUTE format('ALTER TABLE archive.matches_%s SET SCHEMA public', $1);
+		EXECUTE format('ALTER TABLE archive.tournament_data_%s '
+		               'SET SCHEMA public', $1);
+		EXECUTE format('ALTER TABLE matches ATTACH PARTITION public.matches_%s '
+		               'FOR VALUES IN (%s)', $1, $1);
+		EXECUTE format('ALTER TABLE tournament_data '
+		               'ATTACH PARTITION public.tournament_data_%s '
+		               'FOR VALUES IN (%s)', $1, $1);
+	END;
+	$$;
+
+CREATE FUNCTION drop_tournament_partitions(integer)
+	RETURNS void LANGUAGE plpgsql AS $$
+	BEGIN
+		EXECUTE format('DROP TABLE IF EXISTS public.matches_%s, '
+		               'public.tournament_data_%s, archive.matches_%s, '
+		               'archive.tournament_data_%s', $1, $1, $1, $1);
+	END;
+	$$;
+
+SELECT create_tournament_partitions(tournament_id) FROM tournaments;
+
+INSERT INTO tournament_data (tournament_id, player_id, wins, draws, matches)
+	SELECT tournament_id, player_id, wins, draws, matches
+	FROM tournament_data_unpartitioned;
+
+INSERT INTO matches
+	(match_id, tournament_id, round, player_1, player_2, result, version)
+	SELECT match_id, tournament_id, round, player_1, player_2, result, version
+	FROM matches_unpartitioned;
+
+DROP TABLE matches_unpartitioned, tournament_data_unpartitioned;
+
+ALTER TABLE tournament_data ADD PRIMARY KEY (tournament_id, player_id);
+ALTER TABLE matches ADD PRIMARY KEY (tournament_id, match_id);
+
+CREATE INDEX tournament_data_player_idx ON tournament_data (player_id);
+CREATE INDEX matches_match_idx ON matches (match_id);
+CREATE INDEX matches_tournament_round_idx ON matches (tournament_id, round);
+CREATE INDEX matches_player_1_idx ON matches (player_1);
+CREATE INDEX matches_player_2_idx ON matches (player_2);
+
+CREATE VIEW player_standings AS
+	SELECT players.player_id, players.name, tournament_data.wins, tournament_data.matches,
+	       tournament_data.tournament_id
+	FROM players JOIN tournament_data
+	ON (players.player_id = tournament_data.player_id);
+
+COMMIT;
@@ -0,0 +1,39 @@
+-- Creates each new tournament's partitions as tables of their own and then
+-- attaches them, instead of with CREATE TABLE ... PARTITION OF, which locks
+-- matches and tournament_data against every query.  Attaching only blocks
+-- other schema changes from PostgreSQL 12 on; on 11 it takes the same lock
+-- as before, so the script refuses to run there.  The existing partitions
+-- are left as they are.
+--
+-- Run with: psql tournament -f migrations/010_attach_tournament_partitions.sql
+
+BEGIN;
+
+DO $$
+	BEGIN
+		IF current_setting('server_version_num')::integer < 120000 THEN
+			RAISE EXCEPTION 'PostgreSQL 12 or later is needed, not %',
+			                current_setting('server_version');
+		END IF;
+	END;
+	$$;
+
+CREATE OR REPLACE FUNCTION create_tournament_partitions(integer)
+	RETURNS void LANGUAGE plpgsql AS $$
+	BEGIN
+		EXECUTE format('CREATE TABLE public.matches_%s (LIKE matches '
+		               'INCLUDING DEFAULTS INCLUDING CONSTRAINTS, '
+		               'CHECK (tournament_id = %s))', $1, $1);
+		EXECUTE format('CREATE TABLE public.tournament_data_%s '
+		               '(LIKE tournament_data INCLUDING DEFAULTS '
+		               'INCLUDING CONSTRAINTS, CHECK (tournament_id = %s))',
+		               $1, $1);
+		EXECUTE format('ALTER TABLE matches ATTACH PARTITION public.matches_%s '
+		               'FOR VALUES IN (%s)', $1, $1);
+		EXECUTE format('ALTER TABLE tournament_data '
+		               'ATTACH PARTITION public.tournament_data_%s '
+		               'FOR VALUES IN (%s)', $1, $1);
+	END;
+	$$;
+
+COMMIT;
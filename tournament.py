@@ -3,26 +3,69 @@
 # tournament.py -- implementation of a Swiss-system tournament
 #
 
+from contextlib import contextmanager
+import collections
+import csv
+import functools
+import itertools
+import json
+import logging
+import os
+import re
+import select
+import threading
+import time
+import weakref
+
 import psycopg2
+import psycopg2.extensions
+import psycopg2.extras
+import psycopg2.pool
 import sys
 
+import tournament_pairing
+import tournament_ratings
+
+
+DEFAULT_DSN = "dbname=tournament"
+
+# How many rows the streaming and paging functions fetch at a time.
+DEFAULT_BATCH_SIZE = 1000
+
+# The column names written by the exports.
+STANDINGS_COLUMNS = ("player_id", "name", "wins", "matches")
+TIEBREAK_COLUMNS = ("omw", "buchholz", "sos")
+HISTORY_COLUMNS = ("match_id", "round", "player_1", "player_2", "result",
+                   "version")
+
+# How many tournaments' standings a StandingsCache keeps, and the channel
+# on which standings changes are announced with NOTIFY.
+DEFAULT_CACHE_SIZE = 256
+STANDINGS_CHANNEL = "tournament_standings"
+LISTEN_POLL_SECONDS = 5
+
+
+def _connection_failed(error):
+    """Reports a failed connection attempt the same way for pooled and
+    ad-hoc connections and exits the program.
+    """
+    if isinstance(error, psycopg2.InterfaceError):
+        print("The program could not connect to the database because of "
+              "a connection.")
+    else:
+        print("The program could not connect to the database!")
+    sys.exit(1)
 
 def connect():
     """Connect to the PostgreSQL database.  Returns a database connection.
     and a cursor object and raises eceptions if the connection cannot be made.
+
+    This opens a dedicated, unpooled connection and is kept for ad-hoc
+    scripts.  The tournament functions below go through the shared
+    TournamentDB pool instead.  With another storage backend selected (see
+    get_backend()) the connection comes from that backend.
     """
-    try:
-        conn = psycopg2.connect("dbname=tournament")
-    except psycopg2.DatabaseError:
-        print "The program could not connect to the database!"
-        sys.exit(1)
-    except psycopg2.InterfaceError:
-        print ("The program could not connect to the database because of "\
-               "a connection.")
-        sys.exit(1)
-    else:
-        cursor = conn.cursor()
-        return conn, cursor
+    return get_backend().connect()
 
 def commit_and_close(conn, cursor):
     """Commits all changes from the session and closes connections
@@ -35,6 +78,2244 @@ def commit_and_close(conn, cursor):
     cursor.close()
     conn.close()
 
+
+class ResultConflict(ValueError):
+    """Raised when a result is submitted for a match that already has a
+    different result, or whose version has moved on since the caller read
+    it.
+    """
+
+
+class StandingsChanged(ValueError):
+    """Raised when a page of the standings is asked for after the
+    standings changed since the previous page was read.
+    """
+
+
+class StandingsCache(object):
+    """A bounded, thread safe cache of standings, kept per TournamentDB.
+
+    Entries are keyed by (tournament_id, tiebreaks) and labelled with the
+    tournament's standings_version, which every write that can change the
+    standings moves to a new value from the standings_versions sequence.
+    Sequence values are never handed out twice, even by a transaction that
+    rolls back, so a version always identifies one state of the standings.
+    A read checks the version with one primary key lookup and returns the
+    cached rows while it is unchanged, so the standings query only runs
+    again after a write, from whichever process.
+
+    listen() goes further: a background connection LISTENs for the
+    notifications sent with each version bump and evicts the entries of
+    the tournaments that changed, so reads skip the version lookup and are
+    served from memory.  A write in another process then shows up as soon
+    as its notification arrives rather than on the very next read.  Rows
+    read before a notification but put() after it would be stale, so put()
+    takes the generation() read before the query and drops them if the
+    tournament was invalidated in between.
+
+    Args:
+        max_entries: The most standings kept; the least recently used are
+        evicted first.
+    """
+
+    def __init__(self, max_entries=DEFAULT_CACHE_SIZE):
+        self.max_entries = max_entries
+        self.listening = False
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+        self._invalidations = {}
+        self._clears = 0
+        self._lock = threading.Lock()
+        self._stop = None
+
+    def get(self, key, version=None):
+        """Returns the cached rows for key, or None if there are none or
+        they were cached at another version than the one given.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or (version is not None and entry[0] != version):
+                self.misses += 1
+                return None
+            del self._entries[key]
+            self._entries[key] = entry
+            self.hits += 1
+            return entry[1]
+
+    def generation(self, tournament_id):
+        """Returns a token that changes whenever the entries of
+        tournament_id are invalidated or the cache is cleared.  Read it
+        before reading the standings and pass it to put().
+        """
+        with self._lock:
+            return self._clears, self._invalidations.get(tournament_id, 0)
+
+    def put(self, key, version, rows, generation=None):
+        """Caches rows for key at version.  If generation, the token from
+        generation() read before the rows were, shows that key's
+        tournament was invalidated since, the rows may predate that change
+        and are not cached.
+        """
+        with self._lock:
+            if generation is not None and generation != (
+                    self._clears, self._invalidations.get(key[0], 0)):
+                return
+            self._entries.pop(key, None)
+            self._entries[key] = (version, rows)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, tournament_id):
+        """Drops the cached standings of one tournament."""
+        with self._lock:
+            self._invalidations[tournament_id] = (
+                self._invalidations.get(tournament_id, 0) + 1)
+            for tiebreaks in (False, True):
+                self._entries.pop((tournament_id, tiebreaks), None)
+
+    def clear(self):
+        with self._lock:
+            self._clears += 1
+            self._entries.clear()
+
+    def listen(self, dsn):
+        """Starts a daemon thread that evicts entries as the notifications
+        of standings changes arrive.  While its connection is down, reads
+        fall back to checking the version.
+        """
+        if self._stop is not None:
+            return
+        self._stop = threading.Event()
+        listener = threading.Thread(target=self._listen,
+                                    args=(dsn, self._stop),
+                                    name="tournament-standings-listener")
+        listener.daemon = True
+        listener.start()
+
+    def stop(self):
+        """Stops the thread started by listen()."""
+        if self._stop is not None:
+            self._stop.set()
+            self._stop = None
+        self.listening = False
+
+    def _listen(self, dsn, stop):
+        while not stop.is_set():
+            conn = None
+            try:
+                conn = psycopg2.connect(dsn)
+                conn.autocommit = True
+                conn.cursor().execute("LISTEN " + STANDINGS_CHANNEL)
+                # Changes made before LISTEN were never announced.
+                self.clear()
+                self.listening = True
+                while not stop.is_set():
+                    if select.select([conn], [], [], LISTEN_POLL_SECONDS)[0]:
+                        conn.poll()
+                        while conn.notifies:
+                            notify = conn.notifies.pop(0)
+                            self.invalidate(int(notify.payload))
+            except psycopg2.Error as error:
+                _logger.warning("Standings listener disconnected: %s", error)
+            finally:
+                self.listening = False
+                if conn is not None and not conn.closed:
+                    conn.close()
+            stop.wait(LISTEN_POLL_SECONDS)
+
+
+class TournamentDB(object):
+    """A pool of connections to the tournament database.
+
+    Connections are opened lazily on first use and handed out by session(),
+    which wraps each unit of work in a single transaction and returns the
+    connection to the pool afterwards.  The pool is thread safe, so one
+    instance can be shared by every request in a process; when all maxconn
+    connections are in use, session() waits for one to be returned.
+
+    Args:
+        dsn: The libpq connection string for the tournament database.
+        minconn: The number of connections the pool keeps open.
+        maxconn: The most connections the pool will ever open at once.
+        cursor_factory (optional): The psycopg2 cursor class that
+        session() hands out, for example to count the statements run.
+        cache_size (optional): The most tournaments whose standings are
+        cached in standings_cache, or 0 to turn the cache off.
+        prepare (optional): If false, statements are never prepared on the
+        server (see StatementRegistry), for connections that go through a
+        pooler in transaction mode.
+    """
+
+    def __init__(self, dsn=DEFAULT_DSN, minconn=1, maxconn=10,
+                 cursor_factory=None, cache_size=DEFAULT_CACHE_SIZE,
+                 prepare=True):
+        self.dsn = dsn
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.cursor_factory = cursor_factory
+        self.standings_cache = (StandingsCache(cache_size) if cache_size
+                                else None)
+        self.statements = StatementRegistry() if prepare else None
+        self._pool = None
+        self._lock = threading.Lock()
+        self._available = threading.BoundedSemaphore(maxconn)
+
+    def _get_pool(self):
+        if self._pool is None:
+            with self._lock:
+                if self._pool is None:
+                    try:
+                        self._pool = psycopg2.pool.ThreadedConnectionPool(
+                            self.minconn, self.maxconn, self.dsn,
+                            cursor_factory=self.cursor_factory)
+                    except (psycopg2.DatabaseError,
+                            psycopg2.InterfaceError) as error:
+                        _connection_failed(error)
+        return self._pool
+
+    @contextmanager
+    def session(self, cursor=None):
+        """Yields a cursor on a pooled connection inside one transaction.
+
+        The transaction is committed when the block exits normally and
+        rolled back if it raises.  Connections that were broken during the
+        block are discarded rather than returned to the pool.
+
+        Args:
+            cursor (optional): A cursor from a session that is already
+            open.  If given, it is yielded as-is and the enclosing session
+            stays in charge of committing.
+        """
+        if cursor is not None:
+            yield cursor
+            return
+        pool = self._get_pool()
+        instrumented = _instrumentation.enabled
+        if instrumented:
+            start = _clock()
+        self._available.acquire()
+        try:
+            conn = pool.getconn()
+            try:
+                if instrumented:
+                    _instrumentation.connected(_clock() - start)
+                    cursor = conn.cursor(cursor_factory=InstrumentedCursor)
+                else:
+                    cursor = conn.cursor()
+                try:
+                    yield cursor
+                    self._end(conn.commit, "COMMIT", instrumented)
+                except Exception:
+                    if not conn.closed:
+                        self._end(conn.rollback, "ROLLBACK", instrumented)
+                    raise
+                finally:
+                    cursor.close()
+            finally:
+                pool.putconn(conn, close=bool(conn.closed))
+        finally:
+            self._available.release()
+
+    def execute(self, cursor, name, parameters=None):
+        """Runs STATEMENTS[name] with parameters on a cursor from
+        session(), as a prepared statement if it is one of the
+        PREPARED_STATEMENTS and preparing is on.
+        """
+        if self.statements is None:
+            cursor.execute(STATEMENTS[name], parameters)
+        else:
+            self.statements.execute(cursor, name, parameters)
+
+    def _end(self, end, statement, instrumented):
+        """Commits or rolls back, timing the round trip if instrumented."""
+        if not instrumented:
+            end()
+            return
+        start = _clock()
+        try:
+            end()
+        finally:
+            _instrumentation.statement(statement, _clock() - start, 0,
+                                       round_trip_only=True)
+
+    def listen(self):
+        """Keeps standings_cache up to date from the database's change
+        notifications, so cached standings are read without a query; see
+        StandingsCache.listen().
+        """
+        if self.standings_cache is not None:
+            self.standings_cache.listen(self.dsn)
+
+    def close(self):
+        """Closes every connection held by the pool and stops listening
+        for standings changes.
+        """
+        if self.standings_cache is not None:
+            self.standings_cache.stop()
+        with self._lock:
+            if self._pool is not None:
+                self._pool.closeall()
+                self._pool = None
+
+
+_db = None
+_db_lock = threading.Lock()
+
+def get_db():
+    """Returns the TournamentDB shared by the module-level functions,
+    creating it against DEFAULT_DSN on first use.
+    """
+    global _db
+    if _db is None:
+        with _db_lock:
+            if _db is None:
+                _db = TournamentDB()
+    return _db
+
+def configure(dsn=DEFAULT_DSN, minconn=1, maxconn=10, cursor_factory=None,
+              cache_size=DEFAULT_CACHE_SIZE, prepare=True):
+    """Replaces the shared TournamentDB with one using the given settings.
+
+    Any connections held by the previous pool are closed.
+
+    Args:
+        dsn: The libpq connection string for the tournament database.
+        minconn: The number of connections the pool keeps open.
+        maxconn: The most connections the pool will ever open at once.
+        cursor_factory (optional): The psycopg2 cursor class to use.
+        cache_size (optional): The most tournaments whose standings are
+        cached, or 0 for no cache.
+        prepare (optional): If false, statements are never prepared on the
+        server.
+    """
+    global _db
+    with _db_lock:
+        if _db is not None:
+            _db.close()
+        _db = TournamentDB(dsn, minconn, maxconn, cursor_factory, cache_size,
+                           prepare)
+    return _db
+
+
+# Measures elapsed time for the instrumentation; perf_counter where the
+# Python version has it.
+_clock = getattr(time, "perf_counter", time.time)
+
+_logger = logging.getLogger("tournament")
+
+
+class _Instrumentation(object):
+    """Collects the statements run on behalf of each public function.
+
+    While enabled, sessions hand out InstrumentedCursor cursors, which
+    report every statement here, and the public functions are timed.  A
+    record of each call is then added to the totals returned by
+    snapshot() and passed to the hooks.  While disabled, the only cost is
+    checking the enabled flag once per call and per session.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.hooks = []
+        self.slow_query_seconds = None
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._operations = {}
+        self._statements = {}
+        self._names = None
+
+    def enable(self, hook=None, slow_query_seconds=None):
+        with self._lock:
+            if hook is not None:
+                self.hooks.append(hook)
+            self.slow_query_seconds = slow_query_seconds
+            self.enabled = True
+
+    def disable(self):
+        with self._lock:
+            self.enabled = False
+            self.hooks = []
+            self.slow_query_seconds = None
+
+    def snapshot(self, reset=False):
+        with self._lock:
+            snapshot = {
+                "operations": dict((name, dict(totals)) for name, totals
+                                   in self._operations.items()),
+                "statements": dict((name, dict(totals)) for name, totals
+                                   in self._statements.items()),
+            }
+            if reset:
+                self._operations = {}
+                self._statements = {}
+        return snapshot
+
+    def call(self, operation, function, args, kwargs):
+        """Runs a public function, recording the statements it issues."""
+        record = {"operation": operation, "statements": 0, "round_trips": 0,
+                  "rows": 0, "db_seconds": 0.0, "connect_seconds": 0.0,
+                  "queries": [], "error": None}
+        self._local.record = record
+        start = _clock()
+        try:
+            return function(*args, **kwargs)
+        except Exception as error:
+            record["error"] = type(error).__name__
+            raise
+        finally:
+            record["seconds"] = _clock() - start
+            self._local.record = None
+            self._finish(record)
+
+    def _finish(self, record):
+        with self._lock:
+            totals = self._operations.setdefault(record["operation"], {
+                "calls": 0, "errors": 0, "seconds": 0.0, "max_seconds": 0.0,
+                "statements": 0, "round_trips": 0, "rows": 0,
+                "db_seconds": 0.0, "connect_seconds": 0.0})
+            totals["calls"] += 1
+            totals["errors"] += record["error"] is not None
+            totals["max_seconds"] = max(totals["max_seconds"],
+                                        record["seconds"])
+            for key in ("seconds", "statements", "round_trips", "rows",
+                        "db_seconds", "connect_seconds"):
+                totals[key] += record[key]
+            hooks = list(self.hooks)
+        for hook in hooks:
+            hook(record)
+
+    def in_call(self):
+        return getattr(self._local, "record", None) is not None
+
+    def connected(self, seconds):
+        """Records the time a session waited for a pooled connection."""
+        record = getattr(self._local, "record", None)
+        if record is not None:
+            record["connect_seconds"] += seconds
+
+    def statement(self, query, seconds, rows, round_trip_only=False):
+        """Records one round trip to the database.  COMMIT and ROLLBACK
+        are passed with round_trip_only and do not count as statements.
+        """
+        name = self._name(query)
+        record = getattr(self._local, "record", None)
+        if record is not None:
+            record["round_trips"] += 1
+            record["db_seconds"] += seconds
+            if not round_trip_only:
+                record["statements"] += 1
+                record["rows"] += rows
+            record["queries"].append((name, seconds, rows))
+        with self._lock:
+            totals = self._statements.setdefault(name, {
+                "calls": 0, "seconds": 0.0, "max_seconds": 0.0, "rows": 0})
+            totals["calls"] += 1
+            totals["seconds"] += seconds
+            totals["max_seconds"] = max(totals["max_seconds"], seconds)
+            totals["rows"] += rows
+            slow_query_seconds = self.slow_query_seconds
+        if slow_query_seconds is not None and seconds >= slow_query_seconds:
+            _logger.warning("Slow query in %s: %s took %.3fs for %d rows",
+                            record["operation"] if record else "-", name,
+                            seconds, rows)
+
+    def _name(self, query):
+        """Returns the STATEMENTS name of query, prepared or not, or its
+        first words with the literal values replaced by ?, so that the
+        totals are grouped by statement rather than by parameters.
+        """
+        if self._names is None:
+            names = dict((sql, name) for name, sql in STATEMENTS.items())
+            for name, (prepare, execute) in PREPARED_SQL.items():
+                names[prepare] = names["DEALLOCATE ALL; " + prepare] = name
+                names[execute] = name
+            self._names = names
+        if isinstance(query, bytes) and not isinstance(query, str):
+            query = query.decode("utf-8", "replace")
+        name = self._names.get(query)
+        if name is None:
+            name = _LITERALS.sub("?", " ".join(query[:400].split()))[:80]
+        return name
+
+
+# String and number literals in SQL, as psycopg2 inlines them.
+_LITERALS = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+
+_instrumentation = _Instrumentation()
+
+
+class InstrumentedCursor(psycopg2.extensions.cursor):
+    """A psycopg2 cursor that reports the latency and row count of every
+    statement it runs to the instrumentation.  Sessions and connect() use
+    it while instrumentation is enabled.
+    """
+
+    def execute(self, query, vars=None):
+        start = _clock()
+        try:
+            return super(InstrumentedCursor, self).execute(query, vars)
+        finally:
+            _instrumentation.statement(query, _clock() - start,
+                                       max(self.rowcount, 0))
+
+def enable_instrumentation(hook=None, slow_query_seconds=None):
+    """Starts counting the statements, round trips, rows and time spent in
+    the database by each public function.
+
+    Args:
+        hook (optional): A callable given a dict for every call of a public
+        function once it returns.  The dict holds its operation name,
+        seconds, statements, round_trips, rows, db_seconds (time waiting on
+        the database), connect_seconds (time waiting for a connection),
+        error (the exception type name, or None) and queries, a list of
+        (statement, seconds, rows) tuples in the order they ran.
+        slow_query_seconds (optional): If given, statements that take at
+        least this long are logged as warnings on the "tournament" logger.
+    """
+    _instrumentation.enable(hook, slow_query_seconds)
+
+def disable_instrumentation():
+    """Stops the instrumentation and removes its hooks.  The totals are
+    kept until instrumentation_snapshot() is called with reset.
+    """
+    _instrumentation.disable()
+
+def instrumentation_snapshot(reset=False):
+    """Returns the totals collected by the instrumentation as a dict with
+    two dicts: "operations", by public function, of calls, errors, seconds,
+    max_seconds, statements, round_trips, rows, db_seconds and
+    connect_seconds; and "statements", by STATEMENTS name (or the start of
+    the SQL), of calls, seconds, max_seconds and rows.
+
+    Args:
+        reset (optional): If true, the totals start again from zero.
+    """
+    return _instrumentation.snapshot(reset)
+
+def _instrumented(function):
+    """Makes a public function report to the instrumentation while it is
+    enabled.  Calls made from inside another public function count
+    towards the outer call.
+    """
+    operation = function.__name__
+    @functools.wraps(function)
+    def instrumented(*args, **kwargs):
+        if not _instrumentation.enabled or _instrumentation.in_call():
+            return function(*args, **kwargs)
+        return _instrumentation.call(operation, function, args, kwargs)
+    return instrumented
+
+
+# The SQL behind the public tournament operations, by name.  Both this
+# module and tournament_async.py run these exact statements, so the two
+# APIs behave the same.  Parameters use the %s and %(name)s placeholders
+# understood by psycopg2 and aiopg.
+STATEMENTS = {
+    "current_tournament":
+        "SELECT * FROM current_tournament",
+    "count_players":
+        "SELECT count(player_id) FROM tournament_data "
+        "WHERE tournament_id = %s",
+    "count_active_players":
+        "SELECT count(player_id) FROM players WHERE active = 'yes'",
+    "register_player":
+        "WITH player AS ("
+        "INSERT INTO players (name, email) "
+        "VALUES (%(name)s::text, %(email)s::text) "
+        "ON CONFLICT (email) DO UPDATE SET active = 'yes' "
+        "RETURNING player_id), "
+        "entry AS ("
+        "INSERT INTO tournament_data (tournament_id, player_id) "
+        "SELECT %(tournament)s::integer, player_id FROM player "
+        "ON CONFLICT DO NOTHING RETURNING player_id), "
+        "bumped AS ("
+        "UPDATE tournaments "
+        "SET standings_version = nextval('standings_versions') "
+        "WHERE tournament_id = %(tournament)s::integer "
+        "AND (SELECT count(*) FROM entry) > 0 "
+        "RETURNING tournament_id) "
+        "SELECT player.player_id, (SELECT count(pg_notify(%(channel)s::text, "
+        "tournament_id::text)) FROM bumped) FROM player",
+    "deactivate_player":
+        "UPDATE players SET active = 'no' WHERE player_id = %s",
+    "deactivate_all_players":
+        "UPDATE players SET active = 'no'",
+    "add_player":
+        "INSERT INTO tournament_data (tournament_id, player_id) "
+        "VALUES (%s, %s) ON CONFLICT DO NOTHING",
+    "delete_entry":
+        "DELETE FROM tournament_data "
+        "WHERE tournament_id = %s AND player_id = %s",
+    "delete_entries":
+        "DELETE FROM tournament_data WHERE tournament_id = %s",
+    "delete_player_entries":
+        "DELETE FROM tournament_data WHERE player_id = %s",
+    "delete_all_entries":
+        "DELETE FROM tournament_data",
+    "delete_matches":
+        "DELETE FROM matches WHERE tournament_id = %s",
+    "reset_records":
+        "UPDATE tournament_data "
+        "SET matches = DEFAULT, wins = DEFAULT, draws = DEFAULT "
+        "WHERE tournament_id = %s",
+    "standings":
+        "SELECT player_id, name, wins, matches "
+        "FROM tournament_tiebreaks(%s) ORDER BY rank",
+    "standings_with_tiebreaks":
+        "SELECT player_id, name, wins, matches, "
+        "omw::float, buchholz::integer, sos::float "
+        "FROM tournament_tiebreaks(%s) ORDER BY rank",
+    "standings_page":
+        "SELECT standing.player_id, standing.name, standing.wins, "
+        "standing.matches, standing.omw::float, standing.buchholz::integer, "
+        "standing.sos::float, standing.rank, tournaments.standings_version "
+        "FROM tournaments, tournament_tiebreaks(tournaments.tournament_id) "
+        "AS standing "
+        "WHERE tournaments.tournament_id = %s AND standing.rank > %s "
+        "ORDER BY standing.rank LIMIT %s",
+    "standings_by_rating":
+        "SELECT standing.player_id, standing.name, standing.wins, "
+        "standing.matches, players.rating "
+        "FROM tournament_tiebreaks(%s) AS standing "
+        "JOIN players ON players.player_id = standing.player_id "
+        "JOIN tournament_data ON tournament_data.tournament_id = %s "
+        "AND tournament_data.player_id = standing.player_id "
+        "ORDER BY 2 * tournament_data.wins + tournament_data.draws DESC, "
+        "players.rating DESC, standing.rank",
+    "standings_with_tiebreaks_by_rating":
+        "SELECT standing.player_id, standing.name, standing.wins, "
+        "standing.matches, standing.omw::float, "
+        "standing.buchholz::integer, standing.sos::float, players.rating "
+        "FROM tournament_tiebreaks(%s) AS standing "
+        "JOIN players ON players.player_id = standing.player_id "
+        "JOIN tournament_data ON tournament_data.tournament_id = %s "
+        "AND tournament_data.player_id = standing.player_id "
+        "ORDER BY 2 * tournament_data.wins + tournament_data.draws DESC, "
+        "players.rating DESC, standing.rank",
+    # Each step after recorded only runs once the match was recorded.  The
+    # later steps also read the step before, which makes PostgreSQL take
+    # the locks in the order the other write paths do (matches, records,
+    # ratings, tournaments), but not its row count: a player removed from
+    # the tournament after the pairing has no record to update, yet the
+    # match is still rated and the standings version still moves, as in
+    # Tournament._record_results().
+    "report_match":
+        "WITH open_match AS ("
+        "SELECT match_id, player_1, player_2 FROM matches "
+        "WHERE tournament_id = %(tournament)s::integer AND result IS NULL "
+        "AND ((player_1 = %(winner)s::integer "
+        "AND player_2 = %(loser)s::integer) "
+        "OR (player_1 = %(loser)s::integer "
+        "AND player_2 = %(winner)s::integer)) "
+        "ORDER BY round DESC LIMIT 1 FOR UPDATE), "
+        "outcome AS ("
+        "SELECT match_id, player_1, player_2, "
+        "CASE WHEN %(draw)s::boolean THEN 'draw' "
+        "WHEN player_1 = %(winner)s::integer THEN 'win' "
+        "ELSE 'loss' END AS result FROM open_match), "
+        "recorded AS ("
+        "UPDATE matches SET result = outcome.result, "
+        "version = matches.version + 1 FROM outcome "
+        "WHERE matches.tournament_id = %(tournament)s::integer "
+        "AND matches.match_id = outcome.match_id "
+        "RETURNING matches.match_id), "
+        "deltas AS ("
+        "SELECT player_1 AS player_id, (result = 'win')::integer AS wins, "
+        "(result = 'draw')::integer AS draws FROM outcome "
+        "UNION ALL "
+        "SELECT player_2, (result = 'loss')::integer, "
+        "(result = 'draw')::integer FROM outcome), "
+        "locked_records AS ("
+        "SELECT player_id FROM tournament_data "
+        "WHERE tournament_id = %(tournament)s::integer "
+        "AND player_id IN (SELECT player_id FROM deltas) "
+        "AND (SELECT count(*) FROM recorded) > 0 "
+        "ORDER BY player_id FOR UPDATE OF tournament_data), "
+        "records AS ("
+        "UPDATE tournament_data "
+        "SET wins = tournament_data.wins + deltas.wins, "
+        "draws = tournament_data.draws + deltas.draws, "
+        "matches = tournament_data.matches + 1 "
+        "FROM locked_records JOIN deltas USING (player_id) "
+        "WHERE tournament_data.tournament_id = %(tournament)s::integer "
+        "AND tournament_data.player_id = locked_records.player_id "
+        "RETURNING tournament_data.player_id), "
+        "ratings AS ("
+        "SELECT player_id, rating FROM players "
+        "WHERE player_id IN (SELECT player_id FROM deltas) "
+        "AND (SELECT count(*) FROM recorded) > 0 "
+        "AND (SELECT count(*) FROM records) IS NOT NULL "
+        "ORDER BY player_id FOR NO KEY UPDATE OF players), "
+        "change AS ("
+        "SELECT outcome.player_1, outcome.player_2, %(k_factor)s::float8 * ("
+        "CASE outcome.result WHEN 'win' THEN 1.0::float8 "
+        "WHEN 'loss' THEN 0.0::float8 ELSE 0.5::float8 END "
+        "- 1.0::float8 / (1.0::float8 + 10.0::float8 ^ "
+        "((second.rating - first.rating) / %(scale)s::float8))) AS rating "
+        "FROM outcome "
+        "JOIN ratings AS first ON first.player_id = outcome.player_1 "
+        "JOIN ratings AS second ON second.player_id = outcome.player_2), "
+        "rated AS ("
+        "UPDATE players SET rating = players.rating + "
+        "CASE WHEN players.player_id = change.player_1 "
+        "THEN change.rating ELSE -change.rating END, "
+        "rated_games = players.rated_games + 1 FROM change "
+        "WHERE players.player_id IN (change.player_1, change.player_2) "
+        "RETURNING players.player_id), "
+        "bumped AS ("
+        "UPDATE tournaments "
+        "SET standings_version = nextval('standings_versions') "
+        "WHERE tournament_id = %(tournament)s::integer "
+        "AND (SELECT count(*) FROM recorded) > 0 "
+        "AND (SELECT count(*) FROM rated) IS NOT NULL "
+        "RETURNING tournament_id) "
+        "SELECT recorded.match_id, (SELECT count(pg_notify(%(channel)s::text, "
+        "tournament_id::text)) FROM bumped) FROM recorded",
+    "round_match":
+        "SELECT match_id, player_1, result FROM matches "
+        "WHERE tournament_id = %s "
+        "AND round = (SELECT max(round) FROM matches WHERE tournament_id = %s) "
+        "AND ((player_1 = %s AND player_2 = %s) "
+        "OR (player_1 = %s AND player_2 = %s)) "
+        "ORDER BY match_id DESC LIMIT 1 FOR UPDATE",
+    "lock_pair":
+        "SELECT pg_advisory_xact_lock(%s, least(%s::integer, %s::integer))",
+    "insert_unpaired_match":
+        "INSERT INTO matches (tournament_id, round, player_1, player_2) "
+        "SELECT %s, coalesce(max(round), 1), %s, %s "
+        "FROM matches WHERE tournament_id = %s "
+        "RETURNING match_id, player_1",
+    "lock_matches":
+        "SELECT match_id, player_1, player_2, result, version "
+        "FROM matches WHERE tournament_id = %s "
+        "AND match_id = ANY(%s::integer[]) "
+        "ORDER BY match_id FOR UPDATE",
+    "update_results":
+        "UPDATE matches SET result = changed.result, version = version + 1 "
+        "FROM unnest(%s::integer[], %s::text[]) "
+        "AS changed (match_id, result) "
+        "WHERE matches.tournament_id = %s "
+        "AND matches.match_id = changed.match_id",
+    "lock_records":
+        "SELECT 1 FROM tournament_data "
+        "WHERE tournament_id = %s AND player_id = ANY(%s::integer[]) "
+        "ORDER BY player_id FOR UPDATE",
+    "update_records":
+        "UPDATE tournament_data "
+        "SET wins = tournament_data.wins + delta.wins, "
+        "draws = tournament_data.draws + delta.draws, "
+        "matches = tournament_data.matches + delta.matches "
+        "FROM unnest(%s::integer[], %s::integer[], "
+        "%s::integer[], %s::integer[]) "
+        "AS delta (player_id, wins, draws, matches) "
+        "WHERE tournament_data.tournament_id = %s "
+        "AND tournament_data.player_id = delta.player_id",
+    "pairing_history":
+        "SELECT player_1, player_2 FROM matches WHERE tournament_id = %s",
+    "record_pairings":
+        "WITH paired AS ("
+        "INSERT INTO matches "
+        "(tournament_id, round, player_1, player_2, result) "
+        "SELECT %(tournament)s::integer, next.round, "
+        "pairing.player_1, pairing.player_2, "
+        "CASE WHEN pairing.player_2 IS NULL THEN 'bye' END "
+        "FROM unnest(%(players_1)s::integer[], %(players_2)s::integer[]) "
+        "AS pairing (player_1, player_2) "
+        "CROSS JOIN (SELECT coalesce(max(round), 0) + 1 AS round "
+        "FROM matches WHERE tournament_id = %(tournament)s::integer) "
+        "AS next RETURNING match_id), "
+        "bye AS ("
+        "UPDATE tournament_data SET wins = wins + 1, matches = matches + 1 "
+        "WHERE tournament_id = %(tournament)s::integer "
+        "AND player_id = %(bye)s::integer "
+        "AND (SELECT count(*) FROM paired) > 0 "
+        "RETURNING player_id), "
+        "bumped AS ("
+        "UPDATE tournaments "
+        "SET standings_version = nextval('standings_versions') "
+        "WHERE tournament_id = %(tournament)s::integer "
+        "AND (SELECT count(*) FROM bye) > 0 "
+        "RETURNING tournament_id) "
+        "SELECT (SELECT count(*) FROM paired), "
+        "(SELECT count(pg_notify(%(channel)s::text, tournament_id::text)) "
+        "FROM bumped)",
+    "next_rounds":
+        "SELECT tournaments.tournament_id, coalesce(max(round), 0) + 1 "
+        "FROM tournaments LEFT JOIN matches "
+        "ON matches.tournament_id = tournaments.tournament_id "
+        "WHERE tournaments.tournament_id = ANY(%s) "
+        "GROUP BY tournaments.tournament_id",
+    "pairing_standings":
+        "SELECT event.tournament_id, standing.player_id, standing.name, "
+        "standing.wins, standing.matches "
+        "FROM unnest(%s::integer[]) AS event (tournament_id) "
+        "CROSS JOIN LATERAL tournament_tiebreaks(event.tournament_id) "
+        "AS standing ORDER BY event.tournament_id, standing.rank",
+    "pairing_standings_by_rating":
+        "SELECT event.tournament_id, standing.player_id, standing.name, "
+        "standing.wins, standing.matches, players.rating "
+        "FROM unnest(%s::integer[]) AS event (tournament_id) "
+        "CROSS JOIN LATERAL tournament_tiebreaks(event.tournament_id) "
+        "AS standing "
+        "JOIN players ON players.player_id = standing.player_id "
+        "JOIN tournament_data "
+        "ON tournament_data.tournament_id = event.tournament_id "
+        "AND tournament_data.player_id = standing.player_id "
+        "ORDER BY event.tournament_id, "
+        "2 * tournament_data.wins + tournament_data.draws DESC, "
+        "players.rating DESC, standing.rank",
+    "pairing_histories":
+        "SELECT tournament_id, player_1, player_2 FROM matches "
+        "WHERE tournament_id = ANY(%s)",
+    "insert_round_pairings":
+        "INSERT INTO matches "
+        "(tournament_id, round, player_1, player_2, result) "
+        "SELECT pairing.tournament_id, pairing.round, "
+        "pairing.player_1, pairing.player_2, "
+        "CASE WHEN pairing.player_2 IS NULL THEN 'bye' END "
+        "FROM unnest(%s::integer[], %s::integer[], "
+        "%s::integer[], %s::integer[]) "
+        "AS pairing (tournament_id, round, player_1, player_2)",
+    "record_byes":
+        "UPDATE tournament_data SET wins = wins + 1, matches = matches + 1 "
+        "FROM unnest(%s::integer[], %s::integer[]) "
+        "AS bye (tournament_id, player_id) "
+        "WHERE tournament_data.tournament_id = bye.tournament_id "
+        "AND tournament_data.player_id = bye.player_id",
+    "standings_version":
+        "SELECT standings_version FROM tournaments WHERE tournament_id = %s",
+    "bump_standings_version":
+        "WITH locked AS ("
+        "SELECT tournament_id FROM tournaments "
+        "WHERE tournament_id = ANY(%s) ORDER BY tournament_id FOR UPDATE), "
+        "bumped AS ("
+        "UPDATE tournaments "
+        "SET standings_version = nextval('standings_versions') "
+        "FROM locked WHERE tournaments.tournament_id = locked.tournament_id "
+        "RETURNING tournaments.tournament_id) "
+        "SELECT pg_notify(%s, tournament_id::text) FROM bumped",
+    "lock_ratings":
+        "SELECT player_id, rating FROM players "
+        "WHERE player_id = ANY(%s::integer[]) "
+        "ORDER BY player_id FOR NO KEY UPDATE",
+    "update_ratings":
+        "UPDATE players SET rating = players.rating + delta.rating, "
+        "rated_games = players.rated_games + delta.games "
+        "FROM unnest(%s::integer[], %s::float8[], %s::integer[]) "
+        "AS delta (player_id, rating, games) "
+        "WHERE players.player_id = delta.player_id",
+    "lock_rated_matches":
+        "LOCK TABLE matches IN SHARE MODE",
+    "rated_matches":
+        "SELECT tournament_id, round, player_1, player_2, result "
+        "FROM matches WHERE result IN ('win', 'loss', 'draw') "
+        "ORDER BY match_id",
+    "reset_ratings":
+        "UPDATE players SET rating = %s, rated_games = 0 "
+        "WHERE rating <> %s OR rated_games <> 0",
+    "set_ratings":
+        "UPDATE players SET rating = rated.rating, "
+        "rated_games = rated.games "
+        "FROM unnest(%s::integer[], %s::float8[], %s::integer[]) "
+        "AS rated (player_id, rating, games) "
+        "WHERE players.player_id = rated.player_id",
+    "player_ratings":
+        "SELECT player_id, name, rating, rated_games FROM players "
+        "WHERE active = 'yes' ORDER BY rating DESC, player_id",
+    "tournament_storage":
+        "SELECT tournament_storage(%s)",
+    "archive_partitions":
+        "SELECT archive_tournament_partitions(%s)",
+    "restore_partitions":
+        "SELECT restore_tournament_partitions(%s)",
+    "drop_partitions":
+        "SELECT drop_tournament_partitions(%s)",
+    "delete_tournament":
+        "DELETE FROM tournaments WHERE tournament_id = %s",
+    "player_tournaments":
+        "SELECT tournament_id FROM tournament_data WHERE player_id = %s",
+    "entered_tournaments":
+        "SELECT DISTINCT tournament_id FROM tournament_data",
+}
+
+# The STATEMENTS that every registerPlayer(), reportMatch(), swissPairings()
+# and playerStandings() call runs.  TournamentDB prepares these on each of
+# its connections the first time they run there.
+PREPARED_STATEMENTS = frozenset([
+    "current_tournament", "count_players", "register_player", "add_player",
+    "standings", "standings_with_tiebreaks", "standings_by_rating",
+    "standings_with_tiebreaks_by_rating", "standings_version",
+    "report_match", "lock_matches", "update_results", "lock_records",
+    "update_records", "lock_ratings", "update_ratings", "pairing_history",
+    "record_pairings",
+])
+
+# The psycopg2 placeholders in STATEMENTS, and the %% that stands for a %.
+_PLACEHOLDERS = re.compile(r"%(?:\((\w+)\))?s|%%")
+
+def _prepared_sql(name):
+    """Returns the (prepare, execute) SQL for STATEMENTS[name] as the
+    server-side prepared statement tournament_<name>.
+
+    prepare creates the statement and runs it, and execute runs it once it
+    exists; both take the same parameters as STATEMENTS[name].  The
+    statement's placeholders become $1, $2, ... in the order they appear,
+    with each named placeholder numbered once.
+    """
+    arguments = []
+    numbers = {}
+    def number(match):
+        if match.group(0) == "%%":
+            return "%%"
+        key = match.group(1)
+        if key is None or key not in numbers:
+            arguments.append(match.group(0))
+            numbers[key] = len(arguments)
+            return "${0}".format(len(arguments))
+        return "${0}".format(numbers[key])
+    body = _PLACEHOLDERS.sub(number, STATEMENTS[name])
+    statement = "tournament_" + name
+    if not arguments:
+        # Run without parameters, psycopg2 leaves %% alone.
+        body = body.replace("%%", "%")
+        execute = "EXECUTE " + statement
+    else:
+        execute = "EXECUTE {0} ({1})".format(statement, ", ".join(arguments))
+    return "PREPARE {0} AS {1}; {2}".format(statement, body, execute), execute
+
+PREPARED_SQL = dict((name, _prepared_sql(name))
+                    for name in PREPARED_STATEMENTS)
+
+
+class StatementRegistry(object):
+    """Runs STATEMENTS by name, preparing the PREPARED_STATEMENTS once per
+    connection.
+
+    The first time a prepared statement runs on a connection, it is
+    prepared and executed in the same round trip; after that only its name
+    and parameters are sent, and the server reuses its parse and, once it
+    settles on a generic plan, its plan.
+    Which statements each connection holds is tracked by connection, so a
+    connection the pool replaces starts afresh.
+
+    Prepared statements belong to the server session, so the connections
+    must not be shared through a pooler in transaction mode.  If running a
+    statement fails, what the connection holds is no longer known, and
+    the next statement run on it drops them all first.
+    """
+
+    def __init__(self):
+        self._prepared = weakref.WeakKeyDictionary()
+        self._lock = threading.Lock()
+
+    def execute(self, cursor, name, parameters=None):
+        """Runs STATEMENTS[name] on cursor with parameters."""
+        if name not in PREPARED_SQL:
+            cursor.execute(STATEMENTS[name], parameters)
+            return
+        conn = cursor.connection
+        with self._lock:
+            prepared = self._prepared.get(conn)
+            if prepared is None:
+                prepared = self._prepared[conn] = set()
+        prepare, execute = PREPARED_SQL[name]
+        if name in prepared:
+            query = execute
+        elif prepared:
+            query = prepare
+        else:
+            # Nothing is known to be prepared: a new connection, or one
+            # that failed part way through preparing a statement.
+            query = "DEALLOCATE ALL; " + prepare
+        try:
+            cursor.execute(query, parameters)
+        except Exception:
+            prepared.clear()
+            raise
+        prepared.add(name)
+
+
+class Tournament(object):
+    """A handle on a single tournament.
+
+    The handle carries its tournament_id, so every operation runs against
+    that tournament without looking up the current_tournament view again.
+    Several handles can be used side by side to run tournaments at the
+    same time.  Each method takes an optional cursor so that it can join a
+    session that is already open; otherwise it runs in a session of its
+    own.
+
+    Args:
+        tournament_id: The id of the tournament in the tournaments table.
+        db (optional): The TournamentDB to run against.  Defaults to the
+        shared one returned by get_db().
+    """
+
+    def __init__(self, tournament_id, db=None):
+        self.tournament_id = tournament_id
+        self.db = db if db is not None else get_db()
+
+    def __repr__(self):
+        return "Tournament(%r)" % (self.tournament_id,)
+
+    def __eq__(self, other):
+        return (isinstance(other, Tournament) and
+                self.tournament_id == other.tournament_id)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.tournament_id)
+
+    @classmethod
+    def create(cls, name, db=None, cursor=None):
+        """Adds a new tournament and returns a handle on it."""
+        db = db if db is not None else get_db()
+        with db.session(cursor) as cursor:
+            cursor.execute("INSERT INTO tournaments (name) VALUES (%s) \
+                           RETURNING tournament_id", (name,))
+            return cls(cursor.fetchone()[0], db)
+
+    @classmethod
+    def lookup(cls, tournament_id, db=None, cursor=None):
+        """Returns a handle on an existing tournament.
+
+        Raises:
+            ValueError: If there is no tournament with that id.
+        """
+        db = db if db is not None else get_db()
+        with db.session(cursor) as cursor:
+            cursor.execute("SELECT tournament_id FROM tournaments \
+                           WHERE tournament_id = %s", (tournament_id,))
+            if cursor.fetchone() is None:
+                raise ValueError(
+                    "There is no tournament with id {0}.".format(tournament_id))
+        return cls(tournament_id, db)
+
+    @classmethod
+    def current(cls, db=None, cursor=None):
+        """Returns a handle on the current (latest) tournament."""
+        db = db if db is not None else get_db()
+        return cls(get_current_tournament(cursor, db), db)
+
+    def count_players(self, cursor=None):
+        """Returns the number of players registered in this tournament."""
+        with self.db.session(cursor) as cursor:
+            self.db.execute(cursor, "count_players", (self.tournament_id,))
+            return cursor.fetchone()[0]
+
+    def register_player(self, name, email_address, cursor=None):
+        """Adds a player to the players table and to this tournament.
+
+        An inactive player with the same email address is reactivated
+        instead of being added again.  Returns the player's id.
+
+        The player is upserted, entered and the standings moved on by the
+        register_player statement, in a single round trip.
+        """
+        with self.db.session(cursor) as cursor:
+            self.db.execute(cursor, "register_player", {
+                "name": name, "email": email_address,
+                "tournament": self.tournament_id,
+                "channel": STANDINGS_CHANNEL})
+            player_id, entered = cursor.fetchone()
+        if entered and self.db.standings_cache is not None:
+            self.db.standings_cache.invalidate(self.tournament_id)
+        return player_id
+
+    def register_players(self, players, cursor=None):
+        """Adds a roster of players to the players table and to this
+        tournament in one transaction.
+
+        Players are upserted by email address in a single multi-row
+        statement, reactivating inactive players, and then entered into
+        the tournament in a second one.  An email address that appears
+        more than once in the roster is only registered the first time.
+
+        Args:
+            players: An iterable of (name, email_address) pairs.
+
+        Returns:
+            A list with one (player_id, email_address, outcome) tuple per
+            input row, in input order.  outcome is one of 'registered' (a
+            new player), 'reactivated' (an inactive player), 'active' (an
+            active player entered into this tournament), 'already_entered'
+            (already in this tournament) or 'duplicate' (an email address
+            repeated in the roster).
+        """
+        players = list(players)
+        roster = []
+        seen = set()
+        for name, email_address in players:
+            if email_address not in seen:
+                seen.add(email_address)
+                roster.append((name, email_address))
+        if not roster:
+            return []
+        with self.db.session(cursor) as cursor:
+            rows = psycopg2.extras.execute_values(
+                cursor,
+                "WITH roster (name, email) AS (VALUES %s), \
+                      previous AS ( \
+                          SELECT players.email, players.active \
+                          FROM players JOIN roster USING (email)), \
+                      upserted AS ( \
+                          INSERT INTO players (name, email) \
+                          SELECT name, email FROM roster \
+                          ON CONFLICT (email) DO UPDATE SET active = 'yes' \
+                          RETURNING player_id, email) \
+                 SELECT upserted.player_id, upserted.email, previous.active \
+                 FROM upserted LEFT JOIN previous USING (email)",
+                roster, page_size=len(roster), fetch=True)
+            player_ids = dict((email, player_id)
+                              for player_id, email, active in rows)
+            previously = dict((email, active)
+                              for player_id, email, active in rows)
+            cursor.execute("INSERT INTO tournament_data \
+                           (tournament_id, player_id) \
+                           SELECT %s, new_player \
+                           FROM unnest(%s::integer[]) AS new_player \
+                           ON CONFLICT DO NOTHING \
+                           RETURNING player_id",
+                           (self.tournament_id, list(player_ids.values())))
+            entered = set(row[0] for row in cursor.fetchall())
+            if entered:
+                self._standings_changed(cursor)
+        return _registration_outcomes(players, player_ids, previously, entered)
+
+    def add_player(self, player_id, cursor=None):
+        """Adds a player from the players table to this tournament.  A
+        player who is already entered is left as they are.
+        """
+        with self.db.session(cursor) as cursor:
+            self.db.execute(cursor, "add_player",
+                            (self.tournament_id, player_id))
+            if cursor.rowcount:
+                self._standings_changed(cursor)
+
+    def delete_matches(self, cursor=None):
+        """Removes this tournament's matches and resets its win records."""
+        with self.db.session(cursor) as cursor:
+            cursor.execute(STATEMENTS["delete_matches"],
+                           (self.tournament_id,))
+            cursor.execute(STATEMENTS["reset_records"],
+                           (self.tournament_id,))
+            self._standings_changed(cursor)
+
+    def delete_players(self, player_id='ALL', cursor=None):
+        """Removes one player, or every player if player_id is 'ALL',
+        from this tournament.
+        """
+        with self.db.session(cursor) as cursor:
+            if player_id == 'ALL':
+                cursor.execute(STATEMENTS["delete_entries"],
+                               (self.tournament_id,))
+            else:
+                cursor.execute(STATEMENTS["delete_entry"],
+                               (self.tournament_id, player_id))
+            if cursor.rowcount:
+                self._standings_changed(cursor)
+
+    def standings(self, tiebreaks=False, cursor=None, cached=True,
+                  by_rating=False):
+        """Returns this tournament's (id, name, wins, matches) rows, sorted
+        by wins in descending order.
+
+        Ties are broken by opponents' match-win percentage, Buchholz score,
+        strength of schedule and finally player id, all computed by the
+        tournament_tiebreaks() SQL function in one query, so the order is
+        stable.
+
+        The rows are served from the db's standings_cache while the
+        tournament's standings_version has not changed since they were
+        read.  While the cache is listening, cached rows are served
+        without checking the version, until the notification of a change
+        evicts them.
+
+        Args:
+            tiebreaks (optional): If true, each row also carries the
+            tiebreakers as (id, name, wins, matches, omw, buchholz, sos),
+            with omw and sos as floats between 0 and 1.
+            cached (optional): If false, the standings are always read
+            from the database.
+            by_rating (optional): If true, players level on points are
+            ordered by their rating, highest first, before the other
+            tiebreakers, and each row ends with the rating.  Ratings move
+            with results in other tournaments too, so these standings are
+            never cached.
+        """
+        statement = "standings_with_tiebreaks" if tiebreaks else "standings"
+        if by_rating:
+            with self.db.session(cursor) as cursor:
+                self.db.execute(cursor, statement + "_by_rating",
+                                (self.tournament_id, self.tournament_id))
+                return cursor.fetchall()
+        cache = self.db.standings_cache if cached else None
+        key = (self.tournament_id, bool(tiebreaks))
+        if cache is not None and cache.listening:
+            rows = cache.get(key)
+            if rows is not None:
+                return list(rows)
+        if cache is None:
+            with self.db.session(cursor) as cursor:
+                self.db.execute(cursor, statement, (self.tournament_id,))
+                return cursor.fetchall()
+        return list(self._versioned_standings(tiebreaks, cursor, cache)[1])
+
+    def _versioned_standings(self, tiebreaks, cursor, cache):
+        """Returns a (version, rows) tuple: this tournament's
+        standings_version and its standings as a tuple of rows, served
+        from cache (which may be None) if it holds them at that version.
+        """
+        statement = "standings_with_tiebreaks" if tiebreaks else "standings"
+        key = (self.tournament_id, bool(tiebreaks))
+        if cache is not None:
+            generation = cache.generation(self.tournament_id)
+        with self.db.session(cursor) as cursor:
+            self.db.execute(cursor, "standings_version",
+                            (self.tournament_id,))
+            version = cursor.fetchone()
+            version = version[0] if version is not None else None
+            if cache is not None and version is not None:
+                rows = cache.get(key, version)
+                if rows is not None:
+                    return version, rows
+            self.db.execute(cursor, statement, (self.tournament_id,))
+            rows = tuple(cursor.fetchall())
+        if cache is not None and version is not None:
+            cache.put(key, version, rows, generation)
+        return version, rows
+
+    def report_match(self, winner, loser, draw=False, cursor=None):
+        """Records that winner beat loser, or that they drew, in this
+        tournament.
+
+        The result is stored on the open match between the two players,
+        and a match is added to the current round for them if they were
+        never paired.  If their match in the current round has already
+        been reported, reporting the same result again changes nothing,
+        so a retried report is safe; use correct_result() to change it.
+        Stations reporting a pair that was never paired at the same time
+        are serialised by a transaction-level advisory lock keyed on the
+        tournament and the pair's lower player id, so only the first adds
+        the match.
+
+        Storing the result on an open match, with the players' records
+        and ratings and the standings_version, is done by the report_match
+        statement in a single round trip.  It takes its locks in the same
+        order as _record_results().
+        """
+        with self.db.session(cursor) as cursor:
+            self.db.execute(cursor, "report_match", {
+                "tournament": self.tournament_id, "winner": winner,
+                "loser": loser, "draw": bool(draw),
+                "k_factor": tournament_ratings.K_FACTOR,
+                "scale": tournament_ratings.SCALE,
+                "channel": STANDINGS_CHANNEL})
+            if cursor.fetchone() is not None:
+                if self.db.standings_cache is not None:
+                    self.db.standings_cache.invalidate(self.tournament_id)
+                return
+            reported = self._round_match(winner, loser, cursor)
+            if reported is None:
+                # There is no match row to lock yet, so the pair is locked
+                # and looked up again in case another station added it.
+                cursor.execute(STATEMENTS["lock_pair"],
+                               (self.tournament_id, winner, loser))
+                reported = self._round_match(winner, loser, cursor)
+            if reported is not None and reported[2] is not None:
+                _check_repeated_report(winner, draw, *reported)
+                return
+            if reported is None:
+                cursor.execute(STATEMENTS["insert_unpaired_match"],
+                               (self.tournament_id, winner, loser,
+                                self.tournament_id))
+                reported = cursor.fetchone()
+            match_id, player_1 = reported[:2]
+            self._record_results(
+                [(match_id, _result_for(player_1, winner, draw))], cursor)
+
+    def _round_match(self, winner, loser, cursor):
+        """Locks and returns the (match_id, player_1, result) of the pair's
+        latest match in the current round, or None if they have none.
+        """
+        cursor.execute(STATEMENTS["round_match"],
+                       (self.tournament_id, self.tournament_id,
+                        winner, loser, loser, winner))
+        return cursor.fetchone()
+
+    def report_matches(self, results, cursor=None):
+        """Records a whole round of results in one transaction.
+
+        Every (winner, loser) pair must have been paired by swiss_pairings()
+        in this tournament's latest round and not reported yet, and no
+        player may appear in more than one result.  If any result fails
+        those checks nothing is recorded.
+
+        Args:
+            results: An iterable of (winner, loser) player id pairs.
+
+        Raises:
+            ValueError: If a player is reported twice or a pair is not an
+            open pairing of the current round.
+        """
+        results = list(results)
+        winners = [winner for winner, loser in results]
+        losers = [loser for winner, loser in results]
+        if len(set(winners + losers)) != 2 * len(results):
+            raise ValueError("Each player can only be reported once per round.")
+        if not results:
+            return
+        with self.db.session(cursor) as cursor:
+            cursor.execute("SELECT result.winner, result.loser, \
+                                   matches.match_id, matches.player_1 \
+                           FROM unnest(%s::integer[], %s::integer[]) \
+                               AS result (winner, loser) \
+                           LEFT JOIN matches \
+                           ON matches.tournament_id = %s \
+                           AND matches.round = (SELECT max(round) FROM matches \
+                                                WHERE tournament_id = %s) \
+                           AND matches.result IS NULL \
+                           AND ((player_1 = winner AND player_2 = loser) \
+                                OR (player_1 = loser AND player_2 = winner))",
+                           (winners, losers,
+                            self.tournament_id, self.tournament_id))
+            rows = cursor.fetchall()
+            unpaired = [(winner, loser)
+                        for winner, loser, match_id, player_1 in rows
+                        if match_id is None]
+            if unpaired:
+                raise ValueError(
+                    "These results are not open pairings of the current "
+                    "round: {0}".format(unpaired))
+            self._record_results(
+                [(match_id, _result_for(player_1, winner))
+                 for winner, loser, match_id, player_1 in rows],
+                cursor, only_open=True)
+
+    def correct_result(self, match_id, result, cursor=None):
+        """Replaces the recorded result of one match.
+
+        Only the two players' records are adjusted, so the rest of the
+        tournament is left as it is.
+
+        Args:
+            match_id: The match to correct.
+            result: The new result from player_1's point of view: 'win',
+            'loss' or 'draw', or None to mark the match as unreported.
+
+        Raises:
+            ValueError: If the match is not in this tournament or is a bye.
+        """
+        if result not in ('win', 'loss', 'draw', None):
+            raise ValueError("{0!r} is not a match result.".format(result))
+        with self.db.session(cursor) as cursor:
+            self._record_results([(match_id, result)], cursor)
+
+    def submit_result(self, match_id, result, expected_version=None,
+                      cursor=None):
+        """Records the result of one match, safely under concurrent and
+        repeated submissions.
+
+        The match row is locked while the result is checked and written,
+        so stations reporting at the same time are serialised per match.
+        Submitting the result a match already has changes nothing, which
+        makes retries safe.  A different result for a match that has
+        already been reported is only accepted if expected_version is the
+        match's current version, so a correction based on a stale read is
+        refused instead of silently overwriting a newer one.
+
+        Args:
+            match_id: The match being reported.
+            result: 'win', 'loss' or 'draw', from player_1's point of view.
+            expected_version (optional): The version of the match (see
+            match_history()) that the caller is correcting.
+
+        Returns:
+            A (version, applied) tuple: the match's version after the call
+            and whether this call changed it.
+
+        Raises:
+            ResultConflict: If the match already has a different result and
+            expected_version does not match its version.
+            ValueError: If the match is not in this tournament or is a bye.
+        """
+        if result not in ('win', 'loss', 'draw'):
+            raise ValueError("{0!r} is not a match result.".format(result))
+        with self.db.session(cursor) as cursor:
+            current = self._lock_matches([match_id], cursor)
+            player_1, player_2, old_result, version = current[match_id]
+            if old_result == result:
+                return version, False
+            if old_result is not None and expected_version != version:
+                raise ResultConflict(
+                    "Match {0} was already reported as {1!r} (version "
+                    "{2}).".format(match_id, old_result, version))
+            if expected_version is not None and expected_version != version:
+                raise ResultConflict(
+                    "Match {0} is at version {1}, not {2}.".format(
+                        match_id, version, expected_version))
+            self._record_results([(match_id, result)], cursor, current)
+        return version + 1, True
+
+    def _lock_matches(self, match_ids, cursor):
+        """Locks the given matches, in match_id order so that concurrent
+        callers cannot deadlock, and returns a dict mapping each match_id
+        to its (player_1, player_2, result, version).
+
+        Raises:
+            ValueError: If a match is not in this tournament or is a bye.
+        """
+        self.db.execute(cursor, "lock_matches",
+                        (self.tournament_id, list(match_ids)))
+        return _locked_matches(self.tournament_id, match_ids,
+                               cursor.fetchall())
+
+    def _record_results(self, results, cursor, current=None,
+                        only_open=False):
+        """Stores (match_id, result) pairs on their matches and moves each
+        player's wins, draws and matches by the difference between the old
+        and new results.
+
+        The players' ratings are moved by tournament_ratings.rating_changes()
+        in the same transaction.  The matches are locked first (unless
+        current already holds their locked rows), then the players' records
+        and then their ratings, each in id order, so every write path takes
+        its locks in the same order.
+
+        Args:
+            only_open (optional): If true, a match that has already been
+            given a different result raises ResultConflict.  One that
+            already has the same result is left alone.
+        """
+        if current is None:
+            current = self._lock_matches(
+                [match_id for match_id, result in results], cursor)
+        changes, deltas = _result_changes(current, results, only_open)
+        if not changes:
+            return
+        self.db.execute(cursor, "update_results",
+                        ([match_id for match_id, result in changes],
+                         [result for match_id, result in changes],
+                         self.tournament_id))
+        self.db.execute(cursor, "lock_records",
+                        (self.tournament_id, sorted(deltas)))
+        self.db.execute(cursor, "update_records",
+                        _record_deltas(self.tournament_id, deltas))
+        games = _rated_games(current, changes)
+        if games:
+            self.db.execute(cursor, "lock_ratings", (_rated_players(games),))
+            self.db.execute(cursor, "update_ratings", _rating_deltas(
+                tournament_ratings.rating_changes(dict(cursor.fetchall()),
+                                                  games)))
+        self._standings_changed(cursor)
+
+    def rebuild_standings(self, cursor=None):
+        """Recomputes every player's wins, draws and matches in this
+        tournament from the results in the matches table.
+        """
+        with self.db.session(cursor) as cursor:
+            cursor.execute("WITH records AS ( \
+                               SELECT player_1 AS player_id, \
+                                      (result IN ('win', 'bye'))::integer AS won, \
+                                      (result = 'draw')::integer AS drew \
+                               FROM matches \
+                               WHERE tournament_id = %s AND result IS NOT NULL \
+                               UNION ALL \
+                               SELECT player_2, (result = 'loss')::integer, \
+                                      (result = 'draw')::integer \
+                               FROM matches \
+                               WHERE tournament_id = %s AND result IS NOT NULL \
+                               AND player_2 IS NOT NULL), \
+                           totals AS ( \
+                               SELECT player_id, sum(won) AS wins, \
+                                      sum(drew) AS draws, count(*) AS matches \
+                               FROM records GROUP BY player_id) \
+                           UPDATE tournament_data \
+                           SET wins = coalesce(totals.wins, 0), \
+                               draws = coalesce(totals.draws, 0), \
+                               matches = coalesce(totals.matches, 0) \
+                           FROM tournament_data AS entry \
+                           LEFT JOIN totals USING (player_id) \
+                           WHERE entry.tournament_id = %s \
+                           AND tournament_data.tournament_id = entry.tournament_id \
+                           AND tournament_data.player_id = entry.player_id",
+                           (self.tournament_id, self.tournament_id,
+                            self.tournament_id))
+            self._standings_changed(cursor)
+
+    def match_history(self, round_number=None, cursor=None):
+        """Returns this tournament's matches, or one round's, as a list of
+        (match_id, round, player_1, player_2, result, version) tuples in the
+        order they were paired.  result is None for a match not yet
+        reported, and version counts the times its result has changed.
+        """
+        with self.db.session(cursor) as cursor:
+            cursor.execute("SELECT match_id, round, player_1, player_2, \
+                                  result, version \
+                           FROM matches \
+                           WHERE tournament_id = %s \
+                           AND (%s IS NULL OR round = %s) \
+                           ORDER BY match_id",
+                           (self.tournament_id, round_number, round_number))
+            return cursor.fetchall()
+
+    def stream_standings(self, tiebreaks=False,
+                         batch_size=DEFAULT_BATCH_SIZE, cursor=None):
+        """Yields this tournament's standings rows in rank order, as
+        standings() returns them, fetching batch_size rows at a time
+        through a server-side cursor so that memory use stays flat.
+        """
+        statement = "standings_with_tiebreaks" if tiebreaks else "standings"
+        with self.db.session(cursor) as cursor:
+            for row in _stream(cursor, STATEMENTS[statement],
+                               (self.tournament_id,), batch_size):
+                yield row
+
+    def stream_pairings(self, round_number=None,
+                        batch_size=DEFAULT_BATCH_SIZE, cursor=None):
+        """Yields the (id1, name1, id2, name2) pairings of one round, the
+        latest if round_number is omitted, in the order swiss_pairings()
+        returned them.  A bye has None for id2 and name2.
+        """
+        with self.db.session(cursor) as cursor:
+            for row in _stream(
+                    cursor,
+                    "SELECT matches.player_1, first.name, \
+                            matches.player_2, second.name \
+                     FROM matches \
+                     JOIN players AS first \
+                     ON (first.player_id = matches.player_1) \
+                     LEFT JOIN players AS second \
+                     ON (second.player_id = matches.player_2) \
+                     WHERE matches.tournament_id = %s \
+                     AND matches.round = coalesce(%s, \
+                         (SELECT max(round) FROM matches \
+                          WHERE tournament_id = %s)) \
+                     ORDER BY matches.match_id",
+                    (self.tournament_id, round_number, self.tournament_id),
+                    batch_size):
+                yield row
+
+    def stream_history(self, round_number=None,
+                       batch_size=DEFAULT_BATCH_SIZE, cursor=None):
+        """Yields this tournament's matches, or one round's, as the
+        (match_id, round, player_1, player_2, result, version) rows of
+        match_history(), batch_size at a time.
+        """
+        with self.db.session(cursor) as cursor:
+            for row in _stream(
+                    cursor,
+                    "SELECT match_id, round, player_1, player_2, \
+                            result, version \
+                     FROM matches \
+                     WHERE tournament_id = %s \
+                     AND (%s IS NULL OR round = %s) \
+                     ORDER BY match_id",
+                    (self.tournament_id, round_number, round_number),
+                    batch_size):
+                yield row
+
+    def standings_page(self, after=0, limit=DEFAULT_BATCH_SIZE,
+                       tiebreaks=False, cursor=None):
+        """Returns one page of the standings, for callers that page through
+        them across requests.
+
+        Pages are found by keyset rather than OFFSET: the key of the next
+        page is the rank of the last row returned, that is its place in
+        the (points, omw, buchholz, sos, player_id) order, and only the
+        rows ranked after it are fetched, so no more than limit + 1 rows
+        are ever held here.  Ranks only name the same rows while the
+        standings are unchanged, so the key also carries the
+        standings_version the page was read at, and a result reported
+        between two pages makes the next one raise StandingsChanged rather
+        than skip or repeat rows.  The database still ranks the whole
+        field for each page, as the tiebreakers depend on all of it.
+
+        Args:
+            after (optional): 0 for the first page, or the key returned
+            with the previous one.
+            limit (optional): The most rows to return.
+
+        Returns:
+            A (rows, next_key) tuple: the page's standings rows, and the
+            key to pass for the next page, or None after the last page.
+
+        Raises:
+            StandingsChanged: If the standings changed since the previous
+            page was read.
+        """
+        with self.db.session(cursor) as cursor:
+            cursor.execute(STATEMENTS["standings_page"],
+                           (self.tournament_id, after[0] if after else 0,
+                            limit + 1))
+            rows = cursor.fetchall()
+        return _page(rows, after, limit, tiebreaks)
+
+    def history_page(self, after_match_id=0, limit=DEFAULT_BATCH_SIZE,
+                     round_number=None, cursor=None):
+        """Returns one page of match_history(), keyed on match_id.
+
+        Returns:
+            A (rows, next_match_id) tuple: the matches after
+            after_match_id, and the match_id to pass for the next page, or
+            None after the last page.
+        """
+        with self.db.session(cursor) as cursor:
+            cursor.execute("SELECT match_id, round, player_1, player_2, \
+                                  result, version \
+                           FROM matches \
+                           WHERE tournament_id = %s AND match_id > %s \
+                           AND (%s IS NULL OR round = %s) \
+                           ORDER BY match_id LIMIT %s",
+                           (self.tournament_id, after_match_id,
+                            round_number, round_number, limit))
+            rows = cursor.fetchall()
+        return rows, rows[-1][0] if len(rows) == limit else None
+
+    def export_standings(self, out, format="csv", tiebreaks=False,
+                         batch_size=DEFAULT_BATCH_SIZE, cursor=None):
+        """Writes this tournament's standings to the file object out as
+        'csv' (with a header row) or 'jsonl' (one JSON object per line),
+        streaming them with stream_standings().  Returns the number of
+        rows written.
+        """
+        columns = STANDINGS_COLUMNS + (TIEBREAK_COLUMNS if tiebreaks else ())
+        return _export(self.stream_standings(tiebreaks, batch_size, cursor),
+                       columns, out, format)
+
+    def export_history(self, out, format="csv", round_number=None,
+                       batch_size=DEFAULT_BATCH_SIZE, cursor=None):
+        """Writes this tournament's matches to the file object out as
+        'csv' or 'jsonl', streaming them with stream_history().  Returns
+        the number of rows written.
+        """
+        return _export(self.stream_history(round_number, batch_size, cursor),
+                       HISTORY_COLUMNS, out, format)
+
+    def swiss_pairings(self, cursor=None, by_rating=False):
+        """Pairs this tournament's players for the next round, records the
+        pairings in the matches table and returns them as a list of
+        (id1, name1, id2, name2) tuples.
+
+        Pairing is done by tournament_pairing.pair_players(), which avoids
+        rematches and gives a bye to one player when the count is odd.  A
+        bye is recorded as a match with no second player and a 'bye'
+        result, and counts as a win.  With by_rating, players level on
+        points are seeded by rating instead of by the tiebreakers.
+
+        The pairings, the bye and the standings_version are written by the
+        record_pairings statement in a single round trip.
+        """
+        with self.db.session(cursor) as cursor:
+            player_data = self.standings(cursor=cursor, cached=False,
+                                         by_rating=by_rating)
+            self.db.execute(cursor, "pairing_history", (self.tournament_id,))
+            opponents, had_bye = tournament_pairing.opponent_index(
+                cursor.fetchall())
+            match_ups = tournament_pairing.pair_players(
+                player_data, opponents, had_bye)
+            if not match_ups:
+                return match_ups
+            bye = match_ups[-1][0] if match_ups[-1][2] is None else None
+            self.db.execute(cursor, "record_pairings", {
+                "tournament": self.tournament_id,
+                "players_1": [match[0] for match in match_ups],
+                "players_2": [match[2] for match in match_ups],
+                "bye": bye, "channel": STANDINGS_CHANNEL})
+        if bye is not None and self.db.standings_cache is not None:
+            self.db.standings_cache.invalidate(self.tournament_id)
+        return match_ups
+
+    def _standings_changed(self, cursor):
+        """Moves this tournament to a new standings_version, announcing it
+        when the transaction commits, and drops its cached standings.
+        """
+        _bump_standings(cursor, [self.tournament_id], self.db.standings_cache)
+
+
+def _bump_standings(cursor, tournament_ids, cache):
+    """Gives each tournament a new standings_version, notifying
+    STANDINGS_CHANNEL when the transaction commits, and evicts them from
+    cache (which may be None).
+    """
+    if not tournament_ids:
+        return
+    cursor.execute(STATEMENTS["bump_standings_version"],
+                   (list(tournament_ids), STANDINGS_CHANNEL))
+    if cache is not None:
+        for tournament_id in tournament_ids:
+            cache.invalidate(tournament_id)
+
+def _stream(cursor, query, parameters, batch_size):
+    """Yields the rows of query through a named (server-side) cursor on the
+    connection of cursor, fetching batch_size rows per round trip.  The
+    cursor is closed when the rows run out or the caller stops early.
+    """
+    named = cursor.connection.cursor(
+        "tournament_stream_{0}".format(next(_stream_names)))
+    named.itersize = batch_size
+    try:
+        named.execute(query, parameters)
+        for row in named:
+            yield row
+    finally:
+        named.close()
+
+_stream_names = itertools.count(1)
+
+def _export(rows, columns, out, format):
+    """Writes rows to out as CSV or JSON lines and returns how many."""
+    count = 0
+    if format == "csv":
+        writer = csv.writer(out)
+        writer.writerow(columns)
+        for row in rows:
+            writer.writerow(row)
+            count += 1
+    elif format == "jsonl":
+        for row in rows:
+            out.write(json.dumps(collections.OrderedDict(zip(columns, row))))
+            out.write("\n")
+            count += 1
+    else:
+        raise ValueError("{0!r} is not an export format; use 'csv' or "
+                         "'jsonl'.".format(format))
+    return count
+
+def _page(rows, after, limit, tiebreaks):
+    """Turns the rows of the standings_page statement, (player_id, name,
+    wins, matches, omw, buchholz, sos, rank, version) for up to limit + 1
+    players ranked after the key, into a standings_page() result.
+
+    A key names the rank and version of the last row of the page before,
+    which was not the last page, so there must be rows after it at that
+    version.
+    """
+    if after and (not rows or rows[0][8] != after[1]):
+        raise StandingsChanged(
+            "The standings changed since the previous page was read; "
+            "start again from the first page.")
+    page = [tuple(row[:7] if tiebreaks else row[:4]) for row in rows[:limit]]
+    if len(rows) <= limit:
+        return page, None
+    return page, (rows[limit - 1][7], rows[limit - 1][8])
+
+def _registration_outcomes(players, player_ids, previously, entered):
+    """Returns the (player_id, email_address, outcome) rows reported by
+    register_players().
+
+    Args:
+        players: The roster as given, repeated email addresses included.
+        player_ids: A dict mapping each email address to its player_id.
+        previously: A dict mapping each email address to the player's
+        active flag before the roster was registered, or None for a new
+        player.
+        entered: The set of player_ids newly entered into the tournament.
+    """
+    outcomes = []
+    reported = set()
+    for name, email_address in players:
+        player_id = player_ids[email_address]
+        if email_address in reported:
+            outcome = 'duplicate'
+        elif player_id not in entered:
+            outcome = 'already_entered'
+        elif previously[email_address] is None:
+            outcome = 'registered'
+        elif previously[email_address] == 'no':
+            outcome = 'reactivated'
+        else:
+            outcome = 'active'
+        reported.add(email_address)
+        outcomes.append((player_id, email_address, outcome))
+    return outcomes
+
+def _result_for(player_1, winner, draw=False):
+    """Returns the result, from player_1's point of view, of a match that
+    winner won (or that was drawn).
+    """
+    if draw:
+        return 'draw'
+    return 'win' if winner == player_1 else 'loss'
+
+def _check_repeated_report(winner, draw, match_id, player_1, result):
+    """Checks a report of a match in the current round that already has
+    a result.  The same result again is a retry and changes nothing.
+
+    Raises:
+        ResultConflict: If the match was reported with another result.
+    """
+    if _result_for(player_1, winner, draw) != result:
+        raise ResultConflict(
+            "Match {0} was already reported as {1!r}; use correct_result() "
+            "to change it.".format(match_id, result))
+
+def _locked_matches(tournament_id, match_ids, rows):
+    """Turns the rows of the lock_matches statement into a dict mapping
+    each match_id to its (player_1, player_2, result, version), checking
+    that every requested match was found and is not a bye.
+    """
+    current = dict((row[0], tuple(row[1:])) for row in rows)
+    for match_id in match_ids:
+        if match_id not in current:
+            raise ValueError("Match {0} is not in tournament {1}.".format(
+                match_id, tournament_id))
+        if current[match_id][1] is None:
+            raise ValueError(
+                "Match {0} is a bye and has no result to change.".format(
+                    match_id))
+    return current
+
+def _result_changes(current, results, only_open=False):
+    """Works out what recording results on locked matches changes.
+
+    Args:
+        current: A dict mapping match_id to the locked (player_1, player_2,
+        result, version) row.
+        results: The (match_id, result) pairs being recorded.
+        only_open (optional): If true, a match that already has a different
+        result raises ResultConflict.
+
+    Returns:
+        A (changes, deltas) tuple: the (match_id, result) pairs that differ
+        from what is stored, and a dict mapping each affected player_id to
+        the [wins, draws, matches] to add to their record.
+    """
+    changes = []
+    deltas = {}
+    for match_id, result in results:
+        player_1, player_2, old_result, version = current[match_id]
+        if old_result == result:
+            continue
+        if only_open and old_result is not None:
+            raise ResultConflict(
+                "Match {0} was already reported as {1!r}.".format(
+                    match_id, old_result))
+        changes.append((match_id, result))
+        for player_id, old, new in zip(
+                (player_1, player_2),
+                _result_records(old_result), _result_records(result)):
+            delta = deltas.setdefault(player_id, [0, 0, 0])
+            for column in range(3):
+                delta[column] += new[column] - old[column]
+    return changes, deltas
+
+def _record_deltas(tournament_id, deltas):
+    """Returns the parameters of the update_records statement for the
+    deltas returned by _result_changes(), in player_id order.
+    """
+    player_ids = sorted(deltas)
+    return (player_ids,
+            [deltas[player_id][0] for player_id in player_ids],
+            [deltas[player_id][1] for player_id in player_ids],
+            [deltas[player_id][2] for player_id in player_ids],
+            tournament_id)
+
+def _result_records(result):
+    """Returns the (wins, draws, matches) a result adds to player_1's and
+    player_2's records.  An unreported match adds nothing.
+    """
+    return {
+        None: ((0, 0, 0), (0, 0, 0)),
+        'win': ((1, 0, 1), (0, 0, 1)),
+        'loss': ((0, 0, 1), (1, 0, 1)),
+        'draw': ((0, 1, 1), (0, 1, 1)),
+        'bye': ((1, 0, 1), (0, 0, 0)),
+    }[result]
+
+def _rated_games(current, changes):
+    """Returns the (player_1, player_2, old_result, new_result) games that
+    tournament_ratings.rating_changes() takes for the changes returned by
+    _result_changes() on the locked matches in current.
+    """
+    return [(current[match_id][0], current[match_id][1],
+             current[match_id][2], result)
+            for match_id, result in changes
+            if current[match_id][1] is not None]
+
+def _rated_players(games):
+    """Returns the players of games in id order, the order their ratings
+    are locked in.
+    """
+    return sorted(set(player_id for game in games for player_id in game[:2]))
+
+def _rating_deltas(changes):
+    """Returns the parameters of the update_ratings statement for the
+    changes returned by tournament_ratings.rating_changes().
+    """
+    player_ids = sorted(changes)
+    return (player_ids,
+            [changes[player_id][0] for player_id in player_ids],
+            [changes[player_id][1] for player_id in player_ids])
+
+
+class StorageBackend(object):
+    """Where the module-level functions keep the tournament data.
+
+    A backend hands out sessions, which group the work of one module-level
+    call into a single unit, and tournament handles with the methods of
+    Tournament, which take the session's cursor.  The other methods cover
+    the few operations that are not about one tournament.
+
+    PostgresBackend keeps everything in the tournament database and is the
+    default.  tournament_memory.MemoryBackend keeps it in process memory,
+    for simulations and tests that do not need a database.
+    """
+
+    def session(self, cursor=None):
+        """Returns a context manager yielding a cursor for one unit of
+        work; see TournamentDB.session().
+        """
+        raise NotImplementedError
+
+    def connect(self):
+        """Returns a (connection, cursor) pair for ad-hoc statements."""
+        raise NotImplementedError
+
+    def tournament(self, tournament_id):
+        """Returns a handle on a tournament without checking that it
+        exists.
+        """
+        raise NotImplementedError
+
+    def create_tournament(self, name, cursor=None):
+        """Adds a new tournament and returns a handle on it."""
+        raise NotImplementedError
+
+    def lookup_tournament(self, tournament_id, cursor=None):
+        """Returns a handle on an existing tournament.
+
+        Raises:
+            ValueError: If there is no tournament with that id.
+        """
+        raise NotImplementedError
+
+    def current_tournament(self, cursor=None):
+        """Returns the id of the current (latest) tournament, or None if
+        there are no tournaments.
+        """
+        raise NotImplementedError
+
+    def count_active_players(self, cursor=None):
+        """Returns the number of active players in the players table."""
+        raise NotImplementedError
+
+    def deactivate_players(self, player_id='ALL', cursor=None):
+        """Removes one player, or every player if player_id is 'ALL', from
+        every tournament and marks them inactive.
+        """
+        raise NotImplementedError
+
+    def match_tournament(self, match_id, cursor=None):
+        """Returns the tournament_id of a match.
+
+        Raises:
+            ValueError: If there is no match with that id.
+        """
+        raise NotImplementedError
+
+    def pairing_fields(self, tournament_ids, cursor=None, by_rating=False):
+        """Loads what pairing the next round of several tournaments needs.
+
+        Returns:
+            A dict mapping each tournament_id to a (next_round, standings,
+            match_rows) tuple, where standings are the (player_id, name,
+            wins, matches) rows in ranking order, or the by_rating rows of
+            Tournament.standings(), and match_rows are the (player_1,
+            player_2) rows of every match so far.
+
+        Raises:
+            ValueError: If one of the tournaments does not exist.
+        """
+        raise NotImplementedError
+
+    def record_pairings(self, rounds, cursor=None):
+        """Records the pairings of several tournaments' next rounds, as
+        returned by pair_tournaments(), including their byes.
+
+        Args:
+            rounds: A list of (tournament_id, round, match_ups) tuples.
+        """
+        raise NotImplementedError
+
+    def rebuild_ratings(self, k_factor=None, cursor=None):
+        """Recomputes every player's rating from all the rated results in
+        the match history with tournament_ratings.recompute().  Players who
+        have not played a rated game go back to the default rating.
+        Results cannot be reported while it runs.
+        """
+        raise NotImplementedError
+
+    def player_ratings(self, cursor=None):
+        """Returns the active players as (player_id, name, rating,
+        rated_games) tuples, highest rating first.
+        """
+        raise NotImplementedError
+
+    def archive_tournament(self, tournament_id, cursor=None):
+        """Moves a tournament's players and matches out of the live data,
+        keeping them to be restored.
+
+        Raises:
+            ValueError: If the tournament is not live.
+        """
+        raise NotImplementedError
+
+    def restore_tournament(self, tournament_id, cursor=None):
+        """Brings an archived tournament's players and matches back.
+
+        Raises:
+            ValueError: If the tournament is not archived.
+        """
+        raise NotImplementedError
+
+    def purge_tournament(self, tournament_id, cursor=None):
+        """Deletes a tournament, live or archived, with all its players'
+        entries and matches.
+
+        Raises:
+            ValueError: If there is no such tournament.
+        """
+        raise NotImplementedError
+
+
+class PostgresBackend(StorageBackend):
+    """The storage backend that keeps tournaments in PostgreSQL.
+
+    Args:
+        db (optional): The TournamentDB to run against.  Defaults to the
+        shared one returned by get_db(), so configure() applies to it.
+    """
+
+    def __init__(self, db=None):
+        self._db = db
+
+    def __repr__(self):
+        return "PostgresBackend(%r)" % (self.db.dsn,)
+
+    @property
+    def db(self):
+        return self._db if self._db is not None else get_db()
+
+    def session(self, cursor=None):
+        return self.db.session(cursor)
+
+    def connect(self):
+        try:
+            conn = psycopg2.connect(
+                self.db.dsn,
+                cursor_factory=(InstrumentedCursor if _instrumentation.enabled
+                                else self.db.cursor_factory))
+        except (psycopg2.DatabaseError, psycopg2.InterfaceError) as error:
+            _connection_failed(error)
+        else:
+            cursor = conn.cursor()
+            return conn, cursor
+
+    def tournament(self, tournament_id):
+        return Tournament(tournament_id, self.db)
+
+    def create_tournament(self, name, cursor=None):
+        return Tournament.create(name, self.db, cursor)
+
+    def lookup_tournament(self, tournament_id, cursor=None):
+        return Tournament.lookup(tournament_id, self.db, cursor)
+
+    def current_tournament(self, cursor=None):
+        with self.db.session(cursor) as cursor:
+            self.db.execute(cursor, "current_tournament")
+            return cursor.fetchone()[0]
+
+    def count_active_players(self, cursor=None):
+        with self.db.session(cursor) as cursor:
+            cursor.execute(STATEMENTS["count_active_players"])
+            return cursor.fetchone()[0]
+
+    def deactivate_players(self, player_id='ALL', cursor=None):
+        with self.db.session(cursor) as cursor:
+            if player_id == 'ALL':
+                cursor.execute(STATEMENTS["entered_tournaments"])
+                tournament_ids = [row[0] for row in cursor.fetchall()]
+                cursor.execute(STATEMENTS["delete_all_entries"])
+                cursor.execute(STATEMENTS["deactivate_all_players"])
+            else:
+                cursor.execute(STATEMENTS["player_tournaments"], (player_id,))
+                tournament_ids = [row[0] for row in cursor.fetchall()]
+                cursor.execute(STATEMENTS["delete_player_entries"],
+                               (player_id,))
+                cursor.execute(STATEMENTS["deactivate_player"], (player_id,))
+            _bump_standings(cursor, tournament_ids, self.db.standings_cache)
+
+    def match_tournament(self, match_id, cursor=None):
+        with self.db.session(cursor) as cursor:
+            cursor.execute("SELECT tournament_id FROM matches \
+                           WHERE match_id = %s", (match_id,))
+            row = cursor.fetchone()
+        if row is None:
+            raise ValueError("There is no match with id {0}.".format(match_id))
+        return row[0]
+
+    def pairing_fields(self, tournament_ids, cursor=None, by_rating=False):
+        tournament_ids = list(tournament_ids)
+        statement = ("pairing_standings_by_rating" if by_rating
+                     else "pairing_standings")
+        with self.db.session(cursor) as cursor:
+            cursor.execute(STATEMENTS["next_rounds"], (tournament_ids,))
+            fields = dict((tournament_id, (next_round, [], []))
+                          for tournament_id, next_round in cursor.fetchall())
+            _check_tournaments(tournament_ids, fields)
+            cursor.execute(STATEMENTS[statement], (tournament_ids,))
+            for row in cursor.fetchall():
+                fields[row[0]][1].append(row[1:])
+            cursor.execute(STATEMENTS["pairing_histories"], (tournament_ids,))
+            for row in cursor.fetchall():
+                fields[row[0]][2].append(row[1:])
+        return fields
+
+    def record_pairings(self, rounds, cursor=None):
+        events, round_numbers, players_1, players_2 = [], [], [], []
+        bye_events, bye_players = [], []
+        for tournament_id, round_number, match_ups in rounds:
+            for match in match_ups:
+                events.append(tournament_id)
+                round_numbers.append(round_number)
+                players_1.append(match[0])
+                players_2.append(match[2])
+            if match_ups and match_ups[-1][2] is None:
+                bye_events.append(tournament_id)
+                bye_players.append(match_ups[-1][0])
+        with self.db.session(cursor) as cursor:
+            if events:
+                cursor.execute(STATEMENTS["insert_round_pairings"],
+                               (events, round_numbers, players_1, players_2))
+            if bye_events:
+                cursor.execute(STATEMENTS["record_byes"],
+                               (bye_events, bye_players))
+                _bump_standings(cursor, bye_events, self.db.standings_cache)
+
+    def rebuild_ratings(self, k_factor=None, cursor=None):
+        with self.db.session(cursor) as cursor:
+            cursor.execute(STATEMENTS["lock_rated_matches"])
+            cursor.execute(STATEMENTS["rated_matches"])
+            ratings = tournament_ratings.recompute(cursor.fetchall(),
+                                                   k_factor)
+            cursor.execute(STATEMENTS["reset_ratings"],
+                           (tournament_ratings.DEFAULT_RATING,
+                            tournament_ratings.DEFAULT_RATING))
+            player_ids = sorted(ratings)
+            cursor.execute(STATEMENTS["set_ratings"],
+                           (player_ids,
+                            [ratings[player_id][0] for player_id in player_ids],
+                            [ratings[player_id][1] for player_id in player_ids]))
+
+    def player_ratings(self, cursor=None):
+        with self.db.session(cursor) as cursor:
+            cursor.execute(STATEMENTS["player_ratings"])
+            return cursor.fetchall()
+
+    def archive_tournament(self, tournament_id, cursor=None):
+        with self.db.session(cursor) as cursor:
+            self._check_storage(tournament_id, 'live', cursor)
+            cursor.execute(STATEMENTS["archive_partitions"], (tournament_id,))
+            _bump_standings(cursor, [tournament_id], self.db.standings_cache)
+
+    def restore_tournament(self, tournament_id, cursor=None):
+        with self.db.session(cursor) as cursor:
+            self._check_storage(tournament_id, 'archived', cursor)
+            cursor.execute(STATEMENTS["restore_partitions"], (tournament_id,))
+            _bump_standings(cursor, [tournament_id], self.db.standings_cache)
+
+    def purge_tournament(self, tournament_id, cursor=None):
+        with self.db.session(cursor) as cursor:
+            cursor.execute(STATEMENTS["drop_partitions"], (tournament_id,))
+            cursor.execute(STATEMENTS["delete_tournament"], (tournament_id,))
+            if not cursor.rowcount:
+                raise ValueError(
+                    "There is no tournament with id {0}.".format(tournament_id))
+        if self.db.standings_cache is not None:
+            self.db.standings_cache.invalidate(tournament_id)
+
+    def _check_storage(self, tournament_id, storage, cursor):
+        """Raises ValueError unless the partitions of tournament_id are
+        storage, 'live' or 'archived'.
+        """
+        cursor.execute(STATEMENTS["tournament_storage"], (tournament_id,))
+        found = cursor.fetchone()[0]
+        if found is None:
+            raise ValueError(
+                "There is no tournament with id {0}.".format(tournament_id))
+        if found != storage:
+            raise ValueError("Tournament {0} is {1}, not {2}.".format(
+                tournament_id, found, storage))
+
+
+# Set to "memory" to run the module-level functions on the in-memory
+# backend instead of PostgreSQL.
+BACKEND_VARIABLE = "TOURNAMENT_BACKEND"
+
+_backend = None
+
+def get_backend():
+    """Returns the StorageBackend the module-level functions dispatch
+    through, choosing it on first use.
+
+    The backend is a PostgresBackend on the shared TournamentDB unless the
+    TOURNAMENT_BACKEND environment variable is set to 'memory', in which
+    case it is a tournament_memory.MemoryBackend.
+    """
+    global _backend
+    if _backend is None:
+        with _db_lock:
+            if _backend is None:
+                name = os.environ.get(BACKEND_VARIABLE, "postgres")
+                if name == "memory":
+                    import tournament_memory
+                    _backend = tournament_memory.MemoryBackend()
+                elif name == "postgres":
+                    _backend = PostgresBackend()
+                else:
+                    raise ValueError("{0}={1!r} is not a storage backend."
+                                     .format(BACKEND_VARIABLE, name))
+    return _backend
+
+def set_backend(backend):
+    """Makes the module-level functions dispatch through backend, a
+    StorageBackend, and returns it.
+    """
+    global _backend
+    with _db_lock:
+        _backend = backend
+    return backend
+
+
+def _resolve_tournament(backend, tournament_id, cursor):
+    """Returns a tournament handle from backend for the optional
+    *tournament_id argument taken by the module-level functions, falling
+    back to the current tournament.
+    """
+    if tournament_id:
+        return backend.tournament(tournament_id[0])
+    return backend.tournament(backend.current_tournament(cursor))
+
+def _check_tournaments(tournament_ids, found):
+    """Raises ValueError naming the first of tournament_ids that is not in
+    found.
+    """
+    for tournament_id in tournament_ids:
+        if tournament_id not in found:
+            raise ValueError("There is no tournament with id {0}."
+                             .format(tournament_id))
+
+def _optional(tournament_id):
+    """Turns an optional tournament_id keyword argument into the
+    *tournament_id tuple that _resolve_tournament() takes.
+    """
+    return () if tournament_id is None else (tournament_id,)
+
+@_instrumented
 def create_tournament(name):
     """Adds a new tournament to the tournaments table.
 
@@ -43,11 +2324,24 @@ def create_tournament(name):
 
     Arg:
         name: The name of the tournament.
+
+    Returns:
+        A Tournament handle on the new tournament.
+    """
+    return get_backend().create_tournament(name)
+
+@_instrumented
+def get_tournament(tournament_id):
+    """Returns a Tournament handle on an existing tournament.
+
+    Raises ValueError if there is no tournament with that id.
+
+    Arg:
+        tournament_id: The id of the tournament.
     """
-    conn, cursor = connect()
-    cursor.execute("INSERT INTO tournaments (name) VALUES (%s)", (name,))
-    commit_and_close(conn, cursor)
+    return get_backend().lookup_tournament(tournament_id)
 
+@_instrumented
 def deleteMatches(*tournament_id):
     """Remove all the matches for the specified tournament.
 
@@ -60,21 +2354,12 @@ def deleteMatches(*tournament_id):
         the current tournament.  Otherwise the specified tournment will
         be updated.
         """
-    conn, cursor = connect()
-    if not tournament_id:
-        cursor.execute("DELETE FROM matches \
-                       WHERE tournament_id = %s", (get_current_tournament(),))
-        cursor.execute("UPDATE tournament_data \
-                       SET matches = DEFAULT, wins = DEFAULT \
-                       WHERE tournament_id = %s", (get_current_tournament(),))
-    else:
-        cursor.execute("DELETE FROM matches \
-                       WHERE tournament_id = %s", (tournament_id,))
-        cursor.execute("UPDATE tournament_data \
-                       SET matches = DEFAULT, wins = DEFAULT \
-                       WHERE tournament_id = %s", (tournament_id,))
-    commit_and_close(conn, cursor)
+    backend = get_backend()
+    with backend.session() as cursor:
+        tournament = _resolve_tournament(backend, tournament_id, cursor)
+        tournament.delete_matches(cursor)
 
+@_instrumented
 def deletePlayers(player_id, *tournament_id):
     """Removes player records from specified tournaments
 
@@ -93,36 +2378,17 @@ def deletePlayers(player_id, *tournament_id):
         will be set to 'no'.  Otherwise, only the specified tournament's
         data will be updated.
     """
-    conn, cursor = connect()
-    if not tournament_id:
-        """IF tournament_id is omitted, will check player_id and then
-        delete the correct entries.
-        """
-        if player_id is 'ALL':
-            cursor.execute("DELETE FROM tournament_data \
-                           WHERE tournament_id = %s", (get_current_tournament(),))
+    backend = get_backend()
+    with backend.session() as cursor:
+        if tournament_id and tournament_id[0] == 'ALL':
+            """Checks if tournament_id is set to 'ALL' and then deletes the
+            correct entries and updates players.active"""
+            backend.deactivate_players(player_id, cursor)
         else:
-            cursor.execute("DELETE FROM tournament_data \
-                           WHERE tournament_id = %s AND player_id = %s",
-                           (get_current_tournament(), player_id))
-    elif tournament is 'ALL':
-        """Checks if tournament_id is set to 'ALL' and then deletes the
-        correct entries and updates players.active"""
-        if player_id is 'ALL':
-            cursor.execute("DELETE FROM tournament_data")
-            cursor.execute("UPDATE players \
-                           SET active = 'no'")
-        else:
-            cursor.execute("DELETE FROM tournament_data \
-                           WHERE player_id = %s", (player_id,))
-            cursor.execute("UPDATE players \
-                           SET active = 'no' \
-                           WHERE player_id = %s", (player_id,))
-    else:
-        cursor.execute("DELETE FROM tournament_data \
-                       WHERE player_id = %s", (player_id,))
-    commit_and_close(conn, cursor)
+            tournament = _resolve_tournament(backend, tournament_id, cursor)
+            tournament.delete_players(player_id, cursor)
 
+@_instrumented
 def countPlayers(*tournament_id):
     """Returns the number of players.
 
@@ -136,23 +2402,14 @@ def countPlayers(*tournament_id):
         the total count of active players.  Otherwise will return the
         registration for the specified tournament.
     """
-    conn, cursor = connect()
-    if not tournament_id:
-        cursor.execute("SELECT count(player_id) FROM tournament_data \
-                       WHERE tournament_id = %s", (get_current_tournament(),))
-        player_count = cursor.fetchone()
-    elif tournament_id is 'ALL':
-        cursor.execute("SELECT count(player_id) FROM players \
-                       WHERE active = 'yes'")
-        player_count = cursor.fetchone()
-    else:
-        cursor.execute("SELECT count(player_id) FROM tournament_data \
-                       WHERE tournament_id = %s", (tournament_id,))
-        player_count = cursor.fetchone()
-    player_count = player_count[0]
-    commit_and_close(conn, cursor)
-    return player_count
+    backend = get_backend()
+    with backend.session() as cursor:
+        if tournament_id and tournament_id[0] == 'ALL':
+            return backend.count_active_players(cursor)
+        tournament = _resolve_tournament(backend, tournament_id, cursor)
+        return tournament.count_players(cursor)
 
+@_instrumented
 def registerPlayer(name, email_address):
     """Adds a player to players table and current tournament.
 
@@ -165,38 +2422,33 @@ def registerPlayer(name, email_address):
       name: the player's full name (need not be unique)
       email_address: the player's email address (must be unique)
     """
-    conn, cursor = connect()
-    cursor.execute("SELECT (player_id, active) FROM players \
-                   WHERE email = %s", (email_address,))
-    already_registered = cursor.fetchone()
-    if already_registered is None:
-        """IF the player's email address is not already in the players
-        table, then the player is added to players and the current tourney.
-        """
-        cursor.execute("INSERT INTO players (name, email) \
-                       VALUES (%s, %s)", (name, email_address))
-        conn.commit()
-        cursor.execute("SELECT * FROM last_registered_player")
-        newest_player = cursor.fetchone()
-        newest_player = newest_player[0]
-        register_tournament_player(newest_player)
-    else:
-        player_id = already_registered[0]
-        player_active = already_registered[1]
-        if player_active is 'no':
-            """IF the player is in the players table already, but inactive,
-            then the player is set to active and registered to the current
-            tourney.
-            """
-            cursor.execute("UPDATE players \
-                           SET active = 'yes' \
-                           WHERE player_id = %s", (player_id,))
-            register_tournament_player(player_id)
-        else:
-            register_tournament_player(player_id)
-    commit_and_close(conn, cursor)
+    backend = get_backend()
+    with backend.session() as cursor:
+        tournament = _resolve_tournament(backend, (), cursor)
+        return tournament.register_player(name, email_address, cursor)
+
+@_instrumented
+def registerPlayers(players):
+    """Adds a roster of players to the players table and the current
+    tournament in a single transaction.
+
+    This is the bulk form of registerPlayer() and is much faster for large
+    rosters.  See Tournament.register_players() for the outcomes reported
+    for each row.
+
+    Args:
+      players: an iterable of (name, email_address) pairs
+
+    Returns:
+      A list of (player_id, email_address, outcome) tuples in input order.
+    """
+    backend = get_backend()
+    with backend.session() as cursor:
+        tournament = _resolve_tournament(backend, (), cursor)
+        return tournament.register_players(players, cursor)
 
-def register_tournament_player(player_id):
+@_instrumented
+def register_tournament_player(player_id, cursor=None):
     """Adds a registered player to the current tournament.
 
     Requires player to already be registered in the players table and
@@ -206,91 +2458,414 @@ def register_tournament_player(player_id):
 
     ARGS:
         player_id: The player_id for the player being registered.
+        cursor (optional): A cursor from an open session to run in.  If
+        omitted, the player is registered in a session of its own.
     """
-    conn, cursor = connect()
-    cursor.execute("INSERT INTO tournament_data (tournament_id, player_id) \
-                   VALUES (%s, %s)", (get_current_tournament(), player_id))
-    commit_and_close(conn, cursor)
+    backend = get_backend()
+    with backend.session(cursor) as cursor:
+        tournament = _resolve_tournament(backend, (), cursor)
+        tournament.add_player(player_id, cursor)
 
-def playerStandings():
+@_instrumented
+def playerStandings(tiebreaks=False, by_rating=False):
     """Returns a list of the players and their win records, sorted by wins
     in decending order.
 
+    Players with the same number of wins are ordered by their opponents'
+    match-win percentage, then Buchholz score, then strength of schedule
+    and finally player id, so the standings are always in the same order.
+
+    Args:
+      tiebreaks (optional): if true, the tiebreakers are included in each
+        tuple as omw, buchholz and sos
+      by_rating (optional): if true, players with the same points are
+        ordered by rating, highest first, before the other tiebreakers, and
+        each tuple ends with the player's rating
+
     Returns:
       A list of tuples, each of which contains (id, name, wins, matches):
         id: the player's unique id (assigned by the database)
         name: the player's full name (as registered)
         wins: the number of matches the player has won
         matches: the number of matches the player has played
+      or, with tiebreaks, (id, name, wins, matches, omw, buchholz, sos):
+        omw: the average of the opponents' match-win percentages, each
+          floored at one third
+        buchholz: the sum of the opponents' wins
+        sos: strength of schedule, the average of the opponents' omw
     """
-    conn, cursor = connect()
-    cursor.execute("SELECT * \
-                   FROM player_standings \
-                   ORDER BY wins DESC")
-    player_data = cursor.fetchall()
-    commit_and_close(conn, cursor)
-    return player_data
+    backend = get_backend()
+    with backend.session() as cursor:
+        tournament = _resolve_tournament(backend, (), cursor)
+        return tournament.standings(tiebreaks, cursor, by_rating=by_rating)
 
-def reportMatch(winner, loser):
+@_instrumented
+def reportMatch(winner, loser, draw=False):
     """Records the outcome of a match in the current tournament.
 
+    The result is stored on the match swissPairings() created for the two
+    players, or on a new match if they were never paired, and their
+    records are updated from it.
+
     Args:
       winner:  the id number of the player who won
       loser:  the id number of the player who lost
+      draw (optional): if true, the match was a draw and neither won
+    """
+    backend = get_backend()
+    with backend.session() as cursor:
+        tournament = _resolve_tournament(backend, (), cursor)
+        tournament.report_match(winner, loser, draw, cursor)
+
+@_instrumented
+def reportMatches(results):
+    """Records a whole round of results in the current tournament.
+
+    The round is applied in a single transaction.  Every pair must have
+    been paired by swissPairings() in the current round and no player may
+    be reported twice; otherwise ValueError is raised and nothing is
+    recorded.
+
+    Args:
+      results: an iterable of (winner, loser) player id pairs
+    """
+    backend = get_backend()
+    with backend.session() as cursor:
+        tournament = _resolve_tournament(backend, (), cursor)
+        tournament.report_matches(results, cursor)
+
+@_instrumented
+def submit_result(match_id, result, expected_version=None,
+                  tournament_id=None):
+    """Records the result of a match, keyed by its match_id.
+
+    This is the entry point for scorekeeping stations: it is safe to call
+    from many stations at once and to retry, because submitting the result
+    a match already has is a no-op.  See Tournament.submit_result().
+
+    ARGS:
+        match_id: The match being reported.
+        result: 'win', 'loss' or 'draw' from player_1's point of view.
+        expected_version (optional): The match version being corrected, to
+        replace a result that was already reported.
+        tournament_id (optional): The match's tournament.  Stations should
+        pass it: the match is then only looked for in that tournament's
+        partition, while without it the tournament is first found by
+        probing the partitions of every live tournament.
+
+    Returns:
+        A (version, applied) tuple.
+
+    Raises:
+        ResultConflict: If the match already has a different result.
+        ValueError: If there is no such match, in tournament_id if given.
+    """
+    backend = get_backend()
+    with backend.session() as cursor:
+        if tournament_id is None:
+            tournament_id = backend.match_tournament(match_id, cursor)
+        tournament = backend.tournament(tournament_id)
+        return tournament.submit_result(
+            match_id, result, expected_version, cursor)
+
+@_instrumented
+def correct_result(match_id, result, *tournament_id):
+    """Replaces the recorded result of one match.
+
+    Only the two players' records change, so a mistake can be fixed without
+    deleting and re-entering the tournament's matches.
+
+    ARGS:
+        match_id: The match to correct (see match_history()).
+        result: The new result from player_1's point of view: 'win', 'loss'
+        or 'draw', or None to mark the match as unreported.
+        tournament_id (optional): If omitted, the current tournament.
+    """
+    backend = get_backend()
+    with backend.session() as cursor:
+        tournament = _resolve_tournament(backend, tournament_id, cursor)
+        tournament.correct_result(match_id, result, cursor)
+
+@_instrumented
+def rebuild_standings(*tournament_id):
+    """Recomputes every player's record in a tournament from the results
+    stored in the matches table.
+
+    ARGS:
+        tournament_id (optional): If omitted, the current tournament.
+    """
+    backend = get_backend()
+    with backend.session() as cursor:
+        tournament = _resolve_tournament(backend, tournament_id, cursor)
+        tournament.rebuild_standings(cursor)
+
+@_instrumented
+def match_history(*tournament_id):
+    """Returns the matches of a tournament as a list of (match_id, round,
+    player_1, player_2, result, version) tuples.
+
+    result is 'win', 'loss' or 'draw' from player_1's point of view, 'bye'
+    when player_2 is None, or None when the match has not been reported.
+    version counts the times the result has changed.
+
+    ARGS:
+        tournament_id (optional): If omitted, the current tournament.
+    """
+    backend = get_backend()
+    with backend.session() as cursor:
+        tournament = _resolve_tournament(backend, tournament_id, cursor)
+        return tournament.match_history(cursor=cursor)
+
+def stream_standings(tournament_id=None, tiebreaks=False,
+                     batch_size=DEFAULT_BATCH_SIZE):
+    """Yields the standings rows of playerStandings() one at a time,
+    fetching them batch_size at a time so that memory use does not grow
+    with the size of the tournament.
+
+    ARGS:
+        tournament_id (optional): If omitted, the current tournament.
+        tiebreaks (optional): If true, the rows carry the tiebreakers.
+        batch_size (optional): The number of rows fetched per round trip.
+    """
+    backend = get_backend()
+    with backend.session() as cursor:
+        tournament = _resolve_tournament(backend, _optional(tournament_id),
+                                         cursor)
+        for row in tournament.stream_standings(tiebreaks, batch_size, cursor):
+            yield row
+
+def stream_pairings(round_number=None, tournament_id=None,
+                    batch_size=DEFAULT_BATCH_SIZE):
+    """Yields the (id1, name1, id2, name2) pairings of a round as
+    swissPairings() returned them, batch_size at a time.
+
+    ARGS:
+        round_number (optional): If omitted, the latest round.
+        tournament_id (optional): If omitted, the current tournament.
+        batch_size (optional): The number of rows fetched per round trip.
+    """
+    backend = get_backend()
+    with backend.session() as cursor:
+        tournament = _resolve_tournament(backend, _optional(tournament_id),
+                                         cursor)
+        for row in tournament.stream_pairings(round_number, batch_size,
+                                              cursor):
+            yield row
+
+def stream_history(tournament_id=None, round_number=None,
+                   batch_size=DEFAULT_BATCH_SIZE):
+    """Yields the match_history() rows of a tournament, batch_size at a
+    time.
+
+    ARGS:
+        tournament_id (optional): If omitted, the current tournament.
+        round_number (optional): If given, only that round's matches.
+        batch_size (optional): The number of rows fetched per round trip.
+    """
+    backend = get_backend()
+    with backend.session() as cursor:
+        tournament = _resolve_tournament(backend, _optional(tournament_id),
+                                         cursor)
+        for row in tournament.stream_history(round_number, batch_size,
+                                             cursor):
+            yield row
+
+@_instrumented
+def export_standings(out, format="csv", tournament_id=None, tiebreaks=False):
+    """Writes a tournament's standings to the file object out as 'csv'
+    or 'jsonl' without holding them all in memory, and returns the number
+    of rows written.  See Tournament.export_standings().
+
+    ARGS:
+        out: A text file, opened with newline='' for CSV on Python 3.
+        format (optional): 'csv' or 'jsonl'.
+        tournament_id (optional): If omitted, the current tournament.
+        tiebreaks (optional): If true, the tiebreakers are included.
+    """
+    backend = get_backend()
+    with backend.session() as cursor:
+        tournament = _resolve_tournament(backend, _optional(tournament_id),
+                                         cursor)
+        return tournament.export_standings(out, format, tiebreaks,
+                                           cursor=cursor)
+
+@_instrumented
+def export_history(out, format="csv", tournament_id=None, round_number=None):
+    """Writes a tournament's matches to the file object out as 'csv' or
+    'jsonl' without holding them all in memory, and returns the number of
+    rows written.  See Tournament.export_history().
     """
-    conn, cursor = connect()
-    cursor.execute("UPDATE tournament_data \
-                        SET wins = wins + 1 \
-                        WHERE player_id = %s \
-                        AND tournament_id = %s",
-                        (winner, get_current_tournament()))
-    cursor.execute("UPDATE tournament_data \
-                        SET matches = matches + 1 \
-                        WHERE (player_id = %s OR player_id = %s) \
-                        AND tournament_id = %s",
-                        (winner, loser, get_current_tournament()))
-    commit_and_close(conn, cursor)
-
-def get_current_tournament():
-    """Returns the tournament_id for the current tournament"""
-
-    conn, cursor = connect()
-    cursor.execute("SELECT * FROM current_tournament")
-    current_tourney = cursor.fetchone()
-    current_tourney = current_tourney[0]
-    return current_tourney
-
-def swissPairings():
+    backend = get_backend()
+    with backend.session() as cursor:
+        tournament = _resolve_tournament(backend, _optional(tournament_id),
+                                         cursor)
+        return tournament.export_history(out, format, round_number,
+                                         cursor=cursor)
+
+@_instrumented
+def get_current_tournament(cursor=None, db=None):
+    """Returns the tournament_id for the current tournament
+
+    ARGS:
+        cursor (optional): A cursor from an open session to run in.  If
+        omitted, the lookup is made in a session of its own.
+        db (optional): The TournamentDB to use.  If omitted, the lookup
+        goes through the storage backend returned by get_backend().
+    """
+    backend = PostgresBackend(db) if db is not None else get_backend()
+    return backend.current_tournament(cursor)
+
+@_instrumented
+def swissPairings(by_rating=False):
     """Creates the set of matches and returns the list and records the matches
     to the mathes table for the current tournament.
 
-    Assuming that there are an even number of players registered, each player
-    appears exactly once in the pairings.  Each player is paired with another
-    player with an equal or nearly-equal win record, that is, a player adjacent
-    to him or her in the standings.
+    Each player appears exactly once in the pairings.  Each player is paired
+    with another player with an equal or nearly-equal win record whom they
+    have not played yet, floating down to the next win group only when
+    needed.  If there is an odd number of players, the lowest ranked player
+    who has not had a bye gets one, which counts as a win.
+
+    Args:
+      by_rating (optional): if true, players with the same points are
+        seeded by rating instead of by the standings tiebreakers
 
     Returns:
       A list of tuples, each of which contains (id1, name1, id2, name2)
         id1: the first player's unique id
         name1: the first player's name
-        id2: the second player's unique id
-        name2: the second player's name
+        id2: the second player's unique id, or None for a bye
+        name2: the second player's name, or None for a bye
     """
-    conn, cursor = connect()
-    player_data = playerStandings()
-    match_ups = []
-    rank = 0
-    while rank < (len(player_data)):
-        match = (player_data[rank][0], player_data[rank][1],
-                 player_data[rank + 1][0], player_data[rank + 1][1])
-        match_ups.append(match)
-        cursor.execute("INSERT INTO matches (tournament_id, player_1, player_2)"
-                       "VALUES (%s, %s, %s)",
-                       (get_current_tournament(),match[0], match[2]))
-        rank += 2
-    commit_and_close(conn, cursor)
-    return match_ups
+    backend = get_backend()
+    with backend.session() as cursor:
+        tournament = _resolve_tournament(backend, (), cursor)
+        return tournament.swiss_pairings(cursor, by_rating)
 
+@_instrumented
+def pair_tournaments(tournament_ids, processes=None, by_rating=False):
+    """Pairs the next round of several tournaments at once.
 
+    The standings and match history of every tournament are loaded in
+    bulk, paired by tournament_pairing.pair_fields(), and all the pairings
+    and byes are written back in one batch, all in a single transaction.
+    Each tournament is paired exactly as swissPairings() would pair it.
 
+    Batches of fewer than tournament_pairing.PARALLEL_MIN_PLAYERS players
+    in all, and every batch on Python 2, are paired one tournament after
+    another in this process.  Larger batches are spread over a pool of
+    worker processes, started by the first batch that needs it (inside
+    its transaction, which that batch holds open for the start-up) and
+    reused after that.  The pool has only been measured on one CPU, where
+    it is slower than pairing in process; see tournament_bench.py parallel.
 
+    ARGS:
+        tournament_ids: The tournaments to pair.
+        processes (optional): The number of worker processes.  Defaults to
+        the number of CPUs; 1 pairs everything in this process.
+        by_rating (optional): If true, players with the same points are
+        seeded by rating, as swissPairings(by_rating=True) does.
+
+    Returns:
+        A dict mapping each tournament_id to its list of (id1, name1, id2,
+        name2) pairings, as swissPairings() returns them.
+
+    Raises:
+        ValueError: If one of the tournaments does not exist.
+    """
+    tournament_ids = list(collections.OrderedDict.fromkeys(tournament_ids))
+    backend = get_backend()
+    with backend.session() as cursor:
+        fields = backend.pairing_fields(tournament_ids, cursor, by_rating)
+        paired = tournament_pairing.pair_fields(
+            [fields[tournament_id][1:] for tournament_id in tournament_ids],
+            processes)
+        backend.record_pairings(
+            [(tournament_id, fields[tournament_id][0], match_ups)
+             for tournament_id, match_ups in zip(tournament_ids, paired)],
+            cursor)
+    return dict(zip(tournament_ids, paired))
+
+@_instrumented
+def rebuild_ratings(k_factor=None):
+    """Recomputes every player's Elo rating from the whole match history.
+
+    Ratings are normally moved as each result is reported.  This replays
+    every rated result instead, one round at a time, for a backfill, after
+    matches have been deleted, or with a different k_factor when the rules
+    change.  Results cannot be reported while it runs.
+
+    ARGS:
+        k_factor (optional): The most a single game can move a rating.
+        Defaults to tournament_ratings.K_FACTOR, which is also what the
+        ratings move by as results are reported, so change that to change
+        the rules for good.
+    """
+    backend = get_backend()
+    with backend.session() as cursor:
+        backend.rebuild_ratings(k_factor, cursor)
+
+@_instrumented
+def player_ratings():
+    """Returns the active players ranked by Elo rating across all
+    tournaments, as a list of (id, name, rating, rated_games) tuples with
+    the highest rating first.  rated_games counts the reported matches
+    (not byes) the rating is based on.
+    """
+    backend = get_backend()
+    with backend.session() as cursor:
+        return backend.player_ratings(cursor)
+
+@_instrumented
+def archive_tournament(tournament_id):
+    """Moves a finished tournament out of the live tables.
+
+    matches and tournament_data are partitioned by tournament, so this
+    detaches the tournament's partitions and moves them to the archive
+    schema, changing only the catalogs however many rows they hold.  The
+    tournament keeps its row in tournaments, but has no players or matches
+    until restore_tournament() brings them back, and its results no longer
+    count towards rebuild_ratings().  Detaching briefly locks matches and
+    tournament_data against every other query.
+
+    ARGS:
+        tournament_id: The tournament to archive.
+
+    Raises:
+        ValueError: If the tournament is not live.
+    """
+    backend = get_backend()
+    with backend.session() as cursor:
+        backend.archive_tournament(tournament_id, cursor)
+
+@_instrumented
+def restore_tournament(tournament_id):
+    """Brings an archived tournament's players and matches back into the
+    live tables.
+
+    ARGS:
+        tournament_id: The tournament to restore.
+
+    Raises:
+        ValueError: If the tournament is not archived.
+    """
+    backend = get_backend()
+    with backend.session() as cursor:
+        backend.restore_tournament(tournament_id, cursor)
+
+@_instrumented
+def purge_tournament(tournament_id):
+    """Deletes a tournament, live or archived, by dropping its partitions
+    of matches and tournament_data and then its row in tournaments.  No
+    other tournament's rows are read or rewritten.  Players stay in the
+    players table, with their ratings as they are.
+
+    ARGS:
+        tournament_id: The tournament to delete.
+
+    Raises:
+        ValueError: If there is no such tournament.
+    """
+    backend = get_backend()
+    with backend.session() as cursor:
+        backend.purge_tournament(tournament_id, cursor)
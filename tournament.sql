@@ -12,34 +12,170 @@ CREATE TABLE players
 		name text,
 		email text,
 		active text DEFAULT 'yes',
+		rating double precision NOT NULL DEFAULT 1500,
+		rated_games integer NOT NULL DEFAULT 0,
+		-- the player's Elo rating across all tournaments and the number of
+		-- reported matches it is based on, moved as results are reported
 		UNIQUE (email)
 	);
 
+CREATE SEQUENCE standings_versions;
+	-- Hands out standings versions.  Values are never reused, even when the
+	-- transaction that took one rolls back.
+
 CREATE TABLE tournaments
 	-- Creates a table that holds the id and name of each tournament
 	(
 	 	tournament_id serial PRIMARY KEY,
 	 	name text,
-	 	date_started timestamp DEFAULT current_timestamp
+	 	date_started timestamp DEFAULT current_timestamp,
+	 	standings_version bigint NOT NULL DEFAULT nextval('standings_versions')
+	 	-- changes whenever a write may change the tournament's standings, so
+	 	-- cached standings can be checked against it
 	);
 
 CREATE TABLE tournament_data
 	-- Creates a table to hold tournament data like registered players and
-	-- their win/loss records.
+	-- their win/loss records.  A player is entered into a tournament once.
+	-- It is partitioned by tournament, with one partition per tournament
+	-- made by create_tournament_partitions().
 	(
-	 	tournament_id serial REFERENCES tournaments,
-	 	player_id serial REFERENCES players,
+	 	tournament_id integer NOT NULL REFERENCES tournaments,
+	 	player_id integer NOT NULL REFERENCES players,
 	 	wins integer DEFAULT 0,
-	 	matches integer DEFAULT 0
-	);
+	 	draws integer DEFAULT 0,
+	 	matches integer DEFAULT 0,
+	 	-- wins, draws and matches are kept up to date from the results in
+	 	-- the matches table as they are reported.
+	 	PRIMARY KEY (tournament_id, player_id)
+	) PARTITION BY LIST (tournament_id);
+
+CREATE INDEX tournament_data_player_idx ON tournament_data (player_id);
+	-- Supports removing a player from every tournament.
 
 CREATE TABLE matches
-	-- Creates a table to hold all the matchups from the tournaments
+	-- Creates a table to hold all the matchups from the tournaments and
+	-- their results, partitioned by tournament like tournament_data.
 	(
-	 	tournament_id serial REFERENCES tournaments,
-	 	player_1 serial REFERENCES players(player_id),
-	 	player_2 serial REFERENCES players(player_id)
-	);
+	 	match_id serial,
+	 	tournament_id integer NOT NULL REFERENCES tournaments,
+	 	round integer NOT NULL DEFAULT 1,
+	 	player_1 integer NOT NULL REFERENCES players(player_id),
+	 	player_2 integer REFERENCES players(player_id),
+	 	-- player_2 is NULL when player_1 was given a bye
+	 	result text CHECK (result IN ('win', 'loss', 'draw', 'bye')),
+	 	-- result is from player_1's point of view and NULL until reported
+	 	version integer NOT NULL DEFAULT 0,
+	 	-- version counts the changes to result, for optimistic corrections
+	 	PRIMARY KEY (tournament_id, match_id)
+	 	-- a partitioned table's keys must include tournament_id; match_id
+	 	-- is unique on its own because it comes from one sequence
+	) PARTITION BY LIST (tournament_id);
+
+CREATE INDEX matches_match_idx ON matches (match_id);
+	-- Finds a match's tournament from its match_id alone.  This probes
+	-- every partition, so archive or purge tournaments that are over.
+
+CREATE INDEX matches_tournament_round_idx ON matches (tournament_id, round);
+	-- Supports the per-tournament pairing history and current round lookups.
+
+CREATE INDEX matches_player_1_idx ON matches (player_1);
+CREATE INDEX matches_player_2_idx ON matches (player_2);
+	-- Support a player's match history and deleting players.
+
+CREATE SCHEMA archive;
+	-- Holds the partitions of archived tournaments, out of the way of the
+	-- queries on matches and tournament_data.
+
+CREATE FUNCTION create_tournament_partitions(integer)
+	-- Creates the matches_<id> and tournament_data_<id> partitions of a
+	-- tournament.  The tournaments_partitions trigger calls it for every
+	-- new tournament.  CREATE TABLE ... PARTITION OF would lock matches and
+	-- tournament_data against every query, so each partition is created on
+	-- its own and then attached, which lets queries on the other
+	-- tournaments carry on.  Its CHECK constraint spares attaching (now, and
+	-- again after an archive) from reading the rows to prove they belong.
+	RETURNS void LANGUAGE plpgsql AS $$
+	BEGIN
+		EXECUTE format('CREATE TABLE public.matches_%s (LIKE matches '
+		               'INCLUDING DEFAULTS INCLUDING CONSTRAINTS, '
+		               'CHECK (tournament_id = %s))', $1, $1);
+		EXECUTE format('CREATE TABLE public.tournament_data_%s '
+		               '(LIKE tournament_data INCLUDING DEFAULTS '
+		               'INCLUDING CONSTRAINTS, CHECK (tournament_id = %s))',
+		               $1, $1);
+		EXECUTE format('ALTER TABLE matches ATTACH PARTITION public.matches_%s '
+		               'FOR VALUES IN (%s)', $1, $1);
+		EXECUTE format('ALTER TABLE tournament_data '
+		               'ATTACH PARTITION public.tournament_data_%s '
+		               'FOR VALUES IN (%s)', $1, $1);
+	END;
+	$$;
+
+CREATE FUNCTION tournaments_partitions() RETURNS trigger
+	LANGUAGE plpgsql AS $$
+	BEGIN
+		PERFORM create_tournament_partitions(NEW.tournament_id);
+		RETURN NULL;
+	END;
+	$$;
+
+CREATE TRIGGER tournaments_partitions AFTER INSERT ON tournaments
+	FOR EACH ROW EXECUTE PROCEDURE tournaments_partitions();
+
+CREATE FUNCTION tournament_storage(integer)
+	-- Returns 'live' if a tournament's partitions are attached, 'archived'
+	-- if they are in the archive schema and NULL if it has none.
+	RETURNS text LANGUAGE sql STABLE AS $$
+		SELECT CASE
+		       WHEN to_regclass('public.matches_' || $1) IS NOT NULL
+		       THEN 'live'
+		       WHEN to_regclass('archive.matches_' || $1) IS NOT NULL
+		       THEN 'archived' END;
+	$$;
+
+CREATE FUNCTION archive_tournament_partitions(integer)
+	-- Detaches a tournament's partitions and moves them to the archive
+	-- schema.  Only the catalogs change; no rows are read or written.
+	RETURNS void LANGUAGE plpgsql AS $$
+	BEGIN
+		EXECUTE format('ALTER TABLE matches DETACH PARTITION public.matches_%s',
+		               $1);
+		EXECUTE format('ALTER TABLE tournament_data '
+		               'DETACH PARTITION public.tournament_data_%s', $1);
+		EXECUTE format('ALTER TABLE public.matches_%s SET SCHEMA archive', $1);
+		EXECUTE format('ALTER TABLE public.tournament_data_%s '
+		               'SET SCHEMA archive', $1);
+	END;
+	$$;
+
+CREATE FUNCTION restore_tournament_partitions(integer)
+	-- Moves an archived tournament's partitions back and attaches them.
+	-- Attaching checks that every row belongs to the tournament, without
+	-- reading them if the partitions have create_tournament_partitions()'s
+	-- CHECK constraint.
+	RETURNS void LANGUAGE plpgsql AS $$
+	BEGIN
+		EXECUTE format('ALTER TABLE archive.matches_%s SET SCHEMA public', $1);
+		EXECUTE format('ALTER TABLE archive.tournament_data_%s '
+		               'SET SCHEMA public', $1);
+		EXECUTE format('ALTER TABLE matches ATTACH PARTITION public.matches_%s '
+		               'FOR VALUES IN (%s)', $1, $1);
+		EXECUTE format('ALTER TABLE tournament_data '
+		               'ATTACH PARTITION public.tournament_data_%s '
+		               'FOR VALUES IN (%s)', $1, $1);
+	END;
+	$$;
+
+CREATE FUNCTION drop_tournament_partitions(integer)
+	-- Drops a tournament's partitions, live or archived.
+	RETURNS void LANGUAGE plpgsql AS $$
+	BEGIN
+		EXECUTE format('DROP TABLE IF EXISTS public.matches_%s, '
+		               'public.tournament_data_%s, archive.matches_%s, '
+		               'archive.tournament_data_%s', $1, $1, $1, $1);
+	END;
+	$$;
 
 CREATE VIEW current_tournament AS
 	SELECT max(tournament_id) FROM tournaments;
@@ -49,14 +185,76 @@ CREATE VIEW last_registered_player AS
 	SELECT max(player_id) FROM players;
 
 CREATE VIEW player_standings AS
-	SELECT players.player_id, players.name, tournament_data.wins, tournament_data.matches
+	-- tournament_id comes last so the standings columns keep their positions
+	SELECT players.player_id, players.name, tournament_data.wins, tournament_data.matches,
+	       tournament_data.tournament_id
 	FROM players JOIN tournament_data
 	ON (players.player_id = tournament_data.player_id);
 
+CREATE FUNCTION tournament_tiebreaks(integer)
+	-- Returns a tournament's standings with their tiebreakers, computed in a
+	-- single pass over its reported matches:
+	--   omw       opponents' match-win percentage, each floored at 1/3, with
+	--             a draw counting as half a win
+	--   buchholz  the sum of the opponents' wins
+	--   sos       strength of schedule, the average of the opponents' omw
+	-- rank orders players by points (two for a win, one for a draw) and then
+	-- each tiebreaker in turn, with player_id last so that the ranking is
+	-- total and stable.  Byes are not counted as opponents.
+	RETURNS TABLE (player_id integer, name text, wins integer, matches integer,
+	               omw numeric, buchholz bigint, sos numeric, rank bigint)
+	LANGUAGE sql STABLE AS $$
+		WITH records AS (
+			SELECT tournament_data.player_id, tournament_data.wins,
+			       tournament_data.draws, tournament_data.matches,
+			       CASE WHEN tournament_data.matches > 0
+			            THEN greatest((tournament_data.wins
+			                           + tournament_data.draws / 2.0)
+			                          / tournament_data.matches, 1.0 / 3)
+			            ELSE 1.0 / 3 END AS win_pct
+			FROM tournament_data
+			WHERE tournament_data.tournament_id = $1
+		), pairs AS (
+			SELECT player_1 AS player_id, player_2 AS opponent_id
+			FROM matches
+			WHERE tournament_id = $1 AND result IN ('win', 'loss', 'draw')
+			UNION ALL
+			SELECT player_2, player_1
+			FROM matches
+			WHERE tournament_id = $1 AND result IN ('win', 'loss', 'draw')
+		), opponents AS (
+			SELECT pairs.player_id, avg(records.win_pct) AS omw,
+			       sum(records.wins) AS buchholz
+			FROM pairs JOIN records ON (records.player_id = pairs.opponent_id)
+			GROUP BY pairs.player_id
+		), schedule AS (
+			SELECT pairs.player_id, avg(opponents.omw) AS sos
+			FROM pairs JOIN opponents ON (opponents.player_id = pairs.opponent_id)
+			GROUP BY pairs.player_id
+		), tiebreaks AS (
+			SELECT players.player_id, players.name, records.wins, records.matches,
+			       coalesce(opponents.omw, 0) AS omw,
+			       coalesce(opponents.buchholz, 0) AS buchholz,
+			       coalesce(schedule.sos, 0) AS sos,
+			       2 * records.wins + records.draws AS points
+			FROM records
+			JOIN players ON (players.player_id = records.player_id)
+			LEFT JOIN opponents ON (opponents.player_id = records.player_id)
+			LEFT JOIN schedule ON (schedule.player_id = records.player_id)
+		)
+		SELECT player_id, name, wins, matches, omw, buchholz, sos,
+		       row_number() OVER (ORDER BY points DESC, omw DESC, buchholz DESC,
+		                                   sos DESC, player_id)
+		FROM tiebreaks
+		ORDER BY 8;
+	$$;
 
-
-
-
-
-
-
+CREATE FUNCTION tournament_standings(integer)
+	-- Returns the (player_id, name, wins, matches) standings of a single
+	-- tournament in tournament_tiebreaks() rank order.
+	RETURNS TABLE (player_id integer, name text, wins integer, matches integer)
+	LANGUAGE sql STABLE AS $$
+		SELECT player_id, name, wins, matches
+		FROM tournament_tiebreaks($1)
+		ORDER BY rank;
+	$$;
@@ -0,0 +1,411 @@
+#!/usr/bin/env python3
+#
+# tournament_async.py -- asyncio API for the Swiss-system tournament
+#
+# The coroutines here mirror the public functions of tournament.py for
+# services that run on an asyncio event loop.  They go through a pool of
+# aiopg connections instead of blocking on psycopg2, and they run the very
+# same statements (tournament.STATEMENTS) and result bookkeeping as the
+# synchronous module, so both can be used against the same database.
+#
+# Requires Python 3.7 or later and aiopg.
+#
+
+from contextlib import asynccontextmanager
+import asyncio
+
+import aiopg
+import psycopg2
+
+import tournament_pairing
+import tournament_ratings
+from tournament import (DEFAULT_DSN, STANDINGS_CHANNEL, STATEMENTS,
+                        _check_repeated_report, _locked_matches,
+                        _rated_games, _rated_players, _rating_deltas,
+                        _record_deltas, _result_changes, _result_for)
+
+
+class AsyncTournamentDB(object):
+    """A pool of aiopg connections to the tournament database.
+
+    The asyncio counterpart of tournament.TournamentDB.  The pool is opened
+    on first use.  session() waits for a free connection when all maxsize
+    are busy, so hundreds of concurrent coroutines can share one pool.  If
+    the pool cannot connect, session() raises ConnectionError rather than
+    exiting the program like tournament.py does.
+
+    Args:
+        dsn: The libpq connection string for the tournament database.
+        minsize: The number of connections the pool keeps open.
+        maxsize: The most connections the pool will ever open at once.
+    """
+
+    def __init__(self, dsn=DEFAULT_DSN, minsize=1, maxsize=10):
+        self.dsn = dsn
+        self.minsize = minsize
+        self.maxsize = maxsize
+        self._pool = None
+        self._lock = None
+
+    async def _get_pool(self):
+        if self._pool is None:
+            if self._lock is None:
+                self._lock = asyncio.Lock()
+            async with self._lock:
+                if self._pool is None:
+                    try:
+                        self._pool = await aiopg.create_pool(
+                            self.dsn, minsize=self.minsize,
+                            maxsize=self.maxsize)
+                    except (psycopg2.DatabaseError,
+                            psycopg2.InterfaceError) as error:
+                        raise ConnectionError(
+                            "The program could not connect to the "
+                            "database: {0}".format(error)) from error
+        return self._pool
+
+    @asynccontextmanager
+    async def session(self, cursor=None):
+        """Yields a cursor on a pooled connection inside one transaction.
+
+        aiopg connections run in autocommit mode, so the transaction is
+        opened and closed explicitly: it is committed when the block exits
+        normally and rolled back if it raises.  If the task is cancelled
+        (or interrupted), a ROLLBACK awaited now could be cancelled in
+        turn and leave the connection mid-transaction in the pool, so the
+        connection is closed instead, which makes the server roll back.
+
+        Args:
+            cursor (optional): A cursor from a session that is already
+            open.  If given, it is yielded as-is and the enclosing session
+            stays in charge of committing.
+        """
+        if cursor is not None:
+            yield cursor
+            return
+        pool = await self._get_pool()
+        async with pool.acquire() as conn:
+            async with conn.cursor() as cursor:
+                await cursor.execute("BEGIN")
+                try:
+                    yield cursor
+                    await cursor.execute("COMMIT")
+                except asyncio.CancelledError:
+                    conn.close()
+                    raise
+                except Exception:
+                    if not conn.closed:
+                        await cursor.execute("ROLLBACK")
+                    raise
+                except BaseException:
+                    conn.close()
+                    raise
+
+    async def close(self):
+        """Closes every connection held by the pool."""
+        if self._pool is not None:
+            pool, self._pool = self._pool, None
+            pool.close()
+            await pool.wait_closed()
+
+
+_db = None
+
+def get_db():
+    """Returns the AsyncTournamentDB shared by the module-level coroutines,
+    creating it against DEFAULT_DSN on first use.
+    """
+    global _db
+    if _db is None:
+        _db = AsyncTournamentDB()
+    return _db
+
+async def configure(dsn=DEFAULT_DSN, minsize=1, maxsize=10):
+    """Replaces the shared AsyncTournamentDB with one using the given
+    settings, closing the previous pool.
+    """
+    global _db
+    if _db is not None:
+        await _db.close()
+    _db = AsyncTournamentDB(dsn, minsize, maxsize)
+    return _db
+
+
+class AsyncTournament(object):
+    """A handle on a single tournament, the asyncio counterpart of
+    tournament.Tournament.
+
+    Args:
+        tournament_id: The id of the tournament in the tournaments table.
+        db (optional): The AsyncTournamentDB to run against.  Defaults to
+        the shared one returned by get_db().
+    """
+
+    def __init__(self, tournament_id, db=None):
+        self.tournament_id = tournament_id
+        self.db = db if db is not None else get_db()
+
+    def __repr__(self):
+        return "AsyncTournament(%r)" % (self.tournament_id,)
+
+    async def count_players(self, cursor=None):
+        """Returns the number of players registered in this tournament."""
+        async with self.db.session(cursor) as cursor:
+            await cursor.execute(STATEMENTS["count_players"],
+                                 (self.tournament_id,))
+            return (await cursor.fetchone())[0]
+
+    async def register_player(self, name, email_address, cursor=None):
+        """Adds a player to the players table and to this tournament,
+        reactivating an inactive player with the same email address.
+        Returns the player's id.
+        """
+        async with self.db.session(cursor) as cursor:
+            await cursor.execute(STATEMENTS["register_player"], {
+                "name": name, "email": email_address,
+                "tournament": self.tournament_id,
+                "channel": STANDINGS_CHANNEL})
+            return (await cursor.fetchone())[0]
+
+    async def add_player(self, player_id, cursor=None):
+        """Adds a player from the players table to this tournament."""
+        async with self.db.session(cursor) as cursor:
+            await cursor.execute(STATEMENTS["add_player"],
+                                 (self.tournament_id, player_id))
+            if cursor.rowcount:
+                await _bump_standings(cursor, [self.tournament_id])
+
+    async def delete_matches(self, cursor=None):
+        """Removes this tournament's matches and resets its win records."""
+        async with self.db.session(cursor) as cursor:
+            await cursor.execute(STATEMENTS["delete_matches"],
+                                 (self.tournament_id,))
+            await cursor.execute(STATEMENTS["reset_records"],
+                                 (self.tournament_id,))
+            await _bump_standings(cursor, [self.tournament_id])
+
+    async def delete_players(self, player_id='ALL', cursor=None):
+        """Removes one player, or every player if player_id is 'ALL',
+        from this tournament.
+        """
+        async with self.db.session(cursor) as cursor:
+            if player_id == 'ALL':
+                await cursor.execute(STATEMENTS["delete_entries"],
+                                     (self.tournament_id,))
+            else:
+                await cursor.execute(STATEMENTS["delete_entry"],
+                                     (self.tournament_id, player_id))
+            if cursor.rowcount:
+                await _bump_standings(cursor, [self.tournament_id])
+
+    async def standings(self, tiebreaks=False, cursor=None, by_rating=False):
+        """Returns this tournament's standings; see
+        tournament.Tournament.standings().
+        """
+        statement = "standings_with_tiebreaks" if tiebreaks else "standings"
+        async with self.db.session(cursor) as cursor:
+            if by_rating:
+                await cursor.execute(STATEMENTS[statement + "_by_rating"],
+                                     (self.tournament_id, self.tournament_id))
+            else:
+                await cursor.execute(STATEMENTS[statement],
+                                     (self.tournament_id,))
+            return await cursor.fetchall()
+
+    async def report_match(self, winner, loser, draw=False, cursor=None):
+        """Records that winner beat loser, or that they drew; see
+        tournament.Tournament.report_match().
+        """
+        async with self.db.session(cursor) as cursor:
+            await cursor.execute(STATEMENTS["report_match"], {
+                "tournament": self.tournament_id, "winner": winner,
+                "loser": loser, "draw": bool(draw),
+                "k_factor": tournament_ratings.K_FACTOR,
+                "scale": tournament_ratings.SCALE,
+                "channel": STANDINGS_CHANNEL})
+            if await cursor.fetchone() is not None:
+                return
+            reported = await self._round_match(winner, loser, cursor)
+            if reported is None:
+                await cursor.execute(STATEMENTS["lock_pair"],
+                                     (self.tournament_id, winner, loser))
+                reported = await self._round_match(winner, loser, cursor)
+            if reported is not None and reported[2] is not None:
+                _check_repeated_report(winner, draw, *reported)
+                return
+            if reported is None:
+                await cursor.execute(STATEMENTS["insert_unpaired_match"],
+                                     (self.tournament_id, winner, loser,
+                                      self.tournament_id))
+                reported = await cursor.fetchone()
+            match_id, player_1 = reported[:2]
+            await self._record_results(
+                [(match_id, _result_for(player_1, winner, draw))], cursor)
+
+    async def _round_match(self, winner, loser, cursor):
+        """Locks and returns the pair's latest match in the current round;
+        see tournament.Tournament._round_match().
+        """
+        await cursor.execute(STATEMENTS["round_match"],
+                             (self.tournament_id, self.tournament_id,
+                              winner, loser, loser, winner))
+        return await cursor.fetchone()
+
+    async def _record_results(self, results, cursor):
+        """Stores (match_id, result) pairs and updates the players'
+        records and ratings, taking locks in the same order as the
+        synchronous module.
+        """
+        match_ids = [match_id for match_id, result in results]
+        await cursor.execute(STATEMENTS["lock_matches"],
+                             (self.tournament_id, match_ids))
+        current = _locked_matches(self.tournament_id, match_ids,
+                                  await cursor.fetchall())
+        changes, deltas = _result_changes(current, results)
+        if not changes:
+            return
+        await cursor.execute(STATEMENTS["update_results"],
+                             ([match_id for match_id, result in changes],
+                              [result for match_id, result in changes],
+                              self.tournament_id))
+        await cursor.execute(STATEMENTS["lock_records"],
+                             (self.tournament_id, sorted(deltas)))
+        await cursor.execute(STATEMENTS["update_records"],
+                             _record_deltas(self.tournament_id, deltas))
+        games = _rated_games(current, changes)
+        if games:
+            await cursor.execute(STATEMENTS["lock_ratings"],
+                                 (_rated_players(games),))
+            ratings = dict(await cursor.fetchall())
+            await cursor.execute(STATEMENTS["update_ratings"], _rating_deltas(
+                tournament_ratings.rating_changes(ratings, games)))
+        await _bump_standings(cursor, [self.tournament_id])
+
+    async def swiss_pairings(self, cursor=None, by_rating=False):
+        """Pairs this tournament's players for the next round and records
+        the pairings; see tournament.Tournament.swiss_pairings().
+
+        Pairing a large field is CPU bound, so it runs in the event loop's
+        default executor rather than on the loop itself.
+        """
+        async with self.db.session(cursor) as cursor:
+            player_data = await self.standings(cursor=cursor,
+                                               by_rating=by_rating)
+            await cursor.execute(STATEMENTS["pairing_history"],
+                                 (self.tournament_id,))
+            history = await cursor.fetchall()
+            match_ups = await asyncio.get_running_loop().run_in_executor(
+                None, _pair, player_data, history)
+            if match_ups:
+                await cursor.execute(STATEMENTS["record_pairings"], {
+                    "tournament": self.tournament_id,
+                    "players_1": [match[0] for match in match_ups],
+                    "players_2": [match[2] for match in match_ups],
+                    "bye": (match_ups[-1][0] if match_ups[-1][2] is None
+                            else None),
+                    "channel": STANDINGS_CHANNEL})
+        return match_ups
+
+
+def _pair(player_data, history):
+    """Pairs a round from its standings and the pairing_history rows; run
+    in an executor by AsyncTournament.swiss_pairings().
+    """
+    opponents, had_bye = tournament_pairing.opponent_index(history)
+    return tournament_pairing.pair_players(player_data, opponents, had_bye)
+
+async def _bump_standings(cursor, tournament_ids):
+    """Gives each tournament a new standings_version, so that standings
+    cached by tournament.py processes are read again; see
+    tournament.StandingsCache.
+    """
+    if tournament_ids:
+        await cursor.execute(STATEMENTS["bump_standings_version"],
+                             (list(tournament_ids), STANDINGS_CHANNEL))
+
+async def _resolve_tournament(tournament_id, cursor):
+    """Returns an AsyncTournament for the optional *tournament_id argument,
+    falling back to the current tournament.
+    """
+    if tournament_id:
+        return AsyncTournament(tournament_id[0])
+    return AsyncTournament(await get_current_tournament(cursor))
+
+async def get_current_tournament(cursor=None):
+    """Returns the tournament_id for the current tournament."""
+    async with get_db().session(cursor) as cursor:
+        await cursor.execute(STATEMENTS["current_tournament"])
+        return (await cursor.fetchone())[0]
+
+async def deleteMatches(*tournament_id):
+    """Removes the matches of a tournament and resets its win records; see
+    tournament.deleteMatches().
+    """
+    async with get_db().session() as cursor:
+        tournament = await _resolve_tournament(tournament_id, cursor)
+        await tournament.delete_matches(cursor)
+
+async def deletePlayers(player_id, *tournament_id):
+    """Removes player records from tournaments; see
+    tournament.deletePlayers().
+    """
+    async with get_db().session() as cursor:
+        if tournament_id and tournament_id[0] == 'ALL':
+            if player_id == 'ALL':
+                await cursor.execute(STATEMENTS["entered_tournaments"])
+                tournament_ids = [row[0] for row in await cursor.fetchall()]
+                await cursor.execute(STATEMENTS["delete_all_entries"])
+                await cursor.execute(STATEMENTS["deactivate_all_players"])
+            else:
+                await cursor.execute(STATEMENTS["player_tournaments"],
+                                     (player_id,))
+                tournament_ids = [row[0] for row in await cursor.fetchall()]
+                await cursor.execute(STATEMENTS["delete_player_entries"],
+                                     (player_id,))
+                await cursor.execute(STATEMENTS["deactivate_player"],
+                                     (player_id,))
+            await _bump_standings(cursor, tournament_ids)
+        else:
+            tournament = await _resolve_tournament(tournament_id, cursor)
+            await tournament.delete_players(player_id, cursor)
+
+async def countPlayers(*tournament_id):
+    """Returns the number of players; see tournament.countPlayers()."""
+    async with get_db().session() as cursor:
+        if tournament_id and tournament_id[0] == 'ALL':
+            await cursor.execute(STATEMENTS["count_active_players"])
+            return (await cursor.fetchone())[0]
+        tournament = await _resolve_tournament(tournament_id, cursor)
+        return await tournament.count_players(cursor)
+
+async def registerPlayer(name, email_address):
+    """Adds a player to the players table and the current tournament; see
+    tournament.registerPlayer().
+    """
+    async with get_db().session() as cursor:
+        tournament = await _resolve_tournament((), cursor)
+        return await tournament.register_player(name, email_address, cursor)
+
+async def playerStandings(tiebreaks=False, by_rating=False):
+    """Returns the current tournament's standings; see
+    tournament.playerStandings().
+    """
+    async with get_db().session() as cursor:
+        tournament = await _resolve_tournament((), cursor)
+        return await tournament.standings(tiebreaks, cursor, by_rating)
+
+async def reportMatch(winner, loser, draw=False):
+    """Records the outcome of a match in the current tournament; see
+    tournament.reportMatch().
+    """
+    async with get_db().session() as cursor:
+        tournament = await _resolve_tournament((), cursor)
+        await tournament.report_match(winner, loser, draw, cursor)
+
+async def swissPairings(by_rating=False):
+    """Pairs the current tournament's next round; see
+    tournament.swissPairings().
+    """
+    async with get_db().session() as cursor:
+        tournament = await _resolve_tournament((), cursor)
+        return await tournament.swiss_pairings(cursor, by_rating)
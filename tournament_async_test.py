@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+#
+# Test cases for tournament_async.py
+#
+# They run the coroutines against the tournament database, so they are
+# skipped when aiopg is not installed, the memory backend is selected or
+# the database cannot be reached.  Needs Python 3.7 or later.
+
+import asyncio
+import os
+
+import tournament
+
+try:
+    import tournament_async
+except ImportError:
+    tournament_async = None
+
+
+async def testAsyncRegister():
+    """
+    Test that players registered through the coroutines are counted.
+    """
+    tournament.create_tournament("Async register")
+    await tournament_async.registerPlayer("Rainbow Dash", "rdash@fake.com")
+    await tournament_async.registerPlayer("Scootaloo", "scootaloo@fake.com")
+    c = await tournament_async.countPlayers()
+    if c != 2:
+        raise ValueError(
+            "After two players register, countPlayers() should be 2. Got {c}".format(c=c))
+    print("1. Async registerPlayer() and countPlayers() agree.")
+
+async def testAsyncPairAndReport():
+    """
+    Test that a round paired and reported through the coroutines shows up
+    in the standings once, even if a result is reported twice at once.
+    """
+    tournament.create_tournament("Async rounds")
+    for i in range(4):
+        await tournament_async.registerPlayer(
+            "Async Player %d" % i, "async%d@fake.com" % i)
+    pairings = await tournament_async.swissPairings()
+    if len(pairings) != 2:
+        raise ValueError("Four players should be paired into two matches.")
+    [(id1, n1, id2, n2), (id3, n3, id4, n4)] = pairings
+    await asyncio.gather(tournament_async.reportMatch(id1, id2),
+                         tournament_async.reportMatch(id1, id2),
+                         tournament_async.reportMatch(id3, id4, draw=True))
+    records = dict((i, (w, m)) for (i, n, w, m)
+                   in await tournament_async.playerStandings())
+    if records != {id1: (1, 1), id2: (0, 1), id3: (0, 1), id4: (0, 1)}:
+        raise ValueError("Each result should be counted once. Got {r}".format(r=records))
+    if len(tournament.match_history()) != 2:
+        raise ValueError("Reporting a pairing twice should not add a match.")
+    print("2. Async swissPairings() and reportMatch() record a round.")
+
+async def testAsyncByRating():
+    """
+    Test that standings and pairings can be seeded by rating, as in the
+    synchronous module.
+    """
+    standings = await tournament_async.playerStandings(by_rating=True)
+    if len(standings[0]) != 5:
+        raise ValueError("Rated standings should end with the rating.")
+    order = [(-row[2], -row[4]) for row in standings]
+    if order != sorted(order):
+        raise ValueError("Rated standings should order equal points by rating.")
+    pairings = await tournament_async.swissPairings(by_rating=True)
+    if len(pairings) != 2:
+        raise ValueError("Pairing by rating should pair the second round.")
+    print("3. Async standings and pairings can be seeded by rating.")
+
+async def testAsyncCancel():
+    """
+    Test that a session cancelled in the middle of a statement does not
+    hand its connection back to the pool inside the transaction.
+    """
+    async def sleep():
+        async with tournament_async.get_db().session() as cursor:
+            await cursor.execute("SELECT pg_sleep(5)")
+    task = asyncio.ensure_future(sleep())
+    await asyncio.sleep(0.5)
+    task.cancel()
+    try:
+        await task
+    except asyncio.CancelledError:
+        pass
+    else:
+        raise ValueError("The cancelled session should have been cancelled.")
+    c = await tournament_async.countPlayers()
+    if c != 4:
+        raise ValueError("The pool should still serve sessions after a cancellation.")
+    print("4. A cancelled session does not leave its transaction open.")
+
+async def main():
+    try:
+        await tournament_async.get_current_tournament()
+    except ConnectionError as error:
+        print("Skipped: {e}".format(e=error))
+        return
+    try:
+        await testAsyncRegister()
+        await testAsyncPairAndReport()
+        await testAsyncByRating()
+        await testAsyncCancel()
+    finally:
+        await tournament_async.get_db().close()
+    print("Success!  All tests pass!")
+
+
+if __name__ == '__main__':
+    if tournament_async is None:
+        print("Skipped: tournament_async.py needs aiopg.")
+    elif os.environ.get(tournament.BACKEND_VARIABLE) == "memory":
+        print("Skipped: tournament_async.py has no memory backend.")
+    else:
+        asyncio.run(main())
@@ -0,0 +1,551 @@
+#!/usr/bin/env python
+#
+# tournament_bench.py -- benchmarks for tournament.py
+#
+# The benchmarks run against the tournament database configured for
+# tournament.py.  They create their own tournaments and players (with
+# @bench.invalid email addresses) and remove them again when they finish.
+# Each result is printed as one line of JSON.
+#
+
+import argparse
+import json
+import random
+import sys
+import timeit
+
+try:
+    import resource
+except ImportError:
+    resource = None
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+import tournament
+import tournament_pairing
+
+
+BENCH_EMAIL_DOMAIN = "bench.invalid"
+
+
+def _roster(size, tag):
+    """Returns size (name, email_address) pairs unique to tag."""
+    return [("Bench Player {0}".format(i),
+             "{0}-{1}@{2}".format(tag, i, BENCH_EMAIL_DOMAIN))
+            for i in range(size)]
+
+def _cleanup(tournaments):
+    """Removes the given tournaments and every benchmark player."""
+    backend = tournament.get_backend()
+    with backend.session() as cursor:
+        for t in tournaments:
+            backend.purge_tournament(t.tournament_id, cursor)
+        cursor.execute("DELETE FROM players WHERE email LIKE %s",
+                       ("%@" + BENCH_EMAIL_DOMAIN,))
+
+def _report(benchmark, **fields):
+    fields["benchmark"] = benchmark
+    print(json.dumps(fields, sort_keys=True))
+
+def bench_register(size):
+    """Compares registering size players one registerPlayer() call at a
+    time with a single registerPlayers() call.
+    """
+    tournaments = []
+    try:
+        tournaments.append(tournament.create_tournament("bench: registerPlayer"))
+        start = timeit.default_timer()
+        for name, email_address in _roster(size, "loop"):
+            tournament.registerPlayer(name, email_address)
+        loop_seconds = timeit.default_timer() - start
+
+        tournaments.append(tournament.create_tournament("bench: registerPlayers"))
+        start = timeit.default_timer()
+        tournament.registerPlayers(_roster(size, "bulk"))
+        bulk_seconds = timeit.default_timer() - start
+    finally:
+        _cleanup(tournaments)
+    _report("register", method="registerPlayer", players=size,
+            seconds=round(loop_seconds, 4))
+    _report("register", method="registerPlayers", players=size,
+            seconds=round(bulk_seconds, 4),
+            speedup=round(loop_seconds / max(bulk_seconds, 1e-9), 1))
+
+def bench_teardown(players, rounds):
+    """Tears down three copies of a tournament of players and rounds
+    rounds of matches: one with deleteMatches() and deletePlayers('ALL'),
+    one with purge_tournament() and one with archive_tournament().  Runs
+    against the database.
+    """
+    tournaments = []
+    try:
+        for method in ("delete", "purge", "archive"):
+            event = tournament.create_tournament("bench: teardown " + method)
+            tournaments.append(event)
+            event.register_players(_roster(players, "teardown-" + method))
+            with tournament.get_db().session() as cursor:
+                cursor.execute("INSERT INTO matches \
+                               (tournament_id, round, player_1, player_2, \
+                                result) \
+                               SELECT %s, r, entry.player_id, NULL, 'bye' \
+                               FROM tournament_data AS entry, \
+                                    generate_series(1, %s) AS r \
+                               WHERE entry.tournament_id = %s",
+                               (event.tournament_id, rounds,
+                                event.tournament_id))
+                rows = cursor.rowcount + players
+            start = timeit.default_timer()
+            if method == "delete":
+                tournament.deleteMatches(event.tournament_id)
+                tournament.deletePlayers('ALL', event.tournament_id)
+            elif method == "purge":
+                tournament.purge_tournament(event.tournament_id)
+                tournaments.remove(event)
+            else:
+                tournament.archive_tournament(event.tournament_id)
+            _report("teardown", method=method, rows=rows,
+                    seconds=round(timeit.default_timer() - start, 4))
+    finally:
+        _cleanup(tournaments)
+
+def bench_pairing(sizes, seed=0):
+    """Times tournament_pairing.pair_players() over full simulated Swiss
+    tournaments, one per field size, with random results.  This runs in
+    memory and does not touch the database.
+    """
+    rng = random.Random(seed)
+    for size in sizes:
+        wins = [0] * size
+        history = []
+        rounds = max(1, (size - 1).bit_length())
+        times = []
+        rematches = 0
+        for round_number in range(rounds):
+            ranking = sorted(range(size), key=lambda player: -wins[player])
+            opponents, had_bye = tournament_pairing.opponent_index(history)
+            start = timeit.default_timer()
+            match_ups = tournament_pairing.pair_players(
+                [(player, None) for player in ranking], opponents, had_bye)
+            times.append(timeit.default_timer() - start)
+            for player_1, _, player_2, _ in match_ups:
+                history.append((player_1, player_2))
+                if player_2 is None:
+                    wins[player_1] += 1
+                    continue
+                if player_2 in opponents.get(player_1, ()):
+                    rematches += 1
+                wins[rng.choice((player_1, player_2))] += 1
+        _report("pairing", players=size, rounds=rounds,
+                mean_seconds=round(sum(times) / len(times), 4),
+                max_seconds=round(max(times), 4), rematches=rematches)
+
+def _field(size, rounds, rng):
+    """Plays rounds Swiss rounds of a size player field with random results
+    and returns the (standings, match_rows) the next round is paired from.
+    """
+    wins = [0] * size
+    history = []
+    for round_number in range(rounds):
+        ranking = sorted(range(size), key=lambda player: -wins[player])
+        opponents, had_bye = tournament_pairing.opponent_index(history)
+        for player_1, _, player_2, _ in tournament_pairing.pair_players(
+                [(player, None) for player in ranking], opponents, had_bye):
+            history.append((player_1, player_2))
+            wins[player_1 if player_2 is None
+                 else rng.choice((player_1, player_2))] += 1
+    ranking = sorted(range(size), key=lambda player: -wins[player])
+    return [(player, None) for player in ranking], history
+
+def bench_parallel(tournaments, players, rounds, processes, seed=0):
+    """Times tournament_pairing.pair_fields(), which pair_tournaments()
+    uses, pairing the next round of tournaments fields of players each
+    after rounds played rounds, once per worker count in processes.  The
+    pool is started, and its start-up time reported, and given one untimed
+    batch to import the pairing code before the pairing is timed, as
+    pair_tournaments() reuses it from one call to the next.  The
+    speedup is against one process.  This runs in memory and does not
+    touch the database.
+    """
+    rng = random.Random(seed)
+    fields = [_field(players, rounds, rng) for _ in range(tournaments)]
+    serial = None
+    for count in processes:
+        start = timeit.default_timer()
+        tournament_pairing.worker_pool(count)
+        startup = timeit.default_timer() - start
+        tournament_pairing.pair_fields(fields, count)
+        start = timeit.default_timer()
+        tournament_pairing.pair_fields(fields, count)
+        seconds = timeit.default_timer() - start
+        if serial is None:
+            serial = seconds if count == 1 else None
+        _report("parallel", tournaments=tournaments, players=players,
+                rounds=rounds, processes=count, startup=round(startup, 4),
+                seconds=round(seconds, 4),
+                speedup=(round(serial / seconds, 2) if serial is not None
+                         else None))
+
+# The hot queries whose plans bench_explain() checks, with the parameters
+# they take: a tournament id and, for some, a player id.
+EXPLAIN_QUERIES = [
+    ("standings",
+     "SELECT player_id, name, wins, matches FROM tournament_standings(%(t)s)"),
+    ("count_players",
+     "SELECT count(player_id) FROM tournament_data WHERE tournament_id = %(t)s"),
+    ("next_round",
+     "SELECT coalesce(max(round), 0) + 1 FROM matches WHERE tournament_id = %(t)s"),
+    ("pairing_history",
+     "SELECT player_1, player_2 FROM matches WHERE tournament_id = %(t)s"),
+    ("report_match",
+     "UPDATE tournament_data SET wins = wins + 1, matches = matches + 1 "
+     "WHERE tournament_id = %(t)s AND player_id = %(p)s"),
+    ("delete_matches",
+     "DELETE FROM matches WHERE tournament_id = %(t)s"),
+    ("delete_player_everywhere",
+     "DELETE FROM tournament_data WHERE player_id = %(p)s"),
+]
+
+# Tables that must never be read with a sequential scan by the queries above,
+# except for the one partition of the tournament a query is about.
+EXPLAIN_LARGE_TABLES = ("tournament_data", "matches")
+
+def _plan_nodes(plan):
+    """Yields every node of an EXPLAIN (FORMAT JSON) plan tree."""
+    yield plan
+    for child in plan.get("Plans", ()):
+        for node in _plan_nodes(child):
+            yield node
+
+def bench_explain(tournaments, players, rounds):
+    """Seeds tournaments x players rows of history, checks that the hot
+    queries use indexes rather than scanning tournament_data and matches
+    (other than the partitions of the tournament they are about), and
+    rolls everything back.  Returns the number of failing queries.
+
+    Each tournament gets its own partitions, which take locks until the
+    rollback, so keep tournaments well below max_locks_per_transaction
+    times max_connections divided by ten.
+    """
+    failures = 0
+    with tournament.get_db().session() as cursor:
+        cursor.execute("INSERT INTO players (name, email) \
+                       SELECT 'Bench Player ' || i, \
+                              'explain-' || i || '@' || %s \
+                       FROM generate_series(1, %s) AS i \
+                       RETURNING player_id",
+                       (BENCH_EMAIL_DOMAIN, players))
+        player_ids = [row[0] for row in cursor.fetchall()]
+        cursor.execute("INSERT INTO tournaments (name) \
+                       SELECT 'bench: explain ' || i \
+                       FROM generate_series(1, %s) AS i \
+                       RETURNING tournament_id", (tournaments,))
+        tournament_ids = [row[0] for row in cursor.fetchall()]
+        cursor.execute("INSERT INTO tournament_data \
+                       (tournament_id, player_id, wins, matches) \
+                       SELECT t, p, (random() * %s)::integer, %s \
+                       FROM unnest(%s::integer[]) AS t, \
+                            unnest(%s::integer[]) AS p",
+                       (rounds, rounds, tournament_ids, player_ids))
+        cursor.execute("INSERT INTO matches \
+                       (tournament_id, round, player_1, player_2) \
+                       SELECT t, r, (%s::integer[])[2 * k - 1], \
+                              (%s::integer[])[2 * k] \
+                       FROM unnest(%s::integer[]) AS t, \
+                            generate_series(1, %s) AS r, \
+                            generate_series(1, %s) AS k",
+                       (player_ids, player_ids, tournament_ids, rounds,
+                        len(player_ids) // 2))
+        cursor.execute("ANALYZE players")
+        cursor.execute("ANALYZE tournament_data")
+        cursor.execute("ANALYZE matches")
+        cursor.execute("SELECT count(*) FROM tournament_data")
+        history_rows = cursor.fetchone()[0]
+        parameters = {"t": tournament_ids[len(tournament_ids) // 2],
+                      "p": player_ids[len(player_ids) // 2]}
+        for name, query in EXPLAIN_QUERIES:
+            cursor.execute("EXPLAIN (FORMAT JSON) " + query, parameters)
+            plan = cursor.fetchone()[0]
+            if not isinstance(plan, list):
+                plan = json.loads(plan)
+            nodes = list(_plan_nodes(plan[0]["Plan"]))
+            own = ["{0}_{1}".format(table, parameters["t"])
+                   for table in EXPLAIN_LARGE_TABLES]
+            seq_scans = sorted(set(
+                node["Relation Name"] for node in nodes
+                if node["Node Type"] == "Seq Scan" and
+                node.get("Relation Name", "").startswith(EXPLAIN_LARGE_TABLES)
+                and node["Relation Name"] not in own))
+            if seq_scans:
+                failures += 1
+            _report("explain", query=name, history_rows=history_rows,
+                    ok=not seq_scans, seq_scans=seq_scans,
+                    nodes=[node["Node Type"] for node in nodes],
+                    indexes=sorted(set(node["Index Name"] for node in nodes
+                                       if "Index Name" in node)))
+        cursor.connection.rollback()
+    return failures
+
+# The statements issued so far by the public functions, counted by
+# _count_queries() from the instrumentation records.
+_queries = [0]
+
+def _count_queries(record):
+    _queries[0] += record["statements"]
+
+def _memory_method():
+    """Returns how _measure() finds an operation's peak memory:
+
+    tracemalloc_peak: the peak Python allocations while it ran, on top of
+        what was allocated when it started (Python 3.9 and later, which
+        can reset the traced peak).
+    tracemalloc_delta: the same where the traced peak cannot be reset.
+        If the peak since tracing began was raised while it ran, that is
+        exact; otherwise only the growth of the allocations from start to
+        end is known, which is a lower bound.
+    ru_maxrss: how far it raised the process's peak resident size (on
+        Python 2, or with --no-memory).  Memory the process had already
+        peaked at before is reused for free, so it is often 0.
+    None: peak memory cannot be measured.
+    """
+    if tracemalloc is not None and tracemalloc.is_tracing():
+        if hasattr(tracemalloc, "reset_peak"):
+            return "tracemalloc_peak"
+        return "tracemalloc_delta"
+    if resource is not None:
+        return "ru_maxrss"
+    return None
+
+def _max_rss_bytes():
+    """Returns the process's peak resident size in bytes."""
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes.
+    return max_rss if sys.platform == "darwin" else max_rss * 1024
+
+def _measure(operation):
+    """Runs operation() and returns (result, seconds, queries, peak_bytes).
+
+    queries is None unless the statements are being counted, and
+    peak_bytes is the memory the operation took at its peak, found as
+    _memory_method() says, or None if it cannot be measured.
+    """
+    counting = isinstance(tournament.get_backend(), tournament.PostgresBackend)
+    queries = _queries[0]
+    method = _memory_method()
+    if method == "tracemalloc_peak":
+        tracemalloc.reset_peak()
+    if method in ("tracemalloc_peak", "tracemalloc_delta"):
+        memory, peak = tracemalloc.get_traced_memory()
+    elif method == "ru_maxrss":
+        memory = _max_rss_bytes()
+    start = timeit.default_timer()
+    result = operation()
+    seconds = timeit.default_timer() - start
+    peak_bytes = None
+    if method in ("tracemalloc_peak", "tracemalloc_delta"):
+        current, new_peak = tracemalloc.get_traced_memory()
+        peak_bytes = (new_peak - memory if new_peak > peak
+                      else max(current - memory, 0))
+    elif method == "ru_maxrss":
+        peak_bytes = _max_rss_bytes() - memory
+    return (result, seconds,
+            _queries[0] - queries if counting else None,
+            peak_bytes)
+
+def bench_simulate(sizes, rounds=None, batch=False, trace_memory=True,
+                   seed=0):
+    """Runs a full Swiss tournament per field size through the public
+    functions: registerPlayers() and then, every round, swissPairings(),
+    reportMatch() for each pairing (or one reportMatches() with batch) and
+    playerStandings().  Prints one line per operation and round with its
+    wall time, the queries it issued and its peak memory, then a summary
+    line per operation.
+
+    The functions run against the storage backend returned by
+    tournament.get_backend(), so TOURNAMENT_BACKEND=memory simulates
+    without the database.  Queries are only counted for PostgreSQL.
+    """
+    tournament.enable_instrumentation(_count_queries)
+    if trace_memory and tracemalloc is not None:
+        tracemalloc.start()
+    rng = random.Random(seed)
+    backend = type(tournament.get_backend()).__name__
+    _report("simulate", backend=backend, memory_method=_memory_method())
+    for size in sizes:
+        tournaments = []
+        totals = {}
+        def record(operation, round_number, calls, measured):
+            result, seconds, queries, peak_bytes = measured
+            total = totals.setdefault(operation, {
+                "calls": 0, "seconds": 0.0, "queries": 0, "peak_bytes": 0})
+            total["calls"] += calls
+            total["seconds"] += seconds
+            total["queries"] = (None if queries is None or
+                                total["queries"] is None
+                                else total["queries"] + queries)
+            total["peak_bytes"] = (None if peak_bytes is None
+                                   else max(total["peak_bytes"], peak_bytes))
+            _report("simulate", backend=backend, players=size,
+                    operation=operation, round=round_number, calls=calls,
+                    seconds=round(seconds, 4), queries=queries,
+                    peak_bytes=peak_bytes)
+            return result
+        try:
+            tournaments.append(tournament.create_tournament(
+                "bench: simulate {0}".format(size)))
+            record("registerPlayers", 0, 1, _measure(
+                lambda: tournament.registerPlayers(
+                    _roster(size, "simulate-{0}".format(size)))))
+            for round_number in range(
+                    1, (rounds or max(1, (size - 1).bit_length())) + 1):
+                match_ups = record("swissPairings", round_number, 1, _measure(
+                    tournament.swissPairings))
+                results = [rng.choice(((id1, id2), (id2, id1)))
+                           for id1, name1, id2, name2 in match_ups
+                           if id2 is not None]
+                if batch:
+                    record("reportMatches", round_number, 1, _measure(
+                        lambda: tournament.reportMatches(results)))
+                else:
+                    def report_round():
+                        for winner, loser in results:
+                            tournament.reportMatch(winner, loser)
+                    record("reportMatch", round_number, len(results),
+                           _measure(report_round))
+                record("playerStandings", round_number, 1, _measure(
+                    tournament.playerStandings))
+        finally:
+            if isinstance(tournament.get_backend(),
+                          tournament.PostgresBackend):
+                _cleanup(tournaments)
+        for operation in sorted(totals):
+            total = totals[operation]
+            _report("simulate", backend=backend, players=size,
+                    operation=operation, round="all", calls=total["calls"],
+                    seconds=round(total["seconds"], 4),
+                    mean_seconds=round(total["seconds"] /
+                                       max(total["calls"], 1), 6),
+                    queries=total["queries"], peak_bytes=total["peak_bytes"])
+    tournament.disable_instrumentation()
+    if resource is not None:
+        _report("simulate", backend=backend, sizes=sizes,
+                max_rss_kb=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+
+def bench_roundtrips(players, rounds):
+    """Plays a tournament of players for rounds rounds through
+    registerPlayer(), swissPairings(), reportMatch() and playerStandings(),
+    once with the hot statements prepared and once without, and reports
+    the round trips, statements and latency of each operation per call.
+    Runs against the database.
+    """
+    dsn = tournament.get_db().dsn
+    for prepare in (False, True):
+        tournament.configure(dsn, prepare=prepare)
+        records = []
+        tournaments = []
+        tournament.enable_instrumentation(records.append)
+        try:
+            tournaments.append(tournament.create_tournament(
+                "bench: roundtrips"))
+            for name, email_address in _roster(players, "roundtrips"):
+                tournament.registerPlayer(name, email_address)
+            for round_number in range(rounds):
+                for id1, name1, id2, name2 in tournament.swissPairings():
+                    if id2 is not None:
+                        tournament.reportMatch(id1, id2)
+                tournament.playerStandings()
+        finally:
+            tournament.disable_instrumentation()
+            _cleanup(tournaments)
+        totals = {}
+        for record in records:
+            total = totals.setdefault(record["operation"], {
+                "calls": 0, "round_trips": 0, "statements": 0,
+                "seconds": 0.0, "db_seconds": 0.0})
+            total["calls"] += 1
+            for key in ("round_trips", "statements", "seconds", "db_seconds"):
+                total[key] += record[key]
+        for operation in sorted(totals):
+            total = totals[operation]
+            calls = total["calls"]
+            _report("roundtrips", prepared=prepare, operation=operation,
+                    calls=calls,
+                    round_trips=round(total["round_trips"] / float(calls), 2),
+                    statements=round(total["statements"] / float(calls), 2),
+                    mean_seconds=round(total["seconds"] / calls, 6),
+                    mean_db_seconds=round(total["db_seconds"] / calls, 6))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmarks for tournament.py")
+    commands = parser.add_subparsers(dest="command")
+    register = commands.add_parser(
+        "register", help="registerPlayer() loop against registerPlayers()")
+    register.add_argument("--players", type=int, default=5000)
+    pairing = commands.add_parser(
+        "pairing", help="swiss pairing engine across field sizes (no database)")
+    pairing.add_argument("--sizes", type=int, nargs="+",
+                         default=[64, 1000, 10000, 100000])
+    parallel = commands.add_parser(
+        "parallel", help="pairing many tournaments in a process pool "
+        "across worker counts (no database)")
+    parallel.add_argument("--tournaments", type=int, default=32)
+    parallel.add_argument("--players", type=int, default=2000)
+    parallel.add_argument("--rounds", type=int, default=4,
+                          help="rounds already played before the one paired")
+    parallel.add_argument("--processes", type=int, nargs="+",
+                          default=[1, 2, 4, 8])
+    teardown = commands.add_parser(
+        "teardown", help="delete a tournament's rows against purging or "
+        "archiving its partitions")
+    teardown.add_argument("--players", type=int, default=10000)
+    teardown.add_argument("--rounds", type=int, default=10)
+    explain = commands.add_parser(
+        "explain", help="check the hot queries use indexes at scale "
+        "(seeds history and rolls it back)")
+    explain.add_argument("--tournaments", type=int, default=100)
+    explain.add_argument("--players", type=int, default=10000)
+    explain.add_argument("--rounds", type=int, default=2)
+    roundtrips = commands.add_parser(
+        "roundtrips", help="round trips and latency per call of the hot "
+        "operations, with and without prepared statements")
+    roundtrips.add_argument("--players", type=int, default=64)
+    roundtrips.add_argument("--rounds", type=int, default=6)
+    simulate = commands.add_parser(
+        "simulate", help="full Swiss tournaments through the public "
+        "functions: time, queries and peak memory per operation")
+    simulate.add_argument("--sizes", type=int, nargs="+",
+                          default=[64, 1000, 10000, 100000])
+    simulate.add_argument("--rounds", type=int, default=None,
+                          help="rounds per tournament (default: enough to "
+                          "find a single winner)")
+    simulate.add_argument("--batch", action="store_true",
+                          help="report each round with reportMatches()")
+    simulate.add_argument("--no-memory", dest="trace_memory",
+                          action="store_false",
+                          help="do not trace allocations, which slows "
+                          "Python down")
+    args = parser.parse_args(argv)
+    if args.command == "register":
+        bench_register(args.players)
+    elif args.command == "pairing":
+        bench_pairing(args.sizes)
+    elif args.command == "parallel":
+        bench_parallel(args.tournaments, args.players, args.rounds,
+                       args.processes)
+    elif args.command == "teardown":
+        bench_teardown(args.players, args.rounds)
+    elif args.command == "roundtrips":
+        bench_roundtrips(args.players, args.rounds)
+    elif args.command == "simulate":
+        bench_simulate(args.sizes, args.rounds, args.batch, args.trace_memory)
+    elif args.command == "explain":
+        if bench_explain(args.tournaments, args.players, args.rounds):
+            sys.exit(1)
+    else:
+        parser.print_help()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,704 @@
+#!/usr/bin/env python
+#
+# tournament_memory.py -- in-memory storage backend for tournament.py
+#
+# MemoryBackend keeps players, tournaments and matches in Python lists
+# indexed by their ids, with dicts for the lookups the SQL schema indexes,
+# and follows the same rules as the tournament database: ids are handed
+# out in order and never reused, results are stored on matches from
+# player_1's point of view, and standings are ranked by the tiebreakers of
+# tournament_tiebreaks().  It is meant for simulations, load tests and
+# running tournament_test.py without a database:
+#
+#     TOURNAMENT_BACKEND=memory python tournament_test.py
+#
+# Nothing is persisted; the data lives as long as the backend does.
+#
+
+from contextlib import contextmanager
+import bisect
+import datetime
+import threading
+
+import tournament_pairing
+import tournament_ratings
+from tournament import (DEFAULT_BATCH_SIZE, StorageBackend, Tournament,
+                        _check_repeated_report, _locked_matches, _page,
+                        _rated_games, _registration_outcomes,
+                        _result_changes, _result_for, _result_records)
+
+
+# Tiebreakers are compared after rounding to this many decimal places, so
+# averages that are equal in the database's exact arithmetic also tie here.
+TIEBREAK_PLACES = 12
+
+
+class _Player(object):
+    """A row of the players table."""
+
+    __slots__ = ("name", "email", "active", "rating", "rated_games")
+
+    def __init__(self, name, email):
+        self.name = name
+        self.email = email
+        self.active = 'yes'
+        self.rating = tournament_ratings.DEFAULT_RATING
+        self.rated_games = 0
+
+
+class _Event(object):
+    """A row of the tournaments table, together with its tournament_data
+    entries (by player_id), the ids of its matches in the order they were
+    added, the match ids of each pairing (by the frozenset of its two
+    players) and its latest round.  While the tournament is archived,
+    archive holds its (entries, matches, pairings, last_round), where
+    matches are (match_id, _Match) pairs, and the live fields are empty.
+    writes counts the changes to its entries and matches, standing in for
+    the tournaments.standings_version column.
+    """
+
+    __slots__ = ("name", "date_started", "entries", "match_ids", "pairings",
+                 "last_round", "archive", "writes")
+
+    def __init__(self, name):
+        self.name = name
+        self.date_started = datetime.datetime.now()
+        self.entries = {}
+        self.match_ids = []
+        self.pairings = {}
+        self.last_round = None
+        self.archive = None
+        self.writes = 0
+
+    def clear_matches(self):
+        del self.match_ids[:]
+        self.pairings.clear()
+        self.last_round = None
+
+
+class _Entry(object):
+    """A player's record in one tournament."""
+
+    __slots__ = ("wins", "draws", "matches")
+
+    def __init__(self):
+        self.wins = 0
+        self.draws = 0
+        self.matches = 0
+
+
+class _Match(object):
+    """A row of the matches table."""
+
+    __slots__ = ("tournament_id", "round", "player_1", "player_2", "result",
+                 "version")
+
+    def __init__(self, tournament_id, round_number, player_1, player_2,
+                 result=None):
+        self.tournament_id = tournament_id
+        self.round = round_number
+        self.player_1 = player_1
+        self.player_2 = player_2
+        self.result = result
+        self.version = 0
+
+
+class MemoryBackend(StorageBackend):
+    """A storage backend that keeps every tournament in process memory.
+
+    players, tournaments and matches are lists indexed by id, with None in
+    the slots of deleted rows, so ids are never reused.  One reentrant lock
+    guards all of them: session() holds it for the whole unit of work, which
+    makes every module-level call atomic with respect to other threads.
+    Operations check their input before they change anything, so a call
+    that raises leaves the data as it was, as a rolled back transaction
+    would.
+    """
+
+    def __init__(self):
+        self.players = [None]
+        self.emails = {}
+        self.tournaments = [None]
+        self.matches = [None]
+        self._lock = threading.RLock()
+
+    def __repr__(self):
+        return "MemoryBackend()"
+
+    @contextmanager
+    def session(self, cursor=None):
+        """Yields a cursor while holding the backend's lock.  The cursor
+        only marks the session; the tournament methods do not use it.
+        """
+        with self._lock:
+            yield cursor if cursor is not None else self
+
+    def connect(self):
+        raise NotImplementedError(
+            "The memory backend has no SQL connection; use the tournament "
+            "functions instead of connect().")
+
+    def tournament(self, tournament_id):
+        return MemoryTournament(tournament_id, self)
+
+    def create_tournament(self, name, cursor=None):
+        with self.session(cursor):
+            self.tournaments.append(_Event(name))
+            return self.tournament(len(self.tournaments) - 1)
+
+    def lookup_tournament(self, tournament_id, cursor=None):
+        with self.session(cursor):
+            if self.event(tournament_id) is None:
+                raise ValueError(
+                    "There is no tournament with id {0}.".format(tournament_id))
+        return self.tournament(tournament_id)
+
+    def current_tournament(self, cursor=None):
+        with self.session(cursor):
+            for tournament_id in range(len(self.tournaments) - 1, 0, -1):
+                if self.tournaments[tournament_id] is not None:
+                    return tournament_id
+        return None
+
+    def count_active_players(self, cursor=None):
+        with self.session(cursor):
+            return sum(1 for player in self.players
+                       if player is not None and player.active == 'yes')
+
+    def deactivate_players(self, player_id='ALL', cursor=None):
+        with self.session(cursor):
+            for event in self.tournaments:
+                if event is None:
+                    continue
+                if player_id == 'ALL':
+                    event.entries.clear()
+                else:
+                    event.entries.pop(player_id, None)
+                event.writes += 1
+            if player_id == 'ALL':
+                for player in self.players:
+                    if player is not None:
+                        player.active = 'no'
+            elif self.player(player_id) is not None:
+                self.players[player_id].active = 'no'
+
+    def match_tournament(self, match_id, cursor=None):
+        with self.session(cursor):
+            match = self.match(match_id)
+            if match is None:
+                raise ValueError(
+                    "There is no match with id {0}.".format(match_id))
+            return match.tournament_id
+
+    def pairing_fields(self, tournament_ids, cursor=None, by_rating=False):
+        with self.session(cursor) as cursor:
+            fields = {}
+            for tournament_id in tournament_ids:
+                handle = self.tournament(tournament_id)
+                event = handle._event(required=True)
+                fields[tournament_id] = (
+                    (event.last_round or 0) + 1,
+                    handle.standings(cursor=cursor, by_rating=by_rating),
+                    [(match.player_1, match.player_2)
+                     for match_id, match in handle._matches(event)])
+            return fields
+
+    def record_pairings(self, rounds, cursor=None):
+        with self.session(cursor):
+            for tournament_id, round_number, match_ups in rounds:
+                for player_1, name_1, player_2, name_2 in match_ups:
+                    self.add_match(tournament_id, round_number, player_1,
+                                   player_2, 'bye' if player_2 is None else None)
+                if match_ups and match_ups[-1][2] is None:
+                    entry = self.event(tournament_id).entries.get(
+                        match_ups[-1][0])
+                    if entry is not None:
+                        entry.wins += 1
+                        entry.matches += 1
+
+    def rebuild_ratings(self, k_factor=None, cursor=None):
+        with self.session(cursor):
+            ratings = tournament_ratings.recompute(
+                ((match.tournament_id, match.round, match.player_1,
+                  match.player_2, match.result)
+                 for match in self.matches if match is not None), k_factor)
+            for player_id, player in enumerate(self.players):
+                if player is not None:
+                    player.rating, player.rated_games = ratings.get(
+                        player_id, (tournament_ratings.DEFAULT_RATING, 0))
+
+    def archive_tournament(self, tournament_id, cursor=None):
+        with self.session(cursor):
+            event = self._stored_event(tournament_id, 'live')
+            event.archive = (event.entries,
+                             [(match_id, self.matches[match_id])
+                              for match_id in event.match_ids],
+                             event.pairings, event.last_round)
+            for match_id in event.match_ids:
+                self.matches[match_id] = None
+            event.entries = {}
+            event.match_ids = []
+            event.pairings = {}
+            event.last_round = None
+            event.writes += 1
+
+    def restore_tournament(self, tournament_id, cursor=None):
+        with self.session(cursor):
+            event = self._stored_event(tournament_id, 'archived')
+            entries, matches, pairings, last_round = event.archive
+            for match_id, match in matches:
+                self.matches[match_id] = match
+            event.entries = entries
+            event.match_ids = [match_id for match_id, match in matches]
+            event.pairings = pairings
+            event.last_round = last_round
+            event.archive = None
+            event.writes += 1
+
+    def purge_tournament(self, tournament_id, cursor=None):
+        with self.session(cursor):
+            event = self.event(tournament_id)
+            if event is None:
+                raise ValueError(
+                    "There is no tournament with id {0}.".format(tournament_id))
+            for match_id in event.match_ids:
+                self.matches[match_id] = None
+            self.tournaments[tournament_id] = None
+
+    def _stored_event(self, tournament_id, storage):
+        """Returns the _Event with tournament_id, raising ValueError unless
+        it is storage, 'live' or 'archived'.
+        """
+        event = self.event(tournament_id)
+        found = None
+        if event is not None:
+            found = 'live' if event.archive is None else 'archived'
+        if found is None:
+            raise ValueError(
+                "There is no tournament with id {0}.".format(tournament_id))
+        if found != storage:
+            raise ValueError("Tournament {0} is {1}, not {2}.".format(
+                tournament_id, found, storage))
+        return event
+
+    def player_ratings(self, cursor=None):
+        with self.session(cursor):
+            rows = [(player_id, player.name, player.rating,
+                     player.rated_games)
+                    for player_id, player in enumerate(self.players)
+                    if player is not None and player.active == 'yes']
+        rows.sort(key=lambda row: (-row[2], row[0]))
+        return rows
+
+    def player(self, player_id):
+        """Returns the _Player with player_id, or None."""
+        return _row(self.players, player_id)
+
+    def event(self, tournament_id):
+        """Returns the _Event with tournament_id, or None."""
+        return _row(self.tournaments, tournament_id)
+
+    def match(self, match_id):
+        """Returns the _Match with match_id, or None."""
+        return _row(self.matches, match_id)
+
+    def upsert_player(self, name, email_address):
+        """Adds a player, or reactivates the player with email_address.
+        Returns the player_id and the player's previous active flag, which
+        is None for a new player.
+        """
+        player_id = self.emails.get(email_address)
+        if player_id is None:
+            self.players.append(_Player(name, email_address))
+            player_id = len(self.players) - 1
+            self.emails[email_address] = player_id
+            return player_id, None
+        player = self.players[player_id]
+        previously, player.active = player.active, 'yes'
+        return player_id, previously
+
+    def add_match(self, tournament_id, round_number, player_1, player_2,
+                  result=None):
+        """Adds a match to a tournament and returns its match_id."""
+        self.matches.append(_Match(tournament_id, round_number, player_1,
+                                   player_2, result))
+        match_id = len(self.matches) - 1
+        event = self.event(tournament_id)
+        event.match_ids.append(match_id)
+        event.pairings.setdefault(frozenset((player_1, player_2)),
+                                  []).append(match_id)
+        event.last_round = max(event.last_round or 0, round_number)
+        event.writes += 1
+        return match_id
+
+
+def _row(rows, row_id):
+    """Returns rows[row_id] for a positive id in range, or None."""
+    if isinstance(row_id, int) and 0 < row_id < len(rows):
+        return rows[row_id]
+    return None
+
+
+class MemoryTournament(Tournament):
+    """A handle on a tournament kept by a MemoryBackend, with the methods
+    of Tournament.  The cursor arguments are accepted for compatibility and
+    only join the session they come from.
+
+    Args:
+        tournament_id: The id of the tournament.
+        db: The MemoryBackend that holds it.
+    """
+
+    def __repr__(self):
+        return "MemoryTournament(%r)" % (self.tournament_id,)
+
+    @classmethod
+    def create(cls, name, db=None, cursor=None):
+        return db.create_tournament(name, cursor)
+
+    @classmethod
+    def lookup(cls, tournament_id, db=None, cursor=None):
+        return db.lookup_tournament(tournament_id, cursor)
+
+    @classmethod
+    def current(cls, db=None, cursor=None):
+        return cls(db.current_tournament(cursor), db)
+
+    def _event(self, required=False):
+        event = self.db.event(self.tournament_id)
+        if event is None and required:
+            raise ValueError("There is no tournament with id {0}.".format(
+                self.tournament_id))
+        return event
+
+    def _matches(self, event):
+        """Returns (match_id, _Match) pairs for event in match_id order."""
+        if event is None:
+            return []
+        return [(match_id, self.db.matches[match_id])
+                for match_id in event.match_ids]
+
+    def count_players(self, cursor=None):
+        with self.db.session(cursor):
+            event = self._event()
+            return len(event.entries) if event is not None else 0
+
+    def register_player(self, name, email_address, cursor=None):
+        with self.db.session(cursor) as cursor:
+            self._event(required=True)
+            player_id, previously = self.db.upsert_player(name, email_address)
+            self.add_player(player_id, cursor)
+        return player_id
+
+    def register_players(self, players, cursor=None):
+        players = list(players)
+        player_ids = {}
+        previously = {}
+        entered = set()
+        with self.db.session(cursor):
+            event = self._event(required=True)
+            for name, email_address in players:
+                if email_address in player_ids:
+                    continue
+                player_id, active = self.db.upsert_player(name, email_address)
+                player_ids[email_address] = player_id
+                previously[email_address] = active
+                if player_id not in event.entries:
+                    event.entries[player_id] = _Entry()
+                    event.writes += 1
+                    entered.add(player_id)
+        return _registration_outcomes(players, player_ids, previously, entered)
+
+    def add_player(self, player_id, cursor=None):
+        with self.db.session(cursor):
+            event = self._event(required=True)
+            if self.db.player(player_id) is None:
+                raise ValueError(
+                    "There is no player with id {0}.".format(player_id))
+            if player_id not in event.entries:
+                event.entries[player_id] = _Entry()
+                event.writes += 1
+
+    def delete_matches(self, cursor=None):
+        with self.db.session(cursor):
+            event = self._event()
+            if event is None:
+                return
+            for match_id in event.match_ids:
+                self.db.matches[match_id] = None
+            event.clear_matches()
+            for entry in event.entries.values():
+                entry.wins = entry.draws = entry.matches = 0
+            event.writes += 1
+
+    def delete_players(self, player_id='ALL', cursor=None):
+        with self.db.session(cursor):
+            event = self._event()
+            if event is None:
+                return
+            if player_id == 'ALL':
+                event.entries.clear()
+            else:
+                event.entries.pop(player_id, None)
+            event.writes += 1
+
+    def standings(self, tiebreaks=False, cursor=None, cached=True,
+                  by_rating=False):
+        """Returns this tournament's standings, ranked exactly as the
+        tournament_tiebreaks() SQL function ranks them.
+        """
+        with self.db.session(cursor):
+            event = self._event()
+            if event is None:
+                return []
+            entries = event.entries
+            win_pct = {}
+            for player_id, entry in entries.items():
+                if entry.matches > 0:
+                    win_pct[player_id] = max(
+                        (entry.wins + entry.draws / 2.0) / entry.matches,
+                        1.0 / 3)
+                else:
+                    win_pct[player_id] = 1.0 / 3
+            # Opponents are counted once per reported match, and only if
+            # they are still entered, as in the SQL pairs and records join.
+            pairs = {}
+            for match_id, match in self._matches(event):
+                if match.result in ('win', 'loss', 'draw'):
+                    pairs.setdefault(match.player_1, []).append(match.player_2)
+                    pairs.setdefault(match.player_2, []).append(match.player_1)
+            omw = {}
+            buchholz = {}
+            for player_id, opponents in pairs.items():
+                entered = [opponent for opponent in opponents
+                           if opponent in entries]
+                if entered:
+                    omw[player_id] = (sum(win_pct[opponent]
+                                          for opponent in entered) /
+                                      len(entered))
+                    buchholz[player_id] = sum(entries[opponent].wins
+                                              for opponent in entered)
+            sos = {}
+            for player_id, opponents in pairs.items():
+                scheduled = [omw[opponent] for opponent in opponents
+                             if opponent in omw]
+                if scheduled:
+                    sos[player_id] = sum(scheduled) / len(scheduled)
+            rows = []
+            for player_id, entry in entries.items():
+                rows.append((player_id, self.db.players[player_id].name,
+                             entry.wins, entry.matches,
+                             omw.get(player_id, 0.0),
+                             buchholz.get(player_id, 0),
+                             sos.get(player_id, 0.0),
+                             2 * entry.wins + entry.draws,
+                             self.db.players[player_id].rating))
+        rows.sort(key=lambda row: (-row[7],
+                                   -round(row[4], TIEBREAK_PLACES),
+                                   -row[5],
+                                   -round(row[6], TIEBREAK_PLACES),
+                                   row[0]))
+        columns = 7 if tiebreaks else 4
+        if by_rating:
+            rows.sort(key=lambda row: (-row[7], -row[8]))
+            return [row[:columns] + row[8:] for row in rows]
+        return [row[:columns] for row in rows]
+
+    def report_match(self, winner, loser, draw=False, cursor=None):
+        with self.db.session(cursor) as cursor:
+            event = self._event(required=True)
+            open_match = None
+            for match_id in event.pairings.get(frozenset((winner, loser)), ()):
+                match = self.db.matches[match_id]
+                if match.result is None and (
+                        open_match is None or
+                        match.round >= open_match[1].round):
+                    open_match = (match_id, match)
+            if open_match is None:
+                for match_id in reversed(event.pairings.get(
+                        frozenset((winner, loser)), [])):
+                    match = self.db.matches[match_id]
+                    if match.round == event.last_round:
+                        _check_repeated_report(winner, draw, match_id,
+                                               match.player_1, match.result)
+                        return
+                match_id = self.db.add_match(self.tournament_id,
+                                             event.last_round or 1,
+                                             winner, loser)
+                open_match = (match_id, self.db.matches[match_id])
+            match_id, match = open_match
+            self._record_results(
+                [(match_id, _result_for(match.player_1, winner, draw))],
+                cursor)
+
+    def report_matches(self, results, cursor=None):
+        results = list(results)
+        winners = [winner for winner, loser in results]
+        losers = [loser for winner, loser in results]
+        if len(set(winners + losers)) != 2 * len(results):
+            raise ValueError("Each player can only be reported once per round.")
+        if not results:
+            return
+        with self.db.session(cursor) as cursor:
+            event = self._event()
+            recorded = []
+            unpaired = []
+            for winner, loser in results:
+                open_match = None
+                if event is not None:
+                    for match_id in event.pairings.get(
+                            frozenset((winner, loser)), ()):
+                        match = self.db.matches[match_id]
+                        if (match.round == event.last_round and
+                                match.result is None):
+                            open_match = (match_id, match.player_1)
+                if open_match is None:
+                    unpaired.append((winner, loser))
+                else:
+                    match_id, player_1 = open_match
+                    recorded.append((match_id, _result_for(player_1, winner)))
+            if unpaired:
+                raise ValueError(
+                    "These results are not open pairings of the current "
+                    "round: {0}".format(unpaired))
+            self._record_results(recorded, cursor, only_open=True)
+
+    def _lock_matches(self, match_ids, cursor):
+        rows = []
+        for match_id in sorted(set(match_ids)):
+            match = self.db.match(match_id)
+            if match is not None and match.tournament_id == self.tournament_id:
+                rows.append((match_id, match.player_1, match.player_2,
+                             match.result, match.version))
+        return _locked_matches(self.tournament_id, match_ids, rows)
+
+    def _record_results(self, results, cursor, current=None,
+                        only_open=False):
+        with self.db.session(cursor):
+            if current is None:
+                current = self._lock_matches(
+                    [match_id for match_id, result in results], cursor)
+            changes, deltas = _result_changes(current, results, only_open)
+            if not changes:
+                return
+            for match_id, result in changes:
+                match = self.db.matches[match_id]
+                match.result = result
+                match.version += 1
+            event = self._event(required=True)
+            event.writes += 1
+            entries = event.entries
+            for player_id, (wins, draws, matches) in deltas.items():
+                entry = entries.get(player_id)
+                if entry is not None:
+                    entry.wins += wins
+                    entry.draws += draws
+                    entry.matches += matches
+            games = _rated_games(current, changes)
+            players = self.db.players
+            ratings = tournament_ratings.rating_changes(
+                dict((player_id, players[player_id].rating)
+                     for game in games for player_id in game[:2]), games)
+            for player_id, (rating, rated_games) in ratings.items():
+                players[player_id].rating += rating
+                players[player_id].rated_games += rated_games
+
+    def rebuild_standings(self, cursor=None):
+        with self.db.session(cursor):
+            event = self._event()
+            if event is None:
+                return
+            records = {}
+            for match_id, match in self._matches(event):
+                for player_id, record in zip(
+                        (match.player_1, match.player_2),
+                        _result_records(match.result)):
+                    total = records.setdefault(player_id, [0, 0, 0])
+                    for column in range(3):
+                        total[column] += record[column]
+            for player_id, entry in event.entries.items():
+                entry.wins, entry.draws, entry.matches = records.get(
+                    player_id, (0, 0, 0))
+            event.writes += 1
+
+    def match_history(self, round_number=None, cursor=None):
+        with self.db.session(cursor):
+            return [(match_id, match.round, match.player_1, match.player_2,
+                     match.result, match.version)
+                    for match_id, match in self._matches(self._event())
+                    if round_number is None or match.round == round_number]
+
+    def stream_standings(self, tiebreaks=False,
+                         batch_size=DEFAULT_BATCH_SIZE, cursor=None):
+        with self.db.session(cursor) as cursor:
+            rows = self.standings(tiebreaks, cursor)
+        for row in rows:
+            yield row
+
+    def stream_pairings(self, round_number=None,
+                        batch_size=DEFAULT_BATCH_SIZE, cursor=None):
+        with self.db.session(cursor):
+            event = self._event()
+            if round_number is None and event is not None:
+                round_number = event.last_round
+            players = self.db.players
+            rows = [(match.player_1, players[match.player_1].name,
+                     match.player_2,
+                     players[match.player_2].name
+                     if match.player_2 is not None else None)
+                    for match_id, match in self._matches(event)
+                    if match.round == round_number]
+        for row in rows:
+            yield row
+
+    def stream_history(self, round_number=None,
+                       batch_size=DEFAULT_BATCH_SIZE, cursor=None):
+        for row in self.match_history(round_number, cursor):
+            yield row
+
+    def standings_page(self, after=0, limit=DEFAULT_BATCH_SIZE,
+                       tiebreaks=False, cursor=None):
+        with self.db.session(cursor) as cursor:
+            event = self._event()
+            version = event.writes if event is not None else None
+            start = after[0] if after else 0
+            rows = self.standings(True, cursor)[start:start + limit + 1]
+        return _page([tuple(row) + (start + index + 1, version)
+                      for index, row in enumerate(rows)],
+                     after, limit, tiebreaks)
+
+    def history_page(self, after_match_id=0, limit=DEFAULT_BATCH_SIZE,
+                     round_number=None, cursor=None):
+        with self.db.session(cursor):
+            event = self._event()
+            match_ids = event.match_ids if event is not None else []
+            start = bisect.bisect_right(match_ids, after_match_id)
+            rows = []
+            for match_id in match_ids[start:]:
+                if len(rows) == limit:
+                    break
+                match = self.db.matches[match_id]
+                if round_number is None or match.round == round_number:
+                    rows.append((match_id, match.round, match.player_1,
+                                 match.player_2, match.result, match.version))
+        return rows, rows[-1][0] if len(rows) == limit else None
+
+    def swiss_pairings(self, cursor=None, by_rating=False):
+        with self.db.session(cursor) as cursor:
+            event = self._event(required=True)
+            matches = self._matches(event)
+            next_round = (event.last_round or 0) + 1
+            player_data = self.standings(cursor=cursor, by_rating=by_rating)
+            opponents, had_bye = tournament_pairing.opponent_index(
+                (match.player_1, match.player_2) for match_id, match in matches)
+            match_ups = tournament_pairing.pair_players(
+                player_data, opponents, had_bye)
+            for player_1, name_1, player_2, name_2 in match_ups:
+                self.db.add_match(self.tournament_id, next_round, player_1,
+                                  player_2, 'bye' if player_2 is None else None)
+            if match_ups and match_ups[-1][2] is None:
+                entry = event.entries.get(match_ups[-1][0])
+                if entry is not None:
+                    entry.wins += 1
+                    entry.matches += 1
+        return match_ups
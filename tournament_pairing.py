@@ -0,0 +1,281 @@
+#!/usr/bin/env python
+#
+# tournament_pairing.py -- Swiss pairing engine for tournament.py
+#
+# The engine works purely in memory: it takes the standings in ranking
+# order and an index of who has already played whom, and returns the next
+# round's pairings.  It does not touch the database.
+#
+
+import atexit
+import multiprocessing
+import threading
+
+DEFAULT_MAX_STEPS = 200000
+
+# Below this many players in all the fields are paired in process: they pair
+# in a few tens of milliseconds, about what pickling them to the workers and
+# back costs.  No speedup above it has been measured yet; only slowdowns on a
+# single CPU (see tournament_bench.py parallel).
+PARALLEL_MIN_PLAYERS = 20000
+
+_pool = None
+_pool_processes = 0
+_pool_lock = threading.Lock()
+
+
+def opponent_index(match_rows):
+    """Builds the opponent-set index used by pair_players().
+
+    Args:
+        match_rows: An iterable of (player_1, player_2) rows from the
+        matches table.  A row whose player_2 is None is a bye.
+
+    Returns:
+        A tuple (opponents, had_bye) where opponents maps each player_id to
+        the set of players they have already been paired with and had_bye
+        is the set of players who have already received a bye.
+    """
+    opponents = {}
+    had_bye = set()
+    for player_1, player_2 in match_rows:
+        if player_2 is None:
+            had_bye.add(player_1)
+            continue
+        opponents.setdefault(player_1, set()).add(player_2)
+        opponents.setdefault(player_2, set()).add(player_1)
+    return opponents, had_bye
+
+def _choose_bye(ids, had_bye):
+    """Returns the index of the lowest ranked player without a bye, or of
+    the lowest ranked player if everyone has had one.
+    """
+    for index in range(len(ids) - 1, -1, -1):
+        if ids[index] not in had_bye:
+            return index
+    return len(ids) - 1
+
+def _match_without_rematches(ids, opponents, max_steps):
+    """Finds a perfect matching of ids in which nobody meets a previous
+    opponent, or returns None if there is none within max_steps.
+
+    The search walks the players in ranking order and gives each unpaired
+    player the nearest unpaired player below them that they have not met.
+    Because the ranking is sorted by score, that keeps pairs inside their
+    score group and floats a player down to the next group only when their
+    own group cannot pair them.  When a player cannot be paired at all the
+    search backtracks to the most recent pair and tries that player's next
+    candidate.
+
+    Returns:
+        A list of (index, index) pairs into ids.
+    """
+    count = len(ids)
+    partner = [-1] * count
+    stack = []
+    steps = 0
+    player = 0
+    candidate = 1
+    while True:
+        while player < count and partner[player] != -1:
+            player += 1
+            candidate = player + 1
+        if player == count:
+            return stack
+        played = opponents.get(ids[player], ())
+        found = -1
+        while candidate < count:
+            if partner[candidate] == -1 and ids[candidate] not in played:
+                found = candidate
+                break
+            candidate += 1
+        steps += candidate - player
+        if found != -1:
+            partner[player] = found
+            partner[found] = player
+            stack.append((player, found))
+            continue
+        if not stack or steps > max_steps:
+            return None
+        player, previous = stack.pop()
+        partner[player] = partner[previous] = -1
+        candidate = previous + 1
+
+def _match_greedily(ids, opponents):
+    """Pairs each player with the nearest unpaired player they have not
+    met, or with the nearest unpaired player if they have met them all.
+
+    This always succeeds and is used when no rematch-free pairing exists.
+    """
+    count = len(ids)
+    taken = [False] * count
+    pairs = []
+    for player in range(count):
+        if taken[player]:
+            continue
+        taken[player] = True
+        played = opponents.get(ids[player], ())
+        first_free = -1
+        found = -1
+        for candidate in range(player + 1, count):
+            if taken[candidate]:
+                continue
+            if first_free == -1:
+                first_free = candidate
+            if ids[candidate] not in played:
+                found = candidate
+                break
+        if found == -1:
+            found = first_free
+        taken[found] = True
+        pairs.append((player, found))
+    return pairs
+
+def pair_players(standings, opponents=None, had_bye=None,
+                 max_steps=DEFAULT_MAX_STEPS):
+    """Pairs a field for the next Swiss round.
+
+    Players are paired within their score group where possible and float
+    down to the next group when they cannot be, without repeating an
+    earlier pairing.  With an odd number of players the lowest ranked
+    player who has not had a bye sits out.  If no rematch-free pairing is
+    found within max_steps, the fewest rematches a greedy pass can manage
+    are allowed instead.
+
+    Args:
+        standings: A list of (player_id, name) or (player_id, name, ...)
+        rows in ranking order, best first.
+        opponents (optional): A dict mapping player_id to the set of
+        players they have already met, as built by opponent_index().
+        had_bye (optional): The set of players who have had a bye.
+        max_steps (optional): How many candidates the rematch-free search
+        may examine before giving up.
+
+    Returns:
+        A list of (id1, name1, id2, name2) tuples.  If a player gets a bye
+        it is the last tuple, with id2 and name2 set to None.
+    """
+    opponents = opponents if opponents is not None else {}
+    had_bye = had_bye if had_bye is not None else set()
+    field = list(standings)
+    bye = None
+    if len(field) % 2:
+        bye = field.pop(_choose_bye([row[0] for row in field], had_bye))
+    ids = [row[0] for row in field]
+    pairs = _match_without_rematches(ids, opponents, max_steps)
+    if pairs is None:
+        pairs = _match_greedily(ids, opponents)
+    pairs.sort()
+    match_ups = [(field[first][0], field[first][1],
+                  field[second][0], field[second][1])
+                 for first, second in pairs]
+    if bye is not None:
+        match_ups.append((bye[0], bye[1], None, None))
+    return match_ups
+
+def _pair_field(field):
+    """Pairs one (standings, match_rows, max_steps) field for pair_fields().
+    It is a module-level function so that a process pool can pickle it.
+    """
+    standings, match_rows, max_steps = field
+    opponents, had_bye = opponent_index(match_rows)
+    return pair_players(standings, opponents, had_bye, max_steps)
+
+def _context():
+    """Returns the multiprocessing context the worker pool is started with,
+    or None if there is none that does not fork this process.
+
+    Forking a process with open database connections and running threads
+    (the connection pool, the standings listener) can leave the children
+    with locks held by threads that no longer exist, so the workers are
+    started by a forkserver, or spawned where there is none.  Python 2 can
+    only fork, so it pairs in this process.
+    """
+    if not hasattr(multiprocessing, "get_context"):
+        return None
+    if "forkserver" in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context("forkserver")
+    return multiprocessing.get_context("spawn")
+
+def worker_pool(processes=None):
+    """Returns the shared pool of worker processes pair_fields() uses,
+    starting it on first use.
+
+    The pool is kept for the life of the process, so only the first batch
+    that uses it pays for starting the workers.  pair_fields() only starts
+    it for a batch large enough to use it.  Asking for another number of
+    processes replaces the pool.
+
+    Args:
+        processes (optional): The number of worker processes.  Defaults to
+        the number of CPUs.
+
+    Returns:
+        The pool, or None if processes is 1 or less or workers cannot be
+        started without forking.
+    """
+    global _pool, _pool_processes
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    context = _context()
+    if processes <= 1 or context is None:
+        return None
+    with _pool_lock:
+        if _pool is None or _pool_processes != processes:
+            _close_pool()
+            _pool = context.Pool(processes)
+            _pool_processes = processes
+        return _pool
+
+def close_pool():
+    """Stops the shared worker pool, if it was started."""
+    with _pool_lock:
+        _close_pool()
+
+def _close_pool():
+    global _pool, _pool_processes
+    if _pool is not None:
+        _pool.terminate()
+        _pool.join()
+    _pool = None
+    _pool_processes = 0
+
+atexit.register(close_pool)
+
+def pair_fields(fields, processes=None, max_steps=DEFAULT_MAX_STEPS):
+    """Pairs the next round of several tournaments at once, spreading them
+    over the worker_pool().
+
+    Pairing is CPU bound once rematches have to be avoided, so separate
+    tournaments are paired in separate processes.  The largest fields are
+    handed out first so that one big event does not start last and hold
+    up the whole batch.  With a single field, processes=1, no pool (see
+    worker_pool()) or fewer than PARALLEL_MIN_PLAYERS players in all,
+    everything is paired in this process.
+
+    Args:
+        fields: A list of (standings, match_rows) pairs, one per tournament,
+        as taken by pair_players() and opponent_index().
+        processes (optional): The number of worker processes.  Defaults to
+        the number of CPUs.
+        max_steps (optional): Passed on to pair_players().
+
+    Returns:
+        A list with the pair_players() result for each field, in the order
+        of fields.
+    """
+    work = [(standings, match_rows, max_steps)
+            for standings, match_rows in fields]
+    if (len(work) <= 1 or
+            sum(len(field[0]) for field in work) < PARALLEL_MIN_PLAYERS):
+        return [_pair_field(field) for field in work]
+    pool = worker_pool(processes)
+    if pool is None:
+        return [_pair_field(field) for field in work]
+    order = sorted(range(len(work)), key=lambda index: -len(work[index][0]))
+    paired = pool.map(_pair_field, [work[index] for index in order],
+                      chunksize=1)
+    results = [None] * len(work)
+    for index, match_ups in zip(order, paired):
+        results[index] = match_ups
+    return results
@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+#
+# tournament_ratings.py -- Elo rating engine for tournament.py
+#
+# Every player carries one Elo rating across all tournaments.  Ratings are
+# moved as results are reported, by rating_changes(), and can be worked out
+# again from the whole match history by recompute(), for backfills and after
+# the rules change.  Like tournament_pairing.py, this module does its work
+# in memory and does not touch the database.
+#
+# K_FACTOR can be changed to change the rules; rebuild the ratings with
+# recompute() afterwards so that earlier results are rated the same way.
+#
+# recompute() treats each round of a tournament as one rating period: every
+# match of the round is rated against the ratings the players had when the
+# round began.  A Swiss round pairs each player once, so that is also what
+# reporting the round's results one at a time gives.  numpy, when it is
+# installed, lets each round be rated in a handful of array operations.
+#
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+DEFAULT_RATING = 1500.0
+K_FACTOR = 32.0
+
+# A rating difference of SCALE points gives the stronger player an expected
+# score of 10/11.
+SCALE = 400.0
+
+# player_1's score for each rated result.  Byes are not rated.
+SCORES = {'win': 1.0, 'loss': 0.0, 'draw': 0.5}
+
+
+def expected_score(rating, opponent_rating):
+    """Returns the score a player rated rating is expected to make against
+    one rated opponent_rating, between 0 and 1.
+    """
+    return 1.0 / (1.0 + 10.0 ** ((opponent_rating - rating) / SCALE))
+
+def rating_changes(ratings, games, k_factor=None):
+    """Works out how reporting or changing results moves the ratings.
+
+    A reported result moves player_1 by k_factor times the difference
+    between their score and their expected score, and player_2 by the
+    same amount the other way.  A result that replaces another takes the
+    old one's change back at the same ratings, so a correction swings the
+    ratings by the difference between the two scores.
+
+    Args:
+        ratings: A dict mapping each player in games to their rating.
+        games: An iterable of (player_1, player_2, old_result, new_result)
+        tuples, with results from player_1's point of view and None for an
+        unreported match.
+        k_factor (optional): The most a single game can move a rating.
+        Defaults to K_FACTOR.
+
+    Returns:
+        A dict mapping each player whose rating moves to a [rating,
+        rated_games] pair of changes.
+    """
+    if k_factor is None:
+        k_factor = K_FACTOR
+    changes = {}
+    for player_1, player_2, old_result, new_result in games:
+        if player_2 is None:
+            continue
+        expected = expected_score(ratings[player_1], ratings[player_2])
+        points = 0.0
+        played = 0
+        if old_result in SCORES:
+            points -= SCORES[old_result] - expected
+            played -= 1
+        if new_result in SCORES:
+            points += SCORES[new_result] - expected
+            played += 1
+        if not played and not points:
+            continue
+        for player_id, sign in ((player_1, 1), (player_2, -1)):
+            change = changes.setdefault(player_id, [0.0, 0])
+            change[0] += sign * k_factor * points
+            change[1] += played
+    return changes
+
+def recompute(matches, k_factor=None, initial=DEFAULT_RATING):
+    """Works out every player's rating from scratch.
+
+    Args:
+        matches: An iterable of (tournament_id, round, player_1, player_2,
+        result) rows in the order they were paired, as match_id orders
+        them.  Rows without a rated result are skipped.
+        k_factor (optional): The most a single game can move a rating.
+        Defaults to K_FACTOR.
+        initial (optional): The rating every player starts from.
+
+    Returns:
+        A dict mapping each player who has played a rated game to a
+        (rating, rated_games) tuple.
+    """
+    if k_factor is None:
+        k_factor = K_FACTOR
+    periods = []
+    period_of = {}
+    for tournament_id, round_number, player_1, player_2, result in matches:
+        if player_2 is None or result not in SCORES:
+            continue
+        key = (tournament_id, round_number)
+        if key not in period_of:
+            period_of[key] = len(periods)
+            periods.append([])
+        periods[period_of[key]].append((player_1, player_2, SCORES[result]))
+    if numpy is not None:
+        return _recompute_arrays(periods, k_factor, initial)
+    ratings = {}
+    games = {}
+    for period in periods:
+        changes = {}
+        for player_1, player_2, score in period:
+            change = k_factor * (score - expected_score(
+                ratings.get(player_1, initial), ratings.get(player_2, initial)))
+            changes[player_1] = changes.get(player_1, 0.0) + change
+            changes[player_2] = changes.get(player_2, 0.0) - change
+            games[player_1] = games.get(player_1, 0) + 1
+            games[player_2] = games.get(player_2, 0) + 1
+        for player_id, change in changes.items():
+            ratings[player_id] = ratings.get(player_id, initial) + change
+    return dict((player_id, (ratings[player_id], games[player_id]))
+                for player_id in ratings)
+
+def _recompute_arrays(periods, k_factor, initial):
+    """recompute() with numpy: the games of all periods are laid out in
+    arrays once, the players' ratings live in one array, and each period
+    is rated with a few vector operations on its slice of the games.
+    """
+    if not periods:
+        return {}
+    games = numpy.array([game for period in periods for game in period],
+                        dtype=numpy.float64)
+    bounds = numpy.cumsum([0] + [len(period) for period in periods])
+    players = games[:, :2].astype(numpy.int64)
+    player_ids, slots = numpy.unique(players, return_inverse=True)
+    slots = slots.reshape(players.shape)
+    first, second, scores = slots[:, 0], slots[:, 1], games[:, 2]
+    ratings = numpy.full(len(player_ids), initial, dtype=numpy.float64)
+    for start, stop in zip(bounds[:-1], bounds[1:]):
+        period_first = first[start:stop]
+        period_second = second[start:stop]
+        expected = 1.0 / (1.0 + 10.0 ** (
+            (ratings[period_second] - ratings[period_first]) / SCALE))
+        change = k_factor * (scores[start:stop] - expected)
+        numpy.add.at(ratings, period_first, change)
+        numpy.add.at(ratings, period_second, -change)
+    played = numpy.bincount(slots.ravel(), minlength=len(player_ids))
+    return dict((int(player_id), (float(rating), int(count)))
+                for player_id, rating, count
+                in zip(player_ids, ratings, played))
@@ -6,13 +6,28 @@
 # If you do add any of the extra credit options, be sure to add/modify these test cases
 # as appropriate to account for your module's added functionality.
 
+import json
+import random
+import threading
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
 from tournament import *
 
 def clear_all_tables():
+    if not isinstance(get_backend(), PostgresBackend):
+        # The memory backend starts out empty.
+        return
+    # Purging drops each tournament's partitions along with its rows.
+    conn, cursor = connect()
+    cursor.execute("SELECT tournament_id FROM tournaments")
+    tournament_ids = [row[0] for row in cursor.fetchall()]
+    commit_and_close(conn, cursor)
+    for tournament_id in tournament_ids:
+        purge_tournament(tournament_id)
     conn, cursor = connect()
-    cursor.execute("DELETE FROM matches")
-    cursor.execute("DELETE FROM tournament_data")
-    cursor.execute("DELETE FROM tournaments")
     cursor.execute("DELETE FROM players")
     commit_and_close(conn, cursor)
 
@@ -155,41 +170,624 @@ def testPairings():
                 "After one match, players with one win should be paired.")
     print "10. After one match, players with one win are properly paired."
 
+def testBulkRegistration():
+    """
+    Test that a roster is registered in bulk, reactivating inactive players
+    and skipping repeated email addresses.
+    """
+    deleteMatches()
+    deletePlayers('ALL')
+    registerPlayer("Zecora", "zecora@fake.com")
+    [(zecora_id, name, wins, matches)] = playerStandings()
+    deletePlayers(zecora_id, 'ALL')
+    results = registerPlayers([("Trixie", "trixie@fake.com"),
+                               ("Zecora", "zecora@fake.com"),
+                               ("Great and Powerful Trixie", "trixie@fake.com")])
+    outcomes = [outcome for (player_id, email, outcome) in results]
+    if outcomes != ['registered', 'reactivated', 'duplicate']:
+        raise ValueError(
+            "registerPlayers should report each row's outcome. Got {o}".format(o=outcomes))
+    if results[1][0] != zecora_id or results[0][0] != results[2][0]:
+        raise ValueError("registerPlayers should return each row's player id.")
+    if countPlayers() != 2:
+        raise ValueError("After a bulk registration, countPlayers() should be 2.")
+    results = registerPlayers([("Trixie", "trixie@fake.com")])
+    if results[0][2] != 'already_entered' or countPlayers() != 2:
+        raise ValueError("Players should only be entered into a tournament once.")
+    print "11. registerPlayers() registers a roster in bulk."
+
+def testReportRound():
+    """
+    Test that a round is reported in one batch and that unpaired or repeated
+    results are rejected without recording anything.
+    """
+    deleteMatches()
+    deletePlayers('ALL')
+    registerPlayer("Twilight Sparkle", "tsparkle@fake.com")
+    registerPlayer("Fluttershy", "fluttershy@fake.com")
+    registerPlayer("Applejack", "applejack@fake.com")
+    registerPlayer("Pinkie Pie", "ppie@fake.com")
+    [(id1, n1, id2, n2), (id3, n3, id4, n4)] = swissPairings()
+    for bad_round in ([(id1, id3), (id2, id4)], [(id1, id2), (id1, id2)]):
+        try:
+            reportMatches(bad_round)
+        except ValueError:
+            pass
+        else:
+            raise ValueError("reportMatches should reject {r}.".format(r=bad_round))
+    for (i, n, w, m) in playerStandings():
+        if m != 0:
+            raise ValueError("A rejected round should not record any matches.")
+    reportMatches([(id1, id2), (id4, id3)])
+    for (i, n, w, m) in playerStandings():
+        if m != 1:
+            raise ValueError("Each player should have one match recorded.")
+        if (i in (id1, id4)) != (w == 1):
+            raise ValueError("Only the winners should have a win recorded.")
+    print "12. reportMatches() records a round in one batch."
+
+def testByesAndRematches():
+    """
+    Test that an odd field gets a bye and that players are not paired with
+    someone they have already played.
+    """
+    deleteMatches()
+    deletePlayers('ALL')
+    registerPlayer("Twilight Sparkle", "tsparkle@fake.com")
+    registerPlayer("Fluttershy", "fluttershy@fake.com")
+    registerPlayer("Applejack", "applejack@fake.com")
+    registerPlayer("Pinkie Pie", "ppie@fake.com")
+    registerPlayer("Rarity", "rarity@fake.com")
+    played = set()
+    byes = set()
+    for round_number in range(3):
+        pairings = swissPairings()
+        if len(pairings) != 3 or pairings[-1][2] is not None:
+            raise ValueError("Five players should get two pairs and a bye.")
+        (bye_id, bye_name, none_id, none_name) = pairings[-1]
+        if bye_id in byes:
+            raise ValueError("No player should get a second bye while others have none.")
+        byes.add(bye_id)
+        for (pid1, pname1, pid2, pname2) in pairings[:-1]:
+            if frozenset([pid1, pid2]) in played:
+                raise ValueError("Players should not be paired against the same opponent twice.")
+            played.add(frozenset([pid1, pid2]))
+        reportMatches([(pid1, pid2) for (pid1, pname1, pid2, pname2) in pairings[:-1]])
+    print "13. Odd fields get byes and rematches are avoided."
+
+def testTiebreakStandings():
+    """
+    Test that standings carry tiebreakers and come back in a stable order.
+    """
+    deleteMatches()
+    deletePlayers('ALL')
+    registerPlayer("Twilight Sparkle", "tsparkle@fake.com")
+    registerPlayer("Fluttershy", "fluttershy@fake.com")
+    registerPlayer("Applejack", "applejack@fake.com")
+    registerPlayer("Pinkie Pie", "ppie@fake.com")
+    [(id1, n1, id2, n2), (id3, n3, id4, n4)] = swissPairings()
+    reportMatches([(id1, id2), (id3, id4)])
+    standings = playerStandings(tiebreaks=True)
+    if len(standings[0]) != 7:
+        raise ValueError("Standings with tiebreaks should have seven columns.")
+    for (i, n, w, m, omw, buchholz, sos) in standings:
+        if i in (id1, id3) and (abs(omw - 1.0 / 3) > 1e-9 or buchholz != 0):
+            raise ValueError("A winner's only opponent lost, so OMW% should be 1/3 and Buchholz 0.")
+        if i in (id2, id4) and (abs(omw - 1.0) > 1e-9 or buchholz != 1):
+            raise ValueError("A loser's only opponent won, so OMW% should be 1 and Buchholz 1.")
+    if [row[0] for row in standings[:2]] != sorted([id1, id3]):
+        raise ValueError("Players tied on every tiebreaker should be ordered by id.")
+    if [row[:4] for row in standings] != playerStandings():
+        raise ValueError("Standings should be in the same order with or without tiebreaks.")
+    print "14. Standings are ordered by tiebreakers."
+
+def testResultCorrection():
+    """
+    Test that results are stored on matches, that one result can be
+    corrected and that rebuilding the standings from the results agrees.
+    """
+    deleteMatches()
+    deletePlayers('ALL')
+    registerPlayer("Twilight Sparkle", "tsparkle@fake.com")
+    registerPlayer("Fluttershy", "fluttershy@fake.com")
+    registerPlayer("Applejack", "applejack@fake.com")
+    registerPlayer("Pinkie Pie", "ppie@fake.com")
+    [(id1, n1, id2, n2), (id3, n3, id4, n4)] = swissPairings()
+    reportMatches([(id1, id2), (id3, id4)])
+    try:
+        reportMatches([(id1, id2)])
+    except ValueError:
+        pass
+    else:
+        raise ValueError("A result should not be reported twice.")
+    results = dict(((p1, p2), (match_id, result))
+                   for (match_id, rnd, p1, p2, result, version) in match_history())
+    if results[(id1, id2)][1] != 'win' or results[(id3, id4)][1] != 'win':
+        raise ValueError("Reported results should be stored on their matches.")
+    correct_result(results[(id3, id4)][0], 'loss')
+    records = dict((i, (w, m)) for (i, n, w, m) in playerStandings())
+    if records[id3] != (0, 1) or records[id4] != (1, 1) or records[id1] != (1, 1):
+        raise ValueError("Correcting a result should only change its players' records.")
+    standings = playerStandings()
+    rebuild_standings()
+    if playerStandings() != standings:
+        raise ValueError("Rebuilding standings should agree with the incremental records.")
+    [(id5, n5, id6, n6), (id7, n7, id8, n8)] = swissPairings()
+    reportMatch(id5, id6, draw=True)
+    drawn = dict((i, (w, m)) for (i, n, w, m) in playerStandings())
+    for i in (id5, id6):
+        if drawn[i] != (records[i][0], 2):
+            raise ValueError("A draw should count as a match but not a win for both players.")
+    matches = len(match_history())
+    reportMatch(id5, id6, draw=True)
+    if len(match_history()) != matches or \
+            dict((i, (w, m)) for (i, n, w, m) in playerStandings()) != drawn:
+        raise ValueError("Reporting a result again should count it once.")
+    try:
+        reportMatch(id5, id6)
+    except ResultConflict:
+        pass
+    else:
+        raise ValueError("A different result for a reported pair should conflict.")
+    errors = []
+    def station():
+        try:
+            reportMatch(id7, id8)
+        except Exception as error:
+            errors.append(error)
+    stations = [threading.Thread(target=station) for i in range(4)]
+    for thread in stations:
+        thread.start()
+    for thread in stations:
+        thread.join()
+    if errors:
+        raise ValueError("Repeated reports should not fail: {e}".format(e=errors[0]))
+    reported = dict((i, (w, m)) for (i, n, w, m) in playerStandings())
+    if len(match_history()) != matches or \
+            reported[id7] != (records[id7][0] + 1, 2) or \
+            reported[id8] != (records[id8][0], 2):
+        raise ValueError("A pair reported at once by several stations should count once.")
+    [(id9, n9, id10, n10), (id11, n11, id12, n12)] = swissPairings()
+    ratings = dict((row[0], row[2:]) for row in player_ratings())
+    deletePlayers(id10)
+    wins = dict((i, w) for (i, n, w, m) in playerStandings())[id9]
+    reportMatch(id9, id10)
+    rated = dict((row[0], row[2:]) for row in player_ratings())
+    if rated[id9][0] <= ratings[id9][0] or rated[id9][1] != ratings[id9][1] + 1 or \
+            rated[id10][1] != ratings[id10][1] + 1:
+        raise ValueError("A match should be rated even if a player has left.")
+    if dict((i, w) for (i, n, w, m) in playerStandings())[id9] != wins + 1:
+        raise ValueError("The remaining player's win should be counted.")
+    id13 = registerPlayer("Rainbow Dash", "rdash@fake.com")
+    id14 = registerPlayer("Rarity", "rarity@fake.com")
+    matches = len(match_history())
+    def unpaired_station():
+        try:
+            reportMatch(id13, id14)
+        except Exception as error:
+            errors.append(error)
+    stations = [threading.Thread(target=unpaired_station) for i in range(4)]
+    for thread in stations:
+        thread.start()
+    for thread in stations:
+        thread.join()
+    if errors:
+        raise ValueError("Repeated reports should not fail: {e}".format(e=errors[0]))
+    reported = dict((i, (w, m)) for (i, n, w, m) in playerStandings())
+    if len(match_history()) != matches + 1 or reported[id13] != (1, 1) or \
+            reported[id14] != (0, 1):
+        raise ValueError("An unpaired pair reported at once by several "
+                         "stations should add one match.")
+    print "15. Results are stored on matches and can be corrected."
+
+def testConcurrentReporting():
+    """
+    Stress test: many stations submit every result of a large round several
+    times in parallel, and the standings must still come out exact.
+    """
+    deleteMatches()
+    deletePlayers('ALL')
+    registerPlayers([("Station Player %d" % i, "station%d@fake.com" % i)
+                     for i in range(1000)])
+    swissPairings()
+    matches = [(match_id, p1, p2) for (match_id, rnd, p1, p2, result, version)
+               in match_history()]
+    rng = random.Random(9)
+    results = dict((match_id, rng.choice(['win', 'loss', 'draw']))
+                   for (match_id, p1, p2) in matches)
+    submissions = [match_id for match_id in results for copy in range(4)]
+    rng.shuffle(submissions)
+    tournament_id = get_current_tournament()
+    applied = []
+    errors = []
+    def station(batch, *tournament):
+        try:
+            for match_id in batch:
+                version, changed = submit_result(
+                    match_id, results[match_id],
+                    tournament_id=tournament[0] if tournament else None)
+                if changed:
+                    applied.append(match_id)
+        except Exception as error:
+            errors.append(error)
+    # Half the stations name the tournament, as a station that knows it
+    # should, and half leave submit_result() to look it up.
+    stations = [threading.Thread(target=station,
+                                 args=(submissions[i::32],) + (
+                                     (tournament_id,) if i % 2 else ()))
+                for i in range(32)]
+    for thread in stations:
+        thread.start()
+    for thread in stations:
+        thread.join()
+    if errors:
+        raise ValueError("Repeated submissions should not fail: {e}".format(e=errors[0]))
+    if sorted(applied) != sorted(results):
+        raise ValueError("Each result should be applied exactly once.")
+    expected = {}
+    for (match_id, p1, p2) in matches:
+        result = results[match_id]
+        expected[p1] = (1 if result == 'win' else 0, 1)
+        expected[p2] = (1 if result == 'loss' else 0, 1)
+    if dict((i, (w, m)) for (i, n, w, m) in playerStandings()) != expected:
+        raise ValueError("Standings after concurrent reporting should be exact.")
+    match_id = matches[0][0]
+    other = 'draw' if results[match_id] != 'draw' else 'win'
+    try:
+        submit_result(match_id, other)
+    except ResultConflict:
+        pass
+    else:
+        raise ValueError("A different result for a reported match should conflict.")
+    elsewhere = create_tournament("Elsewhere").tournament_id
+    try:
+        submit_result(match_id, other, tournament_id=elsewhere)
+    except ResultConflict:
+        raise ValueError("A match should only be found in its own tournament.")
+    except ValueError:
+        pass
+    else:
+        raise ValueError("A match should only be found in its own tournament.")
+    if submit_result(match_id, other, expected_version=1,
+                     tournament_id=tournament_id) != (2, True):
+        raise ValueError("A correction at the current version should be applied.")
+    print "16. Concurrent, repeated result submissions give exact standings."
+
+def testInstrumentation():
+    """
+    Test that public calls are reported to hooks and to the stats snapshot
+    while instrumentation is enabled, and not once it is disabled.
+    """
+    deleteMatches()
+    deletePlayers('ALL')
+    registerPlayer("Twilight Sparkle", "tsparkle@fake.com")
+    records = []
+    instrumentation_snapshot(reset=True)
+    enable_instrumentation(records.append)
+    try:
+        playerStandings()
+    finally:
+        disable_instrumentation()
+    countPlayers()
+    if [record["operation"] for record in records] != ["playerStandings"]:
+        raise ValueError("Each public call should be reported to the hook once.")
+    queries = [name for (name, seconds, rows) in records[0]["queries"]]
+    if isinstance(get_backend(), PostgresBackend):
+        # The registration changed the standings version, so the cache
+        # looks the version up and then reads the standings.
+        if queries != ["current_tournament", "standings_version", "standings",
+                       "COMMIT"]:
+            raise ValueError("The hook should see every statement. Got {q}".format(q=queries))
+        if records[0]["statements"] != 3 or records[0]["round_trips"] != 4:
+            raise ValueError("Statements and round trips should be counted.")
+    operations = instrumentation_snapshot()["operations"]
+    if list(operations) != ["playerStandings"] or operations["playerStandings"]["calls"] != 1:
+        raise ValueError("The snapshot should total the instrumented calls.")
+    print "17. Instrumentation counts the statements of each call."
+
+def testStreaming():
+    """
+    Test that streamed standings, pairings and history, keyset pages and
+    exports agree with the list-returning functions.
+    """
+    deleteMatches()
+    deletePlayers('ALL')
+    registerPlayers([("Stream Player %d" % i, "stream%d@fake.com" % i)
+                     for i in range(11)])
+    pairings = swissPairings()
+    reportMatches([(p1, p2) for (p1, n1, p2, n2) in pairings[:-1]])
+    standings = playerStandings(tiebreaks=True)
+    if list(stream_standings(tiebreaks=True, batch_size=3)) != standings:
+        raise ValueError("Streamed standings should match playerStandings().")
+    if list(stream_pairings(batch_size=2)) != pairings:
+        raise ValueError("Streamed pairings should match swissPairings().")
+    if list(stream_history(batch_size=4)) != match_history():
+        raise ValueError("Streamed history should match match_history().")
+    tournament = get_tournament(get_current_tournament())
+    paged = []
+    after = 0
+    while after is not None:
+        rows, after = tournament.standings_page(after, 4, tiebreaks=True)
+        paged.extend(rows)
+    if paged != standings:
+        raise ValueError("Paging through the standings should visit every row once.")
+    rows, after = tournament.standings_page(0, 4)
+    tournament.correct_result(match_history()[0][0], 'draw')
+    try:
+        tournament.standings_page(after, 4)
+    except StandingsChanged:
+        pass
+    else:
+        raise ValueError("A page after the standings changed should be refused.")
+    rows, after = tournament.standings_page(0, 4)
+    deletePlayers(registerPlayer("Stream Visitor", "visitor@fake.com"))
+    try:
+        tournament.standings_page(after, 4)
+    except StandingsChanged:
+        pass
+    else:
+        raise ValueError("A page after writes that leave the same rows should be refused.")
+    paged = []
+    after = 0
+    while after is not None:
+        rows, after = tournament.history_page(after, 2)
+        paged.extend(rows)
+    if paged != match_history():
+        raise ValueError("Paging through the history should visit every match once.")
+    out = StringIO()
+    if export_standings(out) != 11 or len(out.getvalue().splitlines()) != 12:
+        raise ValueError("A CSV export should have a header and a row per player.")
+    out = StringIO()
+    export_history(out, "jsonl")
+    exported = [json.loads(line) for line in out.getvalue().splitlines()]
+    if [row["match_id"] for row in exported] != [row[0] for row in match_history()]:
+        raise ValueError("A JSON lines export should have an object per match.")
+    print "18. Standings, pairings and history can be streamed, paged and exported."
+
+def testStandingsCache():
+    """
+    Test that a repeated standings read is served from the cache and that
+    the next read after each kind of write sees it.
+    """
+    deleteMatches()
+    deletePlayers('ALL')
+    registerPlayer("Twilight Sparkle", "tsparkle@fake.com")
+    registerPlayer("Fluttershy", "fluttershy@fake.com")
+    standings = playerStandings()
+    cache = get_db().standings_cache
+    hits = cache.hits
+    if playerStandings() != standings:
+        raise ValueError("A repeated read should return the same standings.")
+    if isinstance(get_backend(), PostgresBackend) and cache.hits != hits + 1:
+        raise ValueError("A repeated read should be served from the standings cache.")
+    registerPlayer("Applejack", "applejack@fake.com")
+    standings = playerStandings()
+    if len(standings) != 3:
+        raise ValueError("Registering a player should change the cached standings.")
+    [id1, id2, id3] = [row[0] for row in standings]
+    reportMatch(id1, id2)
+    if dict((i, w) for (i, n, w, m) in playerStandings())[id1] != 1:
+        raise ValueError("Reporting a match should change the cached standings.")
+    deletePlayers(id3)
+    if len(playerStandings()) != 2:
+        raise ValueError("Deleting a player should change the cached standings.")
+    deleteMatches()
+    if [w for (i, n, w, m) in playerStandings()] != [0, 0]:
+        raise ValueError("Deleting matches should change the cached standings.")
+    cache = StandingsCache()
+    generation = cache.generation(1)
+    cache.invalidate(1)
+    cache.put((1, False), 5, ((1, "Twilight Sparkle", 0, 0),), generation)
+    if cache.get((1, False)) is not None:
+        raise ValueError("Rows read before an invalidation should not be cached.")
+    cache.put((1, False), 6, ((1, "Twilight Sparkle", 0, 0),),
+              cache.generation(1))
+    if cache.get((1, False), 6) is None:
+        raise ValueError("Rows read after the invalidation should be cached.")
+    print "19. Cached standings are reused until a write changes them."
+
+def testParallelPairings():
+    """
+    Test that pair_tournaments() pairs several tournaments in one batch,
+    recording each one's round and bye as swissPairings() would.
+    """
+    odd = create_tournament("Parallel odd")
+    even = create_tournament("Parallel even")
+    for i in range(5):
+        odd.register_player("Odd %d" % i, "odd%d@fake.com" % i)
+    for i in range(4):
+        even.register_player("Even %d" % i, "even%d@fake.com" % i)
+    first = pair_tournaments([odd.tournament_id, even.tournament_id],
+                             processes=2)
+    for handle, size in ((odd, 5), (even, 4)):
+        match_ups = first[handle.tournament_id]
+        paired = [match[0] for match in match_ups] + \
+            [match[2] for match in match_ups if match[2] is not None]
+        if sorted(paired) != sorted(row[0] for row in handle.standings()):
+            raise ValueError("Every player should be paired exactly once.")
+        if len(handle.match_history()) != (size + 1) // 2:
+            raise ValueError("Each tournament's pairings should be recorded.")
+    if first[odd.tournament_id][-1][2] is not None:
+        raise ValueError("The odd tournament should have a bye.")
+    if odd.standings()[0][2] != 1:
+        raise ValueError("The bye should be recorded as a win.")
+    second = pair_tournaments([even.tournament_id], processes=1)
+    met = set(frozenset((match[0], match[2]))
+              for match in first[even.tournament_id])
+    for match in second[even.tournament_id]:
+        if frozenset((match[0], match[2])) in met:
+            raise ValueError("The next round should avoid rematches.")
+    if set(row[1] for row in even.match_history()) != set([1, 2]):
+        raise ValueError("The second batch should be recorded as round 2.")
+    print "20. Several tournaments are paired in one batch."
+
+def testRatings():
+    """
+    Test that ratings move as results are reported and corrected, that a
+    rebuild from the match history agrees with them, and that standings and
+    pairings can be seeded by rating.
+    """
+    create_tournament("Rated")
+    ids = [registerPlayer("Rated %d" % i, "rated%d@fake.com" % i)
+           for i in range(4)]
+    def ratings():
+        return dict((row[0], row[2:]) for row in player_ratings()
+                    if row[0] in ids)
+    if set(ratings().values()) != set([(1500.0, 0)]):
+        raise ValueError("New players should start at the default rating.")
+    for (id1, name1, id2, name2) in swissPairings():
+        reportMatch(id1, id2)
+    after_one = ratings()
+    if sorted(rating for rating, games in after_one.values()) != \
+            [1484.0, 1484.0, 1516.0, 1516.0]:
+        raise ValueError("An even game should move each rating by 16.")
+    for (id1, name1, id2, name2) in swissPairings(by_rating=True):
+        reportMatch(id1, id2)
+    incremental = ratings()
+    if abs(sum(rating for rating, games in incremental.values()) - 6000) > 1e-6:
+        raise ValueError("Rating points should only move between players.")
+    rebuild_ratings()
+    for player_id, (rating, games) in ratings().items():
+        if games != 2 or abs(rating - incremental[player_id][0]) > 1e-6:
+            raise ValueError("Rebuilding should give the incremental ratings.")
+    standings = playerStandings(by_rating=True)
+    if len(standings[0]) != 5:
+        raise ValueError("Rated standings should end with the rating.")
+    order = [(-row[2], -row[4]) for row in standings]
+    if order != sorted(order):
+        raise ValueError("Rated standings should order equal points by rating.")
+    match_id, round_number, player_1, player_2, result, version = \
+        match_history()[-1]
+    before = ratings()
+    correct_result(match_id, 'loss')
+    after = ratings()
+    if abs(after[player_1][0] - before[player_1][0] + 32) > 1e-6 or \
+            abs(after[player_2][0] - before[player_2][0] - 32) > 1e-6:
+        raise ValueError("Correcting a win to a loss should swing 32 points.")
+    print "21. Ratings follow results and can be rebuilt from history."
+
+def testArchiveAndPurge():
+    """
+    Test that a tournament can be archived, restored and purged without
+    touching the tournaments around it.
+    """
+    kept = create_tournament("Kept")
+    kept.register_player("Rarity", "rarity@fake.com")
+    event = create_tournament("Archived")
+    tid = event.tournament_id
+    registerPlayer("Spike", "spike@fake.com")
+    registerPlayer("Starlight", "starlight@fake.com")
+    [(id1, name1, id2, name2)] = swissPairings()
+    reportMatch(id1, id2)
+    archive_tournament(tid)
+    if countPlayers(tid) != 0 or match_history(tid):
+        raise ValueError("An archived tournament should have no live data.")
+    try:
+        archive_tournament(tid)
+    except ValueError:
+        pass
+    else:
+        raise ValueError("A tournament cannot be archived twice.")
+    restore_tournament(tid)
+    if countPlayers(tid) != 2 or len(match_history(tid)) != 1:
+        raise ValueError("Restoring should bring the players and matches back.")
+    if [row[2] for row in playerStandings()] != [1, 0]:
+        raise ValueError("Restored standings should keep their results.")
+    purge_tournament(tid)
+    try:
+        get_tournament(tid)
+    except ValueError:
+        pass
+    else:
+        raise ValueError("A purged tournament should be gone.")
+    if countPlayers(kept.tournament_id) != 1:
+        raise ValueError("Purging should leave other tournaments alone.")
+    print "22. Tournaments can be archived, restored and purged."
+
+class _RecordingConnection(object):
+    """Stands in for a psycopg2 connection."""
+
+class _RecordingCursor(object):
+    """Stands in for a psycopg2 cursor, recording the SQL it is given and
+    failing it when failing is set.
+    """
+
+    def __init__(self):
+        self.connection = _RecordingConnection()
+        self.queries = []
+        self.failing = False
+
+    def execute(self, query, parameters=None):
+        self.queries.append(query)
+        if self.failing:
+            raise ValueError("The statement failed.")
+
+def testPreparedStatements():
+    """
+    Test that the hot statements are prepared once per connection, that a
+    failure makes the next statement start afresh, and that the single
+    round trip writes stay single round trips.
+    """
+    registry = StatementRegistry()
+    first = _RecordingCursor()
+    second = _RecordingCursor()
+    for cursor in (first, first, second):
+        registry.execute(cursor, "count_players", (1,))
+    registry.execute(first, "standings", (1,))
+    registry.execute(first, "delete_matches", (1,))
+    prepare, execute = PREPARED_SQL["count_players"]
+    if first.queries[:2] != ["DEALLOCATE ALL; " + prepare, execute]:
+        raise ValueError("A statement should be prepared on first use only.")
+    if second.queries != ["DEALLOCATE ALL; " + prepare]:
+        raise ValueError("Each connection should prepare its own statements.")
+    if first.queries[2] != PREPARED_SQL["standings"][0]:
+        raise ValueError("Each statement should be prepared when first run.")
+    if first.queries[3] != STATEMENTS["delete_matches"]:
+        raise ValueError("Cold statements should run without preparing.")
+    if "$1" not in prepare or "%s" in prepare.split(";")[0]:
+        raise ValueError("Placeholders should be numbered in the PREPARE.")
+    first.failing = True
+    try:
+        registry.execute(first, "count_players", (1,))
+    except ValueError:
+        pass
+    first.failing = False
+    registry.execute(first, "count_players", (1,))
+    if first.queries[-1] != "DEALLOCATE ALL; " + prepare:
+        raise ValueError("A failure should make the connection start afresh.")
+    if isinstance(get_backend(), PostgresBackend):
+        deleteMatches()
+        deletePlayers('ALL')
+        records = []
+        enable_instrumentation(records.append)
+        try:
+            for name in ("Applejack", "Rarity"):
+                registerPlayer(name, name.lower() + "@fake.com")
+            [(id1, name1, id2, name2)] = swissPairings()
+            reportMatch(id1, id2)
+        finally:
+            disable_instrumentation()
+        trips = [(record["operation"], record["round_trips"])
+                 for record in records]
+        if trips != [("registerPlayer", 3), ("registerPlayer", 3),
+                     ("swissPairings", 5), ("reportMatch", 3)]:
+            raise ValueError("Writes should take one round trip each. "
+                             "Got {0}".format(trips))
+    print "23. Hot statements are prepared once per connection."
+
 def test_create_tournaments():
     """Test that tournaments are created properly and that the current
     tournament is correctly reported
     """
-    conn, cursor = connect()
-    cursor.execute("DELETE FROM tournaments")
-    create_tournament("First is the worst!")
-    create_tournament("Second is the best!")
-    create_tournament("Third is the one with the hairy chest!")
-    cursor.execute("SELECT tournament_id, name  FROM tournaments \
-                   ORDER BY tournament_id DESC")
-    tourney_data = cursor.fetchmany(3)
-    [id3, id2, id1] = [row[0] for row in tourney_data]
-    [name_3, name_2, name_1] = [row[1] for row in tourney_data]
-    # if tourney_data[0][0] != 1:
-    #     raise ValueError ("After adding the first tournament of the table, "
-    #                       "the table's ID should be 1")
-    # if tourney_data[0][1] != "First is the worst!":
-    #     print tourney_data[0][1]
-    #     raise ValueError ("After adding the first tournament, the name "
-    #                       "should be 'First is the worst'.")
-    # if tourney_data[1][0] != 2:
-    #     raise ValueError ("After adding the first tournament of the table, "
-    #                       "the table's ID should be 1")
-    # if tourney_data[1][1] != 'Second is the best!':
-    #     raise ValueError ("After adding the first tournament, the name "
-    #                       "should be 'First is the worst'.")
-    cursor = conn.cursor()
-    cursor.execute("SELECT * FROM current_tournament")
-    current_tournament = cursor.fetchone()
-    current_tournament = current_tournament[0]
-    # if current_tournament != 3:
-    #     raise ValueError ("The current tournament, after adding 3 tournaments "
-    #                       "should be 3!")
-    commit_and_close(conn, cursor)
+    first = create_tournament("First is the worst!")
+    second = create_tournament("Second is the best!")
+    third = create_tournament("Third is the one with the hairy chest!")
+    if not first.tournament_id < second.tournament_id < third.tournament_id:
+        raise ValueError("Tournaments should be given increasing ids.")
+    if get_tournament(second.tournament_id) != second:
+        raise ValueError("A created tournament should be found by its id.")
+    if get_current_tournament() != third.tournament_id:
+        raise ValueError("The current tournament should be the latest one.")
     print "1. Tournaments created successfully!"
 
 
@@ -200,4 +798,17 @@ if __name__ == '__main__':
     testStandingsBeforeMatches()
     testReportMatches()
     testPairings()
+    testBulkRegistration()
+    testReportRound()
+    testByesAndRematches()
+    testTiebreakStandings()
+    testResultCorrection()
+    testConcurrentReporting()
+    testInstrumentation()
+    testStreaming()
+    testStandingsCache()
+    testParallelPairings()
+    testRatings()
+    testArchiveAndPurge()
+    testPreparedStatements()
     print "Success!  All tests pass!"